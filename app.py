@@ -1,5 +1,5 @@
 import streamlit as st
-import os
+import numpy as np
 import pandas as pd
 
 import qc_core as qc
@@ -114,6 +114,26 @@ with col2:
             "Vào trang **2_Ghi_nhan_va_danh_gia** để tính."
         )
 
+    st.markdown("#### 🧬 Tình trạng QC tất cả xét nghiệm")
+    all_results = qc.evaluate_westgard_store()
+    if all_results:
+        overview_rows = []
+        for name, res in all_results.items():
+            has_data = ~np.isnan(res.z).all(axis=1)
+            run_status = np.asarray(res.run_status(), dtype=object)[has_data]
+            overview_rows.append(
+                {
+                    "Xét nghiệm": name,
+                    "Số lần chạy": int(has_data.sum()),
+                    "Cảnh báo": int((res.run_warn & ~res.run_reject)[has_data].sum()),
+                    "Không đạt": int(res.run_reject[has_data].sum()),
+                    "Lần gần nhất": run_status[-1] if run_status.size else "",
+                }
+            )
+        st.dataframe(pd.DataFrame(overview_rows), use_container_width=True, hide_index=True)
+    else:
+        st.caption("Chưa có xét nghiệm nào có dữ liệu z-score.")
+
     st.markdown("#### 🧭 Gợi ý thao tác tiếp theo")
     st.markdown(
         """
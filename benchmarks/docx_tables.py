@@ -0,0 +1,68 @@
+"""
+Benchmark ghi bảng Word: thời gian ghi bảng Sổ ghi nhận 10 cột cho 31, 365, 3000 dòng.
+
+So sánh:
+- "add_row + cell.text": cách cũ, mỗi dòng tbl.add_row() rồi gán text từng ô
+- "_append_rows": dựng XML w:tr/w:tc cả khối, parse 1 lần bằng lxml
+
+Chạy: python -m benchmarks.docx_tables [số lần lặp]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from docx import Document
+
+from export.word_reports import _append_rows, _safe_str, _str_column
+
+ROW_COUNTS = (31, 365, 3000)
+COLUMNS = ["Ngày/Lần", "Ctrl 1", "Ctrl 2", "Ctrl 3", "z_Ctrl 1", "z_Ctrl 2", "z_Ctrl 3",
+           "Trạng thái", "Vi phạm loại bỏ", "Người thực hiện"]
+
+
+def _sample(n_rows, seed=0):
+    rng = np.random.default_rng(seed + n_rows)
+    df = pd.DataFrame({"Ngày/Lần": np.arange(1, n_rows + 1)})
+    for lvl in (1, 2, 3):
+        df[f"Ctrl {lvl}"] = np.round(rng.normal(100 * lvl, 3, n_rows), 2)
+        df[f"z_Ctrl {lvl}"] = np.round(rng.normal(0, 1, n_rows), 3)
+    df["Trạng thái"] = np.where(rng.random(n_rows) < 0.1, "Cảnh báo", "Đạt")
+    df["Vi phạm loại bỏ"] = ""
+    df["Người thực hiện"] = "KTV"
+    return df
+
+
+def _per_row(df):
+    tbl = Document().add_table(rows=1, cols=len(COLUMNS))
+    for _, r in df.iterrows():
+        cells = tbl.add_row().cells
+        for i, c in enumerate(COLUMNS):
+            cells[i].text = _safe_str(r.get(c, ""))
+
+
+def _bulk(df):
+    tbl = Document().add_table(rows=1, cols=len(COLUMNS))
+    _append_rows(tbl, [_str_column(df, c) for c in COLUMNS])
+
+
+def _best_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times) * 1000
+
+
+def main(repeat=3):
+    print(f"{'dòng':>6} {'add_row + cell.text (ms)':>25} {'_append_rows (ms)':>18}")
+    for n_rows in ROW_COUNTS:
+        df = _sample(n_rows)
+        old = _best_ms(lambda: _per_row(df), repeat)
+        new = _best_ms(lambda: _bulk(df), repeat)
+        print(f"{n_rows:>6} {old:>25.1f} {new:>18.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
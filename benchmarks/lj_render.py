@@ -0,0 +1,60 @@
+"""
+Benchmark xuất ảnh Levey–Jennings: thời gian / hình cho 30, 365, 3000 run.
+
+So sánh:
+- "figure + savefig tight": build_lj_figure_from_z (figure mới) rồi savefig dpi=300, bbox_inches="tight"
+- "render_lj_png": canvas tái dùng, vẽ 1 lượt ở DPI đích (tắt cache đĩa)
+
+Chạy: python -m benchmarks.lj_render [số lần lặp]
+"""
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from export.word_reports import LJ_PNG_DPI, build_lj_figure_from_z, render_lj_png
+from utils.levey_jennings import build_lj_long
+from utils.westgard_rules import build_westgard_result
+
+RUN_COUNTS = (30, 365, 3000)
+ACTIVE_RULES = {"1_2s", "1_3s", "2_2s", "R_4s", "4_1s", "10x"}
+
+
+def _sample(n_runs, n_levels=3, seed=0):
+    rng = np.random.default_rng(seed + n_runs)
+    z_df = pd.DataFrame({"Ngày/Lần": np.arange(1, n_runs + 1)})
+    for lvl in range(n_levels):
+        z_df[f"z_Ctrl {lvl + 1}"] = rng.normal(0, 1.3, n_runs)
+    Z = z_df[[f"z_Ctrl {lvl + 1}" for lvl in range(n_levels)]].to_numpy()
+    result = build_westgard_result(Z, z_df["Ngày/Lần"].tolist(), ACTIVE_RULES, "<4")
+    return z_df, build_lj_long(z_df, westgard_result=result)
+
+
+def _best_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times) * 1000
+
+
+def _figure_savefig(z_df, df_long):
+    fig = build_lj_figure_from_z(z_df, df_long=df_long)
+    fig.savefig(io.BytesIO(), format="png", dpi=LJ_PNG_DPI, bbox_inches="tight", facecolor="white")
+
+
+def main(repeat=3):
+    print(f"{'runs':>6} {'vi phạm':>8} {'figure + savefig tight (ms)':>28} {'render_lj_png (ms)':>19}")
+    for n_runs in RUN_COUNTS:
+        z_df, df_long = _sample(n_runs)
+        n_viol = int((df_long["rule_codes"] != "").sum())
+        old = _best_ms(lambda: _figure_savefig(z_df, df_long), repeat)
+        new = _best_ms(lambda: render_lj_png(z_df, df_long=df_long, use_cache=False), repeat)
+        print(f"{n_runs:>6} {n_viol:>8} {old:>28.0f} {new:>19.0f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -0,0 +1,198 @@
+"""
+Xuất PNG Levey–Jennings hàng loạt (mọi xét nghiệm / mọi labo) bằng process pool.
+
+matplotlib đơn luồng và giữ GIL nên mỗi biểu đồ được vẽ trong 1 process worker
+(render_lj_png, canvas tái dùng theo process). Kết quả trả về dần theo biểu đồ
+hoàn thành; job được lấy dần từ iterable và chỉ tối đa 2 x workers job nằm trong
+pool cùng lúc (iter_pool, dùng chung với batch_reports). Biểu đồ lỗi được ghi nhận
+(ChartResult.error) mà không dừng cả lô.
+Đầu ra: thư mục (write_lj_png_dir) hoặc ZIP ghi luồng (write_lj_png_zip).
+"""
+import csv
+import io
+import itertools
+import os
+import re
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from functools import partial
+from typing import Optional
+
+import pandas as pd
+
+from export.word_reports import LJ_PNG_DPI, render_lj_png
+from utils.process_pool import process_pool
+from utils.westgard_batch import BatchProgress
+
+
+@dataclass
+class LJPngJob:
+    """1 biểu đồ cần xuất: key (vd (lab_id, tên xét nghiệm)), tên file trong thư mục / ZIP."""
+    key: object
+    filename: str
+    z_df: pd.DataFrame
+    df_long: Optional[pd.DataFrame] = None
+    title: str = "Levey–Jennings (Z-score)"
+    max_points: Optional[int] = None
+
+
+@dataclass
+class ChartResult:
+    """Kết quả 1 biểu đồ: thời gian vẽ (s), kích thước PNG, lỗi (None nếu OK)."""
+    key: object
+    filename: str
+    seconds: float
+    size: int = 0
+    error: Optional[str] = None
+    png: Optional[bytes] = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def safe_filename(name) -> str:
+    """Tên file an toàn trên mọi hệ điều hành (giữ chữ có dấu, thay ký tự cấm bằng '_')."""
+    text = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', "_", str(name)).strip(" .")
+    return text or "_"
+
+
+def _render_job(job: LJPngJob, dpi: int) -> ChartResult:
+    """Chạy trong worker: vẽ 1 biểu đồ, bắt mọi lỗi để không làm hỏng cả lô."""
+    t0 = time.perf_counter()
+    try:
+        png = render_lj_png(z_df=job.z_df, df_long=job.df_long, title=job.title,
+                            max_points=job.max_points, dpi=dpi)
+    except Exception as e:  # lỗi dữ liệu 1 xét nghiệm -> ghi nhận, chạy tiếp
+        return ChartResult(job.key, job.filename, time.perf_counter() - t0, error=f"{type(e).__name__}: {e}")
+    return ChartResult(job.key, job.filename, time.perf_counter() - t0, size=len(png), png=png)
+
+
+def iter_pool(fn, jobs, error_result, workers=None, on_progress=None, total=None):
+    """
+    Chạy fn(job) cho mọi job song song, giới hạn số job trong pool (dùng chung cho PNG / báo cáo).
+
+    jobs: iterable (có thể là generator: job được lấy dần, không dựng sẵn cả danh sách;
+    chỉ tối đa 2 x workers job nằm trong pool cùng lúc).
+    error_result(job, exc): kết quả thay thế khi worker chết / lỗi pickle.
+    workers: số process (mặc định os.cpu_count(); <=1 chạy tuần tự trong process hiện tại).
+    on_progress: callback(BatchProgress) sau mỗi job.
+    total: tổng số job cho tiến độ (mặc định len(jobs) nếu có; không biết -> số job đã lấy ra).
+    Yield kết quả theo thứ tự hoàn thành.
+    """
+    if total is None and hasattr(jobs, "__len__"):
+        total = len(jobs)
+    jobs = iter(jobs)
+    first = next(jobs, None)
+    if first is None:
+        return
+    jobs = itertools.chain([first], jobs)
+    workers = (os.cpu_count() or 1) if workers is None else int(workers)
+    if total is not None:
+        workers = min(workers, total)
+
+    t0 = time.perf_counter()
+    done = taken = 0
+
+    def progress():
+        if on_progress:
+            on_progress(BatchProgress(done, total if total is not None else taken, time.perf_counter() - t0))
+
+    if workers <= 1:
+        for job in jobs:
+            taken += 1
+            yield fn(job)
+            done += 1
+            progress()
+        return
+
+    with process_pool(workers) as pool:
+        pending = {}  # future -> job; tối đa 2 x workers job đang chờ / chạy
+
+        def fill():
+            nonlocal taken
+            for job in itertools.islice(jobs, 2 * workers - len(pending)):
+                pending[pool.submit(fn, job)] = job
+                taken += 1
+
+        fill()
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                job = pending.pop(fut)  # không giữ future (và bytes kết quả) sau khi đã trả về
+                try:
+                    res = fut.result()
+                except Exception as e:  # worker chết / lỗi pickle: vẫn báo theo từng job
+                    res = error_result(job, e)
+                yield res
+                done += 1
+                progress()
+            fill()
+
+
+def _chart_error(job: LJPngJob, e: Exception) -> ChartResult:
+    return ChartResult(job.key, job.filename, 0.0, error=f"{type(e).__name__}: {e}")
+
+
+def iter_lj_png_pool(jobs, workers=None, dpi=LJ_PNG_DPI, on_progress=None, total=None):
+    """
+    Vẽ PNG cho mọi job song song.
+
+    jobs: iterable LJPngJob (có thể là generator: z_df / df_long chỉ được dựng khi job
+    sắp được gửi vào pool).
+    workers: số process (mặc định os.cpu_count(); <=1 chạy tuần tự trong process hiện tại).
+    on_progress: callback(BatchProgress) sau mỗi biểu đồ.
+    total: tổng số biểu đồ cho tiến độ (mặc định len(jobs) nếu có).
+    Yield ChartResult (kèm bytes PNG) theo thứ tự hoàn thành.
+    """
+    yield from iter_pool(partial(_render_job, dpi=dpi), jobs, _chart_error,
+                         workers=workers, on_progress=on_progress, total=total)
+
+
+def _timing_csv(results) -> bytes:
+    """Bảng thời gian / lỗi từng biểu đồ (CSV UTF-8 BOM để Excel đọc đúng dấu)."""
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["file", "giây", "bytes", "lỗi"])
+    for r in results:
+        w.writerow([r.filename, f"{r.seconds:.3f}", r.size, r.error or ""])
+    return buf.getvalue().encode("utf-8-sig")
+
+
+def write_lj_png_dir(jobs, out_dir, workers=None, dpi=LJ_PNG_DPI, on_progress=None, total=None):
+    """
+    Ghi PNG vào out_dir (giữ thư mục con theo filename) + timing.csv.
+    Trả về list ChartResult (không giữ bytes PNG).
+    """
+    results = []
+    for res in iter_lj_png_pool(jobs, workers=workers, dpi=dpi, on_progress=on_progress, total=total):
+        if res.ok:
+            path = os.path.join(out_dir, res.filename)
+            os.makedirs(os.path.dirname(path) or out_dir, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(res.png)
+        res.png = None
+        results.append(res)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "timing.csv"), "wb") as f:
+        f.write(_timing_csv(results))
+    return results
+
+
+def write_lj_png_zip(jobs, fileobj, workers=None, dpi=LJ_PNG_DPI, on_progress=None, total=None):
+    """
+    Ghi PNG vào ZIP theo luồng (mỗi ảnh ghi ngay khi vẽ xong, không giữ cả lô trong RAM)
+    + timing.csv ở cuối. fileobj có thể không seek được (vd response stream).
+    PNG đã nén sẵn nên lưu ZIP_STORED. Trả về list ChartResult (không giữ bytes PNG).
+    """
+    results = []
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_STORED) as zf:
+        for res in iter_lj_png_pool(jobs, workers=workers, dpi=dpi, on_progress=on_progress, total=total):
+            if res.ok:
+                zf.writestr(res.filename, res.png)
+            res.png = None
+            results.append(res)
+        zf.writestr("timing.csv", _timing_csv(results))
+    return results
@@ -0,0 +1,113 @@
+"""
+Xuất báo cáo cuối tháng hàng loạt (mọi xét nghiệm / mọi labo) bằng process pool.
+
+Mỗi file (Sổ ghi nhận & đánh giá .docx, Sổ theo dõi KQ NK .xlsx, Phiếu CSTK .docx)
+là 1 job dựng trong process worker (dựng Word + vẽ biểu đồ LJ giữ GIL). Job được lấy
+dần từ iterable và chỉ tối đa 2 x workers job nằm trong pool cùng lúc; kết quả được
+ghi ngay vào ZIP theo thứ tự hoàn thành rồi bỏ bytes, nên không giữ cả lô trong RAM;
+file lỗi được ghi nhận (ReportResult.error) mà không dừng cả lô.
+"""
+import io
+import time
+import zipfile
+from dataclasses import dataclass, field
+from typing import Optional
+
+import pandas as pd
+
+from export.batch_lj_png import _timing_csv, iter_pool
+
+# loại báo cáo -> (tiền tố tên file, đuôi file)
+REPORT_KINDS = {
+    "so_gn_dg": ("So_ghi_nhan_danh_gia", ".docx"),
+    "xlsx": ("So_theo_doi_KQ_NK", ".xlsx"),
+    "cstk": ("Phieu_thiet_lap_CSTK", ".docx"),
+}
+
+
+@dataclass
+class ReportJob:
+    """1 file cần dựng: kind (khoá REPORT_KINDS), tham số cho hàm dựng, tên file trong ZIP."""
+    key: object
+    filename: str
+    kind: str
+    kwargs: dict = field(default_factory=dict)
+
+
+@dataclass
+class ReportResult:
+    """Kết quả 1 file: thời gian dựng (s), kích thước, lỗi (None nếu OK)."""
+    key: object
+    filename: str
+    seconds: float
+    size: int = 0
+    error: Optional[str] = None
+    data: Optional[bytes] = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def xlsx_bytes(df: pd.DataFrame, sheet_name: str = "So theo doi KQ NK") -> bytes:
+    """Bảng -> file Excel (openpyxl) dạng bytes."""
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        df.to_excel(writer, sheet_name=sheet_name, index=False)
+    return buffer.getvalue()
+
+
+def _build(kind: str, kwargs: dict) -> bytes:
+    if kind == "so_gn_dg":
+        from export.export_so_gn_dg_word import export_so_gn_dg
+        return export_so_gn_dg(**kwargs).getvalue()
+    if kind == "cstk":
+        from export.export_cstk_word import export_cstk
+        return export_cstk(**kwargs).getvalue()
+    if kind == "xlsx":
+        return xlsx_bytes(**kwargs)
+    raise ValueError(f"Unknown report kind: {kind!r}")
+
+
+def _build_job(job: ReportJob) -> ReportResult:
+    """Chạy trong worker: dựng 1 file, bắt mọi lỗi để không làm hỏng cả lô."""
+    t0 = time.perf_counter()
+    try:
+        data = _build(job.kind, job.kwargs)
+    except Exception as e:  # lỗi dữ liệu 1 xét nghiệm -> ghi nhận, chạy tiếp
+        return ReportResult(job.key, job.filename, time.perf_counter() - t0, error=f"{type(e).__name__}: {e}")
+    return ReportResult(job.key, job.filename, time.perf_counter() - t0, size=len(data), data=data)
+
+
+def _report_error(job: ReportJob, e: Exception) -> ReportResult:
+    return ReportResult(job.key, job.filename, 0.0, error=f"{type(e).__name__}: {e}")
+
+
+def iter_report_pool(jobs, workers=None, on_progress=None, total=None):
+    """
+    Dựng mọi file song song.
+
+    jobs: iterable ReportJob (có thể là generator: job được lấy dần, không dựng sẵn cả danh sách).
+    workers: số process (mặc định os.cpu_count(); <=1 chạy tuần tự trong process hiện tại).
+    on_progress: callback(BatchProgress) sau mỗi file.
+    total: tổng số file cho tiến độ (mặc định len(jobs) nếu có; không biết -> số job đã lấy ra).
+    Yield ReportResult (kèm bytes) theo thứ tự hoàn thành.
+    """
+    yield from iter_pool(_build_job, jobs, _report_error, workers=workers, on_progress=on_progress, total=total)
+
+
+def write_report_zip(jobs, fileobj, workers=None, on_progress=None, total=None):
+    """
+    Ghi các file vào ZIP theo luồng (mỗi file ghi ngay khi dựng xong) + timing.csv ở cuối.
+    fileobj có thể không seek được. docx/xlsx vốn đã là ZIP nén nên lưu ZIP_STORED.
+    Trả về list ReportResult (không giữ bytes).
+    """
+    results = []
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_STORED) as zf:
+        for res in iter_report_pool(jobs, workers=workers, on_progress=on_progress, total=total):
+            if res.ok:
+                zf.writestr(res.filename, res.data)
+            res.data = None
+            results.append(res)
+        zf.writestr("timing.csv", _timing_csv(results))
+    return results
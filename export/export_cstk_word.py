@@ -5,7 +5,14 @@ from io import BytesIO
 import pandas as pd
 from .word_reports import ReportMeta, build_cstk_3muc_docx, build_cstk_2muc_docx
 
-def export_cstk(meta: ReportMeta, stats_df: pd.DataFrame, raw_df=None, num_levels: int = 3) -> BytesIO:
+def export_cstk(meta: ReportMeta, stats_df: pd.DataFrame, raw_df=None, num_levels: int = 3,
+                exclusions=None, method_label: str = "", use_template=None) -> BytesIO:
+    """
+    exclusions (tuỳ chọn): bảng điểm bị loại khi thiết lập (chế độ ước lượng bền vững).
+    use_template: 3 mức dựng từ templates/*.docx (None -> theo IQC_DOCX_TEMPLATE_MODE, mặc định bật); 2 mức luôn dựng tay.
+    """
     if int(num_levels) == 2:
-        return build_cstk_2muc_docx(meta=meta, raw_df=raw_df, stats_df=stats_df)
-    return build_cstk_3muc_docx(meta=meta, raw_df=raw_df, stats_df=stats_df)
+        return build_cstk_2muc_docx(meta=meta, raw_df=raw_df, stats_df=stats_df,
+                                    exclusions=exclusions, method_label=method_label)
+    return build_cstk_3muc_docx(meta=meta, raw_df=raw_df, stats_df=stats_df,
+                                exclusions=exclusions, method_label=method_label, use_template=use_template)
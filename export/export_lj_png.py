@@ -4,11 +4,10 @@ Export biểu đồ Levey–Jennings thành PNG (bytes).
 """
 from io import BytesIO
 import pandas as pd
-from .word_reports import build_lj_figure_from_z
+from .word_reports import render_lj_png
 
-def export_lj_png(z_df: pd.DataFrame, point_df=None) -> BytesIO:
-    fig = build_lj_figure_from_z(z_df=z_df, point_df=point_df)
-    buf = BytesIO()
-    fig.savefig(buf, format="png", dpi=300, bbox_inches="tight", facecolor="white")
-    buf.seek(0)
-    return buf
+def export_lj_png(z_df: pd.DataFrame, point_df=None, westgard_result=None, df_long=None,
+                  max_points=None) -> BytesIO:
+    """max_points (tuỳ chọn): ngân sách điểm khi rút gọn chuỗi dài (giữ mọi điểm vi phạm / |z| > 3)."""
+    return BytesIO(render_lj_png(z_df=z_df, point_df=point_df, westgard_result=westgard_result, df_long=df_long,
+                                 max_points=max_points))
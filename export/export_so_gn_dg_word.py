@@ -5,7 +5,16 @@ from io import BytesIO
 import pandas as pd
 from .word_reports import ReportMeta, build_so_ghi_nhan_3muc_docx, build_so_ghi_nhan_2muc_docx
 
-def export_so_gn_dg(meta: ReportMeta, export_df: pd.DataFrame, z_df: pd.DataFrame, point_df=None, num_levels: int = 3) -> BytesIO:
+def export_so_gn_dg(meta: ReportMeta, export_df: pd.DataFrame, z_df: pd.DataFrame, point_df=None, num_levels: int = 3,
+                    westgard_result=None, df_long=None, use_template=None, on_progress=None) -> BytesIO:
+    """
+    use_template: 3 mức dựng từ templates/*.docx (None -> theo IQC_DOCX_TEMPLATE_MODE, mặc định bật); 2 mức luôn dựng tay.
+    on_progress: callback(tỉ lệ, thông báo) tại các mốc ghi bảng / vẽ biểu đồ / lưu tài liệu (job nền).
+    """
     if int(num_levels) == 2:
-        return build_so_ghi_nhan_2muc_docx(export_df=export_df, z_df=z_df, meta=meta, point_df=point_df)
-    return build_so_ghi_nhan_3muc_docx(export_df=export_df, z_df=z_df, meta=meta, point_df=point_df)
+        return build_so_ghi_nhan_2muc_docx(export_df=export_df, z_df=z_df, meta=meta, point_df=point_df,
+                                           westgard_result=westgard_result, df_long=df_long,
+                                           on_progress=on_progress)
+    return build_so_ghi_nhan_3muc_docx(export_df=export_df, z_df=z_df, meta=meta, point_df=point_df,
+                                       westgard_result=westgard_result, df_long=df_long,
+                                       use_template=use_template, on_progress=on_progress)
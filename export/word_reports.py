@@ -1,19 +1,40 @@
 
+import copy
+import functools
 import io
+import os
+import re
+import tempfile
+import threading
+from bisect import bisect_right
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from xml.sax.saxutils import escape as xml_escape
+from typing import Optional
 
 import numpy as np
 import pandas as pd
 
 from docx import Document
+from docx.oxml import parse_xml
+from docx.oxml.ns import nsdecls, qn
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from docx.shared import Emu
 from docx.shared import Cm, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.table import WD_TABLE_ALIGNMENT
 
-import matplotlib.pyplot as plt
+import matplotlib
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PathCollection
+from matplotlib.figure import Figure
+from matplotlib.font_manager import FontProperties
+from matplotlib.path import Path
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D
 
 from export.docx_layout import apply_header_footer
+from utils.cache import DiskCache, fingerprint
+from utils.levey_jennings import build_lj_long, downsample_lj_long, reduction_note
 
 
 @dataclass
@@ -35,15 +56,132 @@ def _safe_str(x) -> str:
     return str(x)
 
 
-def build_lj_figure_from_z(z_df: pd.DataFrame,
-                           point_df: Optional[pd.DataFrame] = None,
-                           title: str = "Levey–Jennings (Z-score)") -> plt.Figure:
+_CELL_SPECIAL = re.compile(r"([\t\r\n])")
+
+
+def _run_content_xml(text: str) -> str:
+    """Nội dung w:r giống python-docx (run.text = ...): tab -> w:tab, xuống dòng -> w:br."""
+    if not _CELL_SPECIAL.search(text):
+        if not text:
+            return ""
+        space = ' xml:space="preserve"' if len(text.strip()) < len(text) else ""
+        return f"<w:t{space}>{xml_escape(text)}</w:t>"
+    out = []
+    for part in _CELL_SPECIAL.split(text):
+        if part == "\t":
+            out.append("<w:tab/>")
+        elif part in ("\r", "\n"):
+            out.append("<w:br/>")
+        elif part:
+            out.append(_run_content_xml(part))
+    return "".join(out)
+
+
+def _append_rows(table, columns) -> None:
     """
-    Vẽ Levey–Jennings kiểu giống chart trong app:
-    - 3 mức QC là 3 đường
-    - đường ngang 0, ±1, ±2, ±3
-    - khoanh đỏ các điểm có rule_codes (vi phạm/cảnh báo)
+    Thêm hàng loạt dòng vào bảng python-docx từ danh sách cột (mỗi cột 1 list chuỗi):
+    dựng chuỗi XML w:tr/w:tc cho cả khối rồi parse 1 lần bằng lxml, thay cho
+    add_row() + cell.text từng ô. Cấu trúc XML giống hệt cách cũ (tcW theo tblGrid,
+    1 đoạn / 1 run mỗi ô).
     """
+    n_rows = len(columns[0]) if columns else 0
+    if not n_rows:
+        return
+    tbl = table._tbl
+    heads = []
+    for gc in tbl.tblGrid.gridCol_lst:
+        tc_pr = "" if gc.w is None else f'<w:tcPr><w:tcW w:type="dxa" w:w="{Emu(gc.w).twips}"/></w:tcPr>'
+        heads.append(f"<w:tc>{tc_pr}<w:p><w:r>")
+    rows = [
+        "<w:tr>"
+        + "".join(f"{heads[c]}{_run_content_xml(col[i])}</w:r></w:p></w:tc>" for c, col in enumerate(columns))
+        + "</w:tr>"
+        for i in range(n_rows)
+    ]
+    frag = parse_xml(f"<w:tbl {nsdecls('w')}>{''.join(rows)}</w:tbl>")
+    for tr in list(frag):
+        tbl.append(tr)
+
+
+def _str_column(df: pd.DataFrame, col: str) -> list:
+    """Cột -> list chuỗi theo _safe_str (cột thiếu -> chuỗi rỗng)."""
+    if col not in df.columns:
+        return [""] * len(df)
+    return [_safe_str(v) for v in df[col].tolist()]
+
+
+# Khổ hình LJ (~ 3/4 A4 khi chèn vào Word) và DPI ảnh xuất
+LJ_FIGSIZE = (8.2, 4.6)
+LJ_PNG_DPI = 300
+
+_TEXT_PATHS = {}
+_LJ_CANVAS = threading.local()
+
+# Cache PNG trên đĩa theo nội dung; IQC_CHART_CACHE_MB=0 để tắt.
+# Tăng LJ_RENDER_VERSION khi đổi cách vẽ để bỏ ảnh cũ.
+LJ_RENDER_VERSION = "1"
+CHART_CACHE_DIR = os.environ.get("IQC_CHART_CACHE_DIR", os.path.join(tempfile.gettempdir(), "iqc_chart_cache"))
+CHART_CACHE_MB = float(os.environ.get("IQC_CHART_CACHE_MB", "256"))
+chart_png_cache = DiskCache(CHART_CACHE_DIR, int(CHART_CACHE_MB * 1024 * 1024), suffix=".png")
+
+# Nhóm rcParams ảnh hưởng tới ảnh LJ (bỏ backend, keymap, ... — đọc "backend" sẽ import pyplot)
+LJ_STYLE_RC_GROUPS = frozenset({
+    "font", "text", "mathtext", "lines", "markers", "patch", "path", "agg",
+    "axes", "xtick", "ytick", "grid", "legend", "figure", "savefig",
+})
+
+
+@functools.lru_cache(maxsize=None)
+def _lj_style_digest() -> str:
+    """Dấu vân tay style matplotlib cho khoá cache PNG (tính 1 lần / process)."""
+    return fingerprint(
+        sorted(
+            (k, str(v)) for k, v in dict.items(matplotlib.rcParams)
+            if k.split(".", 1)[0] in LJ_STYLE_RC_GROUPS
+        ),
+        matplotlib.__version__,
+    )
+
+
+def _text_path(label: str, fontsize: float) -> Path:
+    """Đường viền chữ (đơn vị point), căn giữa theo x, đáy tại y=0; cache theo (nhãn, cỡ chữ)."""
+    key = (label, fontsize)
+    path = _TEXT_PATHS.get(key)
+    if path is None:
+        tp = TextPath((0, 0), label, size=fontsize, prop=FontProperties())
+        ext = tp.get_extents()
+        path = Path(tp.vertices - [(ext.x0 + ext.x1) / 2, ext.y0], tp.codes)
+        _TEXT_PATHS[key] = path
+    return path
+
+
+def _add_label_collection(ax, xs, ys, labels, fontsize=8, color="red"):
+    """Mọi nhãn mã quy tắc trong 1 PathCollection (thay vì 1 ax.text / điểm)."""
+    keep = [i for i, s in enumerate(labels) if s]
+    if not keep:
+        return
+    fig = ax.figure
+    coll = PathCollection(
+        [_text_path(labels[i], fontsize) for i in keep],
+        offsets=np.column_stack([np.asarray(xs)[keep], np.asarray(ys)[keep]]),
+        offset_transform=ax.transData,
+        transform=Affine2D().scale(1 / 72) + fig.dpi_scale_trans,
+        facecolors=color,
+        edgecolors="none",
+        zorder=6,
+    )
+    coll.set_clip_on(False)  # như ax.text: nhãn trên đường ±3SD không bị cắt
+    ax.add_collection(coll, autolim=False)
+
+
+def _draw_lj(fig: Figure,
+             z_df: pd.DataFrame,
+             point_df: Optional[pd.DataFrame],
+             title: str,
+             westgard_result,
+             df_long: Optional[pd.DataFrame],
+             max_points: Optional[int]) -> None:
+    """Vẽ biểu đồ LJ lên fig (đã xoá sạch trước đó)."""
     if z_df is None or z_df.empty:
         raise ValueError("z_df is empty")
 
@@ -54,40 +192,31 @@ def build_lj_figure_from_z(z_df: pd.DataFrame,
     Z = z_df[z_cols].to_numpy(dtype=float)
     n_runs, n_levels = Z.shape
 
-    # build long for violations
-    viol = set()
-    short_map = {}
-    if point_df is not None and not point_df.empty:
-        for _, r in point_df.iterrows():
-            run = str(r.get("Ngày/Lần", ""))
-            ctrl = str(r.get("Control", ""))
-            codes = _safe_str(r.get("rule_codes", "")).strip()
-            if codes:
-                viol.add((run, ctrl))
-                # short already computed in app chart (rule_short)
-                s = _safe_str(r.get("rule_short", "")).strip()
-                if s:
-                    short_map[(run, ctrl)] = s
-
-    fig = plt.figure(figsize=(8.2, 4.6), dpi=200)  # ~ 3/4 A4 when inserted
+    if df_long is None:
+        df_long = build_lj_long(z_df, westgard_result=westgard_result, point_df=point_df)
+    shown, total = downsample_lj_long(df_long, max_points)
+    title = f"{title}{reduction_note(len(shown), total)}"
+    viol = df_long[df_long["rule_codes"].astype(str).str.strip() != ""]
+    viol_x = viol.index.to_numpy()
+    viol_y = np.clip(viol["z_score"].to_numpy(dtype=float), -3, 3)
+
     ax = fig.add_subplot(111)
 
     x = np.arange(n_runs)
-    for lvl in range(n_levels):
-        y = Z[:, lvl]
-        ax.plot(x, np.clip(y, -3, 3), marker="o", linewidth=1.6, label=f"Ctrl {lvl+1}")
-
-        # red rings for viol points
-        for i in range(n_runs):
-            run = runs[i]
-            key = (run, f"Ctrl {lvl+1}")
-            if key in viol:
-                ax.scatter([x[i]], [np.clip(y[i], -3, 3)], s=120,
-                           facecolors="none", edgecolors="red", linewidths=2.2, zorder=5)
-                s = short_map.get(key, "")
-                if s:
-                    ax.text(x[i], np.clip(y[i], -3, 3)+0.15, s, color="red",
-                            fontsize=8, ha="center", va="bottom")
+    if len(shown) < total:
+        for lvl in range(n_levels):
+            part = shown[shown["Control"] == f"Ctrl {lvl+1}"]
+            ax.plot(part.index.to_numpy(), np.clip(part["z_score"].to_numpy(dtype=float), -3, 3),
+                    marker="o", markersize=3, linewidth=1.0, label=f"Ctrl {lvl+1}")
+    else:
+        for lvl in range(n_levels):
+            y = Z[:, lvl]
+            ax.plot(x, np.clip(y, -3, 3), marker="o", linewidth=1.6, label=f"Ctrl {lvl+1}")
+
+    # red rings + rule labels for viol points (1 collection each)
+    if len(viol):
+        ax.scatter(viol_x, viol_y, s=120, facecolors="none", edgecolors="red", linewidths=2.2, zorder=5)
+        _add_label_collection(ax, viol_x, viol_y + 0.15, viol["rule_short"].tolist())
 
     # Horizontal rules
     for y, lw, ls in [(0, 1.2, "-"),
@@ -99,7 +228,6 @@ def build_lj_figure_from_z(z_df: pd.DataFrame,
     ax.set_title(title, fontsize=11)
     ax.set_ylabel("Z-score")
     ax.set_xlabel("Ngày / Lần")
-    ax.set_xticks(x)
     # show fewer ticks if long
     if n_runs > 20:
         step = max(1, n_runs // 10)
@@ -107,40 +235,335 @@ def build_lj_figure_from_z(z_df: pd.DataFrame,
         ax.set_xticks(show)
         ax.set_xticklabels([runs[i] for i in show], rotation=0, fontsize=8)
     else:
+        ax.set_xticks(x)
         ax.set_xticklabels(runs, rotation=0, fontsize=8)
 
     ax.set_ylim(-3.2, 3.2)
     ax.grid(True, alpha=0.25)
     ax.legend(loc="upper right", fontsize=8, frameon=True)
     fig.tight_layout()
+
+
+def build_lj_figure_from_z(z_df: pd.DataFrame,
+                           point_df: Optional[pd.DataFrame] = None,
+                           title: str = "Levey–Jennings (Z-score)",
+                           westgard_result=None,
+                           df_long: Optional[pd.DataFrame] = None,
+                           max_points: Optional[int] = None) -> Figure:
+    """
+    Vẽ Levey–Jennings kiểu giống chart trong app:
+    - 3 mức QC là 3 đường
+    - đường ngang 0, ±1, ±2, ±3
+    - khoanh đỏ các điểm có rule_codes (vi phạm/cảnh báo)
+    Điểm vi phạm + mã quy tắc lấy từ bảng dạng dài (build_lj_long) — truyền sẵn df_long
+    (như chart trong app) hoặc để dựng từ westgard_result / point_df.
+    max_points: rút gọn chuỗi dài bằng downsample_lj_long (giữ điểm vi phạm / |z| > 3),
+    tiêu đề ghi tỉ lệ rút gọn.
+    Để xuất PNG dùng render_lj_png (tái dùng canvas, vẽ 1 lần ở DPI đích).
+    """
+    fig = Figure(figsize=LJ_FIGSIZE, dpi=200)
+    FigureCanvasAgg(fig)
+    _draw_lj(fig, z_df, point_df, title, westgard_result, df_long, max_points)
     return fig
 
 
-def _replace_placeholders_in_doc(doc: Document, mapping: dict):
-    # paragraphs
+def render_lj_png(z_df: pd.DataFrame,
+                  point_df: Optional[pd.DataFrame] = None,
+                  title: str = "Levey–Jennings (Z-score)",
+                  westgard_result=None,
+                  df_long: Optional[pd.DataFrame] = None,
+                  max_points: Optional[int] = None,
+                  dpi: int = LJ_PNG_DPI,
+                  use_cache: bool = True) -> bytes:
+    """
+    PNG của biểu đồ LJ: Figure + canvas Agg tái dùng theo luồng, dựng thẳng ở DPI đích
+    và ghi 1 lượt (không bbox_inches="tight" nên không vẽ 2 lần).
+    Ảnh được cache trên đĩa (chart_png_cache) theo z, cờ điểm, tiêu đề, khổ, DPI và
+    style matplotlib; xuất lại dữ liệu không đổi dùng luôn bytes PNG.
+    """
+    if z_df is None or z_df.empty:
+        raise ValueError("z_df is empty")
+    if df_long is None:
+        df_long = build_lj_long(z_df, westgard_result=westgard_result, point_df=point_df)
+    if not use_cache or chart_png_cache.max_bytes <= 0:
+        return _render_lj_png(z_df, df_long, title, max_points, dpi)
+    key = fingerprint(
+        pd.util.hash_pandas_object(z_df, index=False).to_numpy(),
+        list(z_df.columns),
+        pd.util.hash_pandas_object(df_long, index=True).to_numpy(),
+        title,
+        max_points,
+        LJ_FIGSIZE,
+        int(dpi),
+        _lj_style_digest(),
+        LJ_RENDER_VERSION,
+    )
+    return chart_png_cache.get_or_compute(key, lambda: _render_lj_png(z_df, df_long, title, max_points, dpi))
+
+
+def _render_lj_png(z_df, df_long, title, max_points, dpi) -> bytes:
+    fig = getattr(_LJ_CANVAS, "fig", None)
+    if fig is None:
+        fig = Figure(figsize=LJ_FIGSIZE, dpi=dpi)
+        FigureCanvasAgg(fig)
+        _LJ_CANVAS.fig = fig
+    fig.set_dpi(dpi)
+    try:
+        _draw_lj(fig, z_df, None, title, None, df_long, max_points)
+        # tight_layout đã đặt vị trí xong; bỏ layout engine để savefig không vẽ nháp thêm 1 lượt
+        fig.set_layout_engine(None)
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png", dpi=dpi, facecolor="white")
+        return buf.getvalue()
+    finally:
+        fig.clear()
+
+
+PLACEHOLDER_RE = re.compile(r"\{\{[A-Za-z0-9_]+\}\}")
+_W_P = qn("w:p")
+_W_T = qn("w:t")
+_XML_SPACE = qn("xml:space")
+
+
+def _set_t_text(t, text: str) -> None:
+    t.text = text
+    if len(text.strip()) < len(text):
+        t.set(_XML_SPACE, "preserve")
+
+
+def _substitute_paragraph(p, mapping: dict) -> int:
+    """
+    Thay mọi {{KEY}} có trong mapping trong 1 đoạn w:p. Ghép nội dung các w:t thành 1 chuỗi,
+    tìm token bằng 1 regex; token nằm gọn trong 1 w:t thì sửa tại chỗ, token bị Word tách
+    qua nhiều run thì dồn giá trị vào w:t đầu và cắt phần token ở các w:t sau
+    (định dạng các run khác giữ nguyên). Trả về số token đã thay.
+    """
+    nodes = list(p.iter(_W_T))
+    if not nodes:
+        return 0
+    texts = [t.text or "" for t in nodes]
+    full = "".join(texts)
+    if "{{" not in full:
+        return 0
+    matches = [m for m in PLACEHOLDER_RE.finditer(full) if m.group(0) in mapping]
+    if not matches:
+        return 0
+
+    starts = []
+    pos = 0
+    for text in texts:
+        starts.append(pos)
+        pos += len(text)
+
+    # từ phải sang trái để offset các token phía trước không đổi
+    for m in reversed(matches):
+        s, e = m.span()
+        value = str(mapping[m.group(0)])
+        i = bisect_right(starts, s) - 1
+        while i < len(nodes) - 1 and starts[i] + len(texts[i]) <= s:
+            i += 1
+        j = bisect_right(starts, e - 1) - 1
+        if i == j:
+            off = starts[i]
+            texts[i] = texts[i][:s - off] + value + texts[i][e - off:]
+            _set_t_text(nodes[i], texts[i])
+            continue
+        texts[i] = texts[i][:s - starts[i]] + value
+        _set_t_text(nodes[i], texts[i])
+        for k in range(i + 1, j):
+            texts[k] = ""
+            _set_t_text(nodes[k], "")
+        texts[j] = texts[j][e - starts[j]:]
+        _set_t_text(nodes[j], texts[j])
+    return len(matches)
+
+
+def _replace_placeholders_in_doc(doc: Document, mapping: dict) -> int:
+    """
+    Thay placeholder {{KEY}} trong thân văn bản (cả ô bảng) và header/footer trong 1 lượt
+    duyệt XML: chi phí O(kích thước tài liệu), không phụ thuộc số khoá trong mapping.
+    Token Word tách qua nhiều run vẫn được thay; khoá không có trong mapping giữ nguyên.
+    Trả về số token đã thay.
+    """
+    mapping = {k: ("" if v is None else v) for k, v in mapping.items()}
+    roots = [doc.element.body]
+    for rel in doc.part.rels.values():
+        if rel.reltype in (RT.HEADER, RT.FOOTER) and not rel.is_external:
+            roots.append(rel.target_part.element)
+    return sum(_substitute_paragraph(p, mapping) for root in roots for p in root.iter(_W_P))
+
+
+# Báo cáo 3 mức dựng từ template .docx trong templates/ (IQC_DOCX_TEMPLATE_MODE=0 -> dựng tay như 2 mức)
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+DOCX_TEMPLATES = {
+    "so_ghi_nhan_3muc": "Template_So_ghi_nhan_danh_gia_3_muc_chi_tiet.docx",
+    "cstk_3muc": "Template_CSTK_3_muc_gop_level.docx",
+}
+DOCX_TEMPLATE_MODE = os.environ.get("IQC_DOCX_TEMPLATE_MODE", "1") == "1"
+
+_TEMPLATE_DOCS = {}
+_TEMPLATE_LOCK = threading.Lock()
+
+
+def template_document(name: str) -> Document:
+    """
+    Bản sao của template đã parse: file .docx chỉ được đọc + parse 1 lần / process,
+    mỗi báo cáo nhận 1 bản deepcopy (package, style, header/footer) để điền.
+    """
+    with _TEMPLATE_LOCK:
+        doc = _TEMPLATE_DOCS.get(name)
+        if doc is None:
+            doc = Document(os.path.join(TEMPLATE_DIR, DOCX_TEMPLATES[name]))
+            _TEMPLATE_DOCS[name] = doc
+        return copy.deepcopy(doc)
+
+
+def _find_paragraph(doc: Document, text: str):
+    """Đoạn đầu tiên trong thân văn bản có nội dung chứa text (None nếu không có)."""
     for p in doc.paragraphs:
-        for k, v in mapping.items():
-            if k in p.text:
-                for run in p.runs:
-                    if k in run.text:
-                        run.text = run.text.replace(k, v)
-    # tables
-    for t in doc.tables:
-        for row in t.rows:
-            for cell in row.cells:
-                for k, v in mapping.items():
-                    if k in cell.text:
-                        cell.text = cell.text.replace(k, v)
+        if text in p.text:
+            return p
+    return None
+
+
+def _move_new_blocks_before(doc: Document, n_before: int, anchor) -> None:
+    """Chuyển các phần tử thân văn bản thêm sau mốc n_before (add_paragraph/add_table) lên trước anchor."""
+    body = doc.element.body
+    blocks = [el for el in body.iterchildren() if not el.tag.endswith("}sectPr")]
+    for el in blocks[n_before:]:
+        anchor.addprevious(el)
+
+
+def _body_block_count(doc: Document) -> int:
+    return sum(1 for el in doc.element.body.iterchildren() if not el.tag.endswith("}sectPr"))
+
+
+def _replace_table_rows(table, columns) -> None:
+    """Bỏ các dòng dữ liệu mẫu (giữ dòng tiêu đề) rồi ghi hàng loạt các cột."""
+    for row in list(table.rows)[1:]:
+        table._tbl.remove(row._tr)
+    _append_rows(table, columns)
+
+
+def _checkpoint(on_progress, progress, message) -> None:
+    """Báo tiến độ dựng Word (job nền: on_progress ném JobCancelled nếu người dùng đã huỷ)."""
+    if on_progress is not None:
+        on_progress(progress, message)
+
+
+def _build_so_ghi_nhan_3muc_from_template(export_df, z_df, point_df, meta, westgard_result, df_long,
+                                          on_progress=None) -> io.BytesIO:
+    """Sổ ghi nhận 3 mức từ Template_So_ghi_nhan_danh_gia_3_muc_chi_tiet.docx (cùng nội dung với bản dựng tay)."""
+    doc = template_document("so_ghi_nhan_3muc")
+    apply_header_footer(
+        doc,
+        header_left=meta.don_vi,
+        header_center="SỔ GHI NHẬN & ĐÁNH GIÁ KẾT QUẢ NỘI KIỂM",
+        header_right="",
+        version_text=meta.phien_ban,
+        effective_date_text=meta.ngay_hieu_luc,
+    )
+    # điền placeholder trước khi thêm dòng dữ liệu để không phải quét cả bảng dài
+    _replace_placeholders_in_doc(doc, {
+        "{{TEN_XET_NGHIEM}}": _safe_str(meta.ten_xet_nghiem),
+        "{{THIET_BI_PHUONG_PHAP}}": _safe_str(meta.thiet_bi_phuong_phap),
+        "{{LO_QC_HAN_DUNG}}": _safe_str(meta.lo_qc_han_dung),
+        "{{THANG_NAM}}": _safe_str(meta.thang_nam),
+    })
+
+    _replace_table_rows(doc.tables[1], [_str_column(export_df, c) for c in
+                                        ["Ngày/Lần", "Ctrl 1", "Ctrl 2", "Ctrl 3", "z_Ctrl 1", "z_Ctrl 2",
+                                         "z_Ctrl 3", "Trạng thái", "Vi phạm loại bỏ", "Người thực hiện",
+                                         "Ghi chú"]])
+    _checkpoint(on_progress, 0.3, "Đã ghi bảng")
+
+    # biểu đồ LJ: chèn trước mục nhận xét chung
+    anchor = _find_paragraph(doc, "NHẬN XÉT – ĐÁNH GIÁ CHUNG")
+    n_before = _body_block_count(doc)
+    p = doc.add_paragraph("BIỂU ĐỒ LEVEY–JENNINGS (Z-SCORE)")
+    p.runs[0].bold = True
+    img_buf = io.BytesIO(render_lj_png(z_df=z_df, point_df=point_df,
+                                       title=f"{meta.ten_xet_nghiem} – Levey–Jennings (Z-score)",
+                                       westgard_result=westgard_result, df_long=df_long))
+    _checkpoint(on_progress, 0.8, "Đã vẽ biểu đồ")
+    doc.add_picture(img_buf, width=Cm(12.5))
+    doc.add_paragraph("")
+    if anchor is not None:
+        _move_new_blocks_before(doc, n_before, anchor._p)
+
+    out = io.BytesIO()
+    doc.save(out)
+    out.seek(0)
+    _checkpoint(on_progress, 1.0, "Đã lưu tài liệu")
+    return out
+
+
+def _build_cstk_3muc_from_template(meta, raw_df, stats_df, exclusions, method_label) -> io.BytesIO:
+    """Phiếu CSTK 3 mức từ Template_CSTK_3_muc_gop_level.docx."""
+    doc = template_document("cstk_3muc")
+    apply_header_footer(
+        doc,
+        header_left=meta.don_vi,
+        header_center="PHIẾU THIẾT LẬP CHỈ SỐ THỐNG KÊ (CSTK)",
+        header_right="",
+        version_text=meta.phien_ban,
+        effective_date_text=meta.ngay_hieu_luc,
+    )
+    get_val = _cstk_value_getter(stats_df)
+    nguon = getattr(meta, "nguon_cstk", "{{NGUON_CSTK}}")
+    mapping = {
+        "{{TEN_XET_NGHIEM}}": _safe_str(meta.ten_xet_nghiem),
+        "{{THIET_BI_PHUONG_PHAP}}": _safe_str(meta.thiet_bi_phuong_phap),
+        "{{LO_QC_HAN_DUNG}}": _safe_str(meta.lo_qc_han_dung),
+        "{{NGAY_THIET_LAP}}": getattr(meta, "ngay_thiet_lap", "{{NGAY_THIET_LAP}}"),
+    }
+    for lvl in (1, 2, 3):
+        ctrl = f"L{lvl}"
+        mean = get_val(ctrl, ["Mean_X", "Mean", "mean"])
+        sd = get_val(ctrl, ["SD_use", "SD", "sd"])
+        cv = get_val(ctrl, ["CV%_use", "CV%", "CV", "cv"])
+        mapping.update({
+            f"{{{{N_L{lvl}}}}}": get_val(ctrl, ["n", "N"]),
+            f"{{{{MEAN_L{lvl}}}}}": mean, f"{{{{SD_L{lvl}}}}}": sd, f"{{{{CV_L{lvl}}}}}": cv,
+            f"{{{{MEAN_Level_{lvl}}}}}": mean, f"{{{{SD_Level_{lvl}}}}}": sd, f"{{{{CV_Level_{lvl}}}}}": cv,
+            f"{{{{NGUON_Level_{lvl}}}}}": nguon,
+        })
+    _replace_placeholders_in_doc(doc, mapping)
+
+    if raw_df is not None and not raw_df.empty:
+        _replace_table_rows(doc.tables[1], _cstk_raw_columns(raw_df))
+
+    if exclusions is not None:
+        anchor = _find_paragraph(doc, "Nhận xét:")
+        n_before = _body_block_count(doc)
+        _add_exclusions_section(doc, exclusions, method_label)
+        doc.add_paragraph("")
+        if anchor is not None:
+            _move_new_blocks_before(doc, n_before, anchor._p)
+
+    out = io.BytesIO()
+    doc.save(out)
+    out.seek(0)
+    return out
 
 
 def build_so_ghi_nhan_3muc_docx(export_df: pd.DataFrame,
                                z_df: pd.DataFrame,
                                point_df: Optional[pd.DataFrame],
-                               meta: ReportMeta) -> io.BytesIO:
+                               meta: ReportMeta,
+                               westgard_result=None,
+                               df_long: Optional[pd.DataFrame] = None,
+                               use_template: Optional[bool] = None,
+                               on_progress=None) -> io.BytesIO:
     """
     Tạo Word A4 cho 'Sổ ghi nhận & đánh giá 3 mức' + chèn biểu đồ L-J (ảnh).
     export_df: đã merge summary_df (có Trạng thái, Vi phạm loại bỏ, Người thực hiện)
+    use_template: dựng từ templates/ (None -> theo DOCX_TEMPLATE_MODE, mặc định bật).
+    on_progress: callback(tỉ lệ, thông báo) sau khi ghi bảng, vẽ biểu đồ, lưu tài liệu.
     """
+    if DOCX_TEMPLATE_MODE if use_template is None else use_template:
+        return _build_so_ghi_nhan_3muc_from_template(export_df, z_df, point_df, meta, westgard_result, df_long,
+                                                     on_progress=on_progress)
     # Create doc
     doc = Document()
 
@@ -189,29 +612,19 @@ def build_so_ghi_nhan_3muc_docx(export_df: pd.DataFrame,
     for i,h in enumerate(headers):
         tbl.cell(0,i).text = h
 
-    for _, r in df.iterrows():
-        cells = tbl.add_row().cells
-        cells[0].text = _safe_str(r.get("Ngày/Lần",""))
-        cells[1].text = _safe_str(r.get("Ctrl 1",""))
-        cells[2].text = _safe_str(r.get("Ctrl 2",""))
-        cells[3].text = _safe_str(r.get("Ctrl 3",""))
-        cells[4].text = _safe_str(r.get("z_Ctrl 1",""))
-        cells[5].text = _safe_str(r.get("z_Ctrl 2",""))
-        cells[6].text = _safe_str(r.get("z_Ctrl 3",""))
-        cells[7].text = _safe_str(r.get("Trạng thái",""))
-        cells[8].text = _safe_str(r.get("Vi phạm loại bỏ",""))
-        cells[9].text = _safe_str(r.get("Người thực hiện",""))
+    _append_rows(tbl, [_str_column(df, c) for c in
+                       ["Ngày/Lần", "Ctrl 1", "Ctrl 2", "Ctrl 3", "z_Ctrl 1", "z_Ctrl 2", "z_Ctrl 3",
+                        "Trạng thái", "Vi phạm loại bỏ", "Người thực hiện"]])
+    _checkpoint(on_progress, 0.3, "Đã ghi bảng")
 
     doc.add_paragraph("")
     p = doc.add_paragraph("BIỂU ĐỒ LEVEY–JENNINGS (Z-SCORE)")
     p.runs[0].bold = True
 
-    fig = build_lj_figure_from_z(z_df=z_df, point_df=point_df,
-                                 title=f"{meta.ten_xet_nghiem} – Levey–Jennings (Z-score)")
-    img_buf = io.BytesIO()
-    fig.savefig(img_buf, format="png", dpi=300, bbox_inches="tight", facecolor="white")
-    plt.close(fig)
-    img_buf.seek(0)
+    img_buf = io.BytesIO(render_lj_png(z_df=z_df, point_df=point_df,
+                                       title=f"{meta.ten_xet_nghiem} – Levey–Jennings (Z-score)",
+                                       westgard_result=westgard_result, df_long=df_long))
+    _checkpoint(on_progress, 0.8, "Đã vẽ biểu đồ")
 
     # Insert image ~ 3/4 A4 width (usable width ~ 17cm-4cm = 13cm)
     doc.add_picture(img_buf, width=Cm(12.5))
@@ -230,6 +643,7 @@ def build_so_ghi_nhan_3muc_docx(export_df: pd.DataFrame,
     out = io.BytesIO()
     doc.save(out)
     out.seek(0)
+    _checkpoint(on_progress, 1.0, "Đã lưu tài liệu")
     return out
 
 
@@ -237,10 +651,14 @@ def build_so_ghi_nhan_3muc_docx(export_df: pd.DataFrame,
 def build_so_ghi_nhan_2muc_docx(export_df: pd.DataFrame,
                                z_df: pd.DataFrame,
                                point_df: Optional[pd.DataFrame],
-                               meta: ReportMeta) -> io.BytesIO:
+                               meta: ReportMeta,
+                               westgard_result=None,
+                               df_long: Optional[pd.DataFrame] = None,
+                               on_progress=None) -> io.BytesIO:
     """
     Tạo Word A4 cho 'Sổ ghi nhận & đánh giá 2 mức' + chèn biểu đồ L-J (ảnh).
     export_df: đã merge summary_df (có Trạng thái, Vi phạm loại bỏ, Người thực hiện)
+    on_progress: callback(tỉ lệ, thông báo) sau khi ghi bảng, vẽ biểu đồ, lưu tài liệu.
     """
     doc = Document()
 
@@ -284,42 +702,113 @@ def build_so_ghi_nhan_2muc_docx(export_df: pd.DataFrame,
     for i,h in enumerate(headers):
         tbl.cell(0,i).text = h
 
-    for _, r in df.iterrows():
-        cells = tbl.add_row().cells
-        cells[0].text = _safe_str(r.get("Ngày/Lần",""))
-        cells[1].text = _safe_str(r.get("Ctrl 1",""))
-        cells[2].text = _safe_str(r.get("Ctrl 2",""))
-        cells[3].text = _safe_str(r.get("z_Ctrl 1",""))
-        cells[4].text = _safe_str(r.get("z_Ctrl 2",""))
-        cells[5].text = _safe_str(r.get("Trạng thái",""))
-        cells[6].text = _safe_str(r.get("Vi phạm loại bỏ",""))
-        cells[7].text = _safe_str(r.get("Người thực hiện",""))
-        cells[8].text = _safe_str(r.get("Ghi chú",""))
+    _append_rows(tbl, [_str_column(df, c) for c in
+                       ["Ngày/Lần", "Ctrl 1", "Ctrl 2", "z_Ctrl 1", "z_Ctrl 2",
+                        "Trạng thái", "Vi phạm loại bỏ", "Người thực hiện", "Ghi chú"]])
+    _checkpoint(on_progress, 0.3, "Đã ghi bảng")
 
     doc.add_paragraph("")
     doc.add_paragraph("BIỂU ĐỒ LEVEY–JENNINGS (Z-SCORE)").runs[0].bold = True
 
-    fig = build_lj_figure_from_z(z_df=z_df, point_df=point_df, title="Levey–Jennings (Z-score)")
-    img_buf = io.BytesIO()
-    fig.savefig(img_buf, format="png", dpi=300, bbox_inches="tight", facecolor="white")
-    plt.close(fig)
-    img_buf.seek(0)
+    img_buf = io.BytesIO(render_lj_png(z_df=z_df, point_df=point_df, title="Levey–Jennings (Z-score)",
+                                       westgard_result=westgard_result, df_long=df_long))
+    _checkpoint(on_progress, 0.8, "Đã vẽ biểu đồ")
     # width ~ 3/4 A4 printable (approx 12.5cm)
     doc.add_picture(img_buf, width=Cm(12.5))
 
     buf = io.BytesIO()
     doc.save(buf)
     buf.seek(0)
+    _checkpoint(on_progress, 1.0, "Đã lưu tài liệu")
     return buf
 
 
-def build_cstk_3muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats_df: pd.DataFrame) -> io.BytesIO:
+def _add_exclusions_section(doc, exclusions: Optional[pd.DataFrame], method_label: str = ""):
+    """Mục 'điểm bị loại khi thiết lập' (Control, Lần đo, Giá trị, Tiêu chí)."""
+    doc.add_paragraph("ĐIỂM NGOẠI LAI TRONG DỮ LIỆU THIẾT LẬP").runs[0].bold = True
+    if method_label:
+        doc.add_paragraph(f"Phương pháp ước lượng: {method_label}")
+    if exclusions is None or exclusions.empty:
+        doc.add_paragraph("Không có điểm bị loại.")
+        return
+    t = doc.add_table(rows=1, cols=4)
+    t.alignment = WD_TABLE_ALIGNMENT.CENTER
+    for i, h in enumerate(["Mức QC", "Lần đo", "Giá trị", "Tiêu chí"]):
+        t.cell(0, i).text = h
+    cols = [exclusions.iloc[:, j].tolist() for j in range(4)]
+    _append_rows(t, [[str(v).replace("Ctrl ", "Level ") for v in cols[0]]]
+                 + [[_safe_str(v) for v in col] for col in cols[1:]])
+
+
+def _cstk_raw_columns(raw_df: pd.DataFrame) -> list:
+    """Cột bảng raw data 3 mức: [STT, L1, L2, L3] (chuỗi), nhận nhiều kiểu tên cột."""
+    raw_df2 = raw_df.copy()
+    # accept various column names
+    colmap = {c.lower(): c for c in raw_df2.columns}
+    def pick(*names):
+        for n in names:
+            if n in colmap:
+                return colmap[n]
+        return None
+
+    c1 = pick("l1","level1","level_1","lvl1")
+    c2 = pick("l2","level2","level_2","lvl2")
+    c3 = pick("l3","level3","level_3","lvl3")
+    if c1 is None or c2 is None or c3 is None:
+        # fallback: first 3 numeric cols
+        num_cols = list(raw_df2.select_dtypes(include="number").columns)[:3]
+        c1, c2, c3 = (num_cols + [None, None, None])[:3]
+
+    def raw_col(c):
+        if c is None:
+            return [""] * len(raw_df2)
+        return ["" if pd.isna(v) else str(v) for v in raw_df2[c].tolist()]
+
+    return [[str(i_row + 1) for i_row in raw_df2.index]] + [raw_col(c) for c in (c1, c2, c3)]
+
+
+def _cstk_value_getter(stats_df: Optional[pd.DataFrame]):
+    """get_val(ctrl_key 'L1'.., [tên cột ứng viên]) -> chuỗi giá trị từ stats_df (rỗng nếu không có)."""
+    # normalize stats_df
+    s = stats_df.copy() if stats_df is not None else pd.DataFrame()
+    if "Control" not in s.columns:
+        # try to detect a control column
+        for cand in ["control", "LEVEL", "level", "Muc", "Mức", "QC Level"]:
+            if cand in s.columns:
+                s = s.rename(columns={cand: "Control"})
+                break
+
+    def get_val(ctrl_key: str, key_candidates):
+        if s is None or s.empty or "Control" not in s.columns:
+            return ""
+        row = s[s["Control"].astype(str).str.lower().isin([ctrl_key.lower(), f"ctrl {ctrl_key[-1]}".lower(), f"level {ctrl_key[-1]}".lower()])]
+        if row.empty:
+            # try exact
+            row = s[s["Control"].astype(str).str.strip().str.lower() == ctrl_key.lower()]
+        if row.empty:
+            return ""
+        for k in key_candidates:
+            if k in s.columns:
+                v = row.iloc[0][k]
+                return "" if pd.isna(v) else str(v)
+        return ""
+
+    return get_val
+
+
+def build_cstk_3muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats_df: pd.DataFrame,
+                         exclusions: Optional[pd.DataFrame] = None, method_label: str = "",
+                         use_template: Optional[bool] = None) -> io.BytesIO:
     """
     Phiếu thiết lập CSTK – 3 mức.
     raw_df: DataFrame có cột ['L1','L2','L3'] (20–30 dòng). Có thể None.
     stats_df: DataFrame tổng hợp (theo page CSTK trong app), tối thiểu có cột:
         ['Control','Mean_X','SD_use','CV%_use'] hoặc tương đương.
+    exclusions: bảng điểm bị loại (chế độ ước lượng bền vững); None -> không in mục này.
+    use_template: dựng từ templates/ (None -> theo DOCX_TEMPLATE_MODE, mặc định bật).
     """
+    if DOCX_TEMPLATE_MODE if use_template is None else use_template:
+        return _build_cstk_3muc_from_template(meta, raw_df, stats_df, exclusions, method_label)
     doc = Document()
 
     apply_header_footer(
@@ -370,29 +859,7 @@ def build_cstk_3muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats
         r[2].text = "{{L2_VALUE}}"
         r[3].text = "{{L3_VALUE}}"
     else:
-        raw_df2 = raw_df.copy()
-        # accept various column names
-        colmap = {c.lower(): c for c in raw_df2.columns}
-        def pick(*names):
-            for n in names:
-                if n in colmap:
-                    return colmap[n]
-            return None
-
-        c1 = pick("l1","level1","level_1","lvl1")
-        c2 = pick("l2","level2","level_2","lvl2")
-        c3 = pick("l3","level3","level_3","lvl3")
-        if c1 is None or c2 is None or c3 is None:
-            # fallback: first 3 numeric cols
-            num_cols = list(raw_df2.select_dtypes(include="number").columns)[:3]
-            c1, c2, c3 = (num_cols + [None, None, None])[:3]
-
-        for i_row, row in raw_df2.iterrows():
-            rr = raw_tbl.add_row().cells
-            rr[0].text = str(i_row + 1)
-            rr[1].text = "" if c1 is None else ("" if pd.isna(row[c1]) else str(row[c1]))
-            rr[2].text = "" if c2 is None else ("" if pd.isna(row[c2]) else str(row[c2]))
-            rr[3].text = "" if c3 is None else ("" if pd.isna(row[c3]) else str(row[c3]))
+        _append_rows(raw_tbl, _cstk_raw_columns(raw_df))
 
     doc.add_paragraph("")
 
@@ -404,29 +871,7 @@ def build_cstk_3muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats
     for i, h in enumerate(headers):
         tbl.cell(0, i).text = h
 
-    # normalize stats_df
-    s = stats_df.copy() if stats_df is not None else pd.DataFrame()
-    if "Control" not in s.columns:
-        # try to detect a control column
-        for cand in ["control", "LEVEL", "level", "Muc", "Mức", "QC Level"]:
-            if cand in s.columns:
-                s = s.rename(columns={cand: "Control"})
-                break
-
-    def get_val(ctrl_key: str, key_candidates):
-        if s is None or s.empty or "Control" not in s.columns:
-            return ""
-        row = s[s["Control"].astype(str).str.lower().isin([ctrl_key.lower(), f"ctrl {ctrl_key[-1]}".lower(), f"level {ctrl_key[-1]}".lower()])]
-        if row.empty:
-            # try exact
-            row = s[s["Control"].astype(str).str.strip().str.lower() == ctrl_key.lower()]
-        if row.empty:
-            return ""
-        for k in key_candidates:
-            if k in s.columns:
-                v = row.iloc[0][k]
-                return "" if pd.isna(v) else str(v)
-        return ""
+    get_val = _cstk_value_getter(stats_df)
 
     for ctrl, tag in [("L1", "Level 1"), ("L2", "Level 2"), ("L3", "Level 3")]:
         r = tbl.add_row().cells
@@ -437,6 +882,9 @@ def build_cstk_3muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats
         r[4].text = getattr(meta, "nguon_cstk", "{{NGUON_CSTK}}")
 
     doc.add_paragraph("")
+    if exclusions is not None:
+        _add_exclusions_section(doc, exclusions, method_label)
+        doc.add_paragraph("")
     doc.add_paragraph("Nhận xét: {{NHAN_XET}}")
 
     doc.add_paragraph("")
@@ -450,12 +898,14 @@ def build_cstk_3muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats
     out.seek(0)
     return out
         
-def build_cstk_2muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats_df: pd.DataFrame) -> io.BytesIO:
+def build_cstk_2muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats_df: pd.DataFrame,
+                         exclusions: Optional[pd.DataFrame] = None, method_label: str = "") -> io.BytesIO:
     """
     Phiếu thiết lập CSTK – 2 mức.
     raw_df: DataFrame có cột ['L1','L2'] (20–30 dòng). Có thể None.
     stats_df: DataFrame tổng hợp, tối thiểu có cột:
         ['Control','Mean_X','SD_use','CV%_use'] hoặc tương đương.
+    exclusions: bảng điểm bị loại (chế độ ước lượng bền vững); None -> không in mục này.
     """
     doc = Document()
 
@@ -494,11 +944,12 @@ def build_cstk_2muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats
         t.cell(0,0).text = "STT"
         t.cell(0,1).text = "L1"
         t.cell(0,2).text = "L2"
-        for i in range(len(raw_df)):
-            rr = t.add_row().cells
-            rr[0].text = str(i+1)
-            rr[1].text = _safe_str(raw_df.iloc[i].get("L1",""))
-            rr[2].text = _safe_str(raw_df.iloc[i].get("L2",""))
+        # to_numpy: cùng kiểu chung như khi lấy từng dòng bằng iloc
+        vals = raw_df.to_numpy()
+        cols = list(raw_df.columns)
+        _append_rows(t, [[str(i + 1) for i in range(len(raw_df))]]
+                     + [[_safe_str(v) for v in vals[:, cols.index(c)]] if c in cols else [""] * len(raw_df)
+                        for c in ("L1", "L2")])
         doc.add_paragraph("")
 
     # Stats summary
@@ -529,6 +980,10 @@ def build_cstk_2muc_docx(meta: ReportMeta, raw_df: Optional[pd.DataFrame], stats
         rr[2].text = _safe_str(sd_v)
         rr[3].text = _safe_str(cv_v)
 
+    if exclusions is not None:
+        doc.add_paragraph("")
+        _add_exclusions_section(doc, exclusions, method_label)
+
     buf = io.BytesIO()
     doc.save(buf)
     buf.seek(0)
@@ -50,18 +50,40 @@ baseline_df = st.data_editor(
 )
 qc.update_current_analyte_state(baseline_df=baseline_df)
 
+robust_key = f"robust_method_{cfg['test_name']}"
+if robust_key not in st.session_state:
+    st.session_state[robust_key] = cur_state.get("robust_method", "none")
+robust_method = st.radio(
+    "Cách ước lượng Mean / SD",
+    list(qc.ROBUST_METHODS),
+    format_func=qc.ROBUST_METHODS.get,
+    horizontal=True,
+    key=robust_key,
+    help="Chế độ bền vững giúp loại sai số thô trong dữ liệu thiết lập trước khi tính SD.",
+)
+
+# Mean/SD/CV chỉ tính lại khi bảng thiết lập / cách ước lượng đổi; đổi CVh chỉ tính lại SD theo CVh
+pipe = qc.get_analyte_pipeline().set_inputs(
+    baseline_df=baseline_df, num_levels=num_levels, robust_method=robust_method
+)
+baseline_stats = pipe.get("baseline_stats").set_index("Control")
+exclusions_df = pipe.get("baseline_exclusions")
+qc.update_current_analyte_state(robust_method=robust_method, baseline_exclusions=exclusions_df)
+
+if not exclusions_df.empty:
+    verb = "được báo cáo (Median/MAD dùng mọi điểm)" if robust_method == "mad" else "bị loại khỏi tính toán"
+    st.warning(f"⚠️ {len(exclusions_df)} điểm ngoại lai {verb}:")
+    st.dataframe(exclusions_df, use_container_width=True, hide_index=True)
+
 st.markdown("### 📌 Kết quả thống kê")
 
-stats_rows = []
 cvh_inputs = {}
-sd_from_cvh = {}
 
 col_stats = st.columns(num_levels)
 
 for i, ctrl in enumerate(cols):
     with col_stats[i]:
-        values = baseline_df[ctrl].tolist()
-        mean, sd, cv = qc.compute_stats(values)
+        mean, sd, cv = baseline_stats.loc[ctrl, ["Mean_X", "SD_empirical", "CV_empirical_%"]]
 
         st.markdown(f"**🧪 {ctrl}**")
         st.write(
@@ -85,29 +107,13 @@ for i, ctrl in enumerate(cols):
         )
         cvh_inputs[ctrl] = cvh
 
-        if not np.isnan(mean):
-            sd_cvh = mean * cvh / 100.0
-        else:
-            sd_cvh = np.nan
-        sd_from_cvh[ctrl] = sd_cvh
-
+        sd_cvh = qc.sd_from_cvh(mean, cvh)
         if not np.isnan(sd_cvh):
             st.write(f"- SD theo CVh: `{sd_cvh:.4g}`")
         else:
             st.write("- SD theo CVh: _chưa tính được_")
 
-    stats_rows.append(
-        {
-            "Control": ctrl,
-            "Mean_X": mean,
-            "SD_empirical": sd,
-            "CV_empirical_%": cv,
-            "CVh_target_%": cvh_inputs[ctrl],
-            "SD_from_CVh": sd_from_cvh[ctrl],
-        }
-    )
-
-stats_df = pd.DataFrame(stats_rows)
+stats_df = pipe.set_input("cvh", cvh_inputs).get("qc_stats")
 st.markdown("#### 🧾 Bảng tổng hợp chỉ số thống kê")
 st.dataframe(stats_df, use_container_width=True)
 
@@ -118,6 +124,38 @@ st.info(
 
 qc.update_current_analyte_state(qc_stats=stats_df)
 
+daily_df = cur_state.get("daily_df")
+with st.expander("🔁 Đề xuất CSTK mới từ kết quả IQC tích luỹ"):
+    if daily_df is None or daily_df.empty:
+        st.caption("Chưa có kết quả IQC hằng ngày (trang 2) để tính CSTK tích luỹ.")
+    else:
+        rt_col1, rt_col2 = st.columns(2)
+        with rt_col1:
+            retarget_mode = st.radio(
+                "Dữ liệu dùng để tính", list(qc.RETARGET_MODES), format_func=qc.RETARGET_MODES.get
+            )
+        with rt_col2:
+            retarget_window = st.number_input(
+                "Số lần chạy (N)", min_value=2, value=min(20, max(2, len(daily_df))), step=1,
+                disabled=retarget_mode != "last_n",
+            )
+        if retarget_mode != "last_n":
+            group = qc.retarget_group(daily_df, retarget_mode)
+            column = "Ngày" if retarget_mode == "month" else "Lô QC"
+            st.caption(
+                f"Tính từ lần chạy đầu tiên của {'tháng' if retarget_mode == 'month' else 'lô'} **{group}** đến nay."
+                if group
+                else f"Chưa ghi cột '{column}' ở bảng IQC hằng ngày (trang 2) → dùng toàn bộ bảng."
+            )
+        proposal_df = qc.propose_qc_stats(
+            daily_df, stats_df, num_levels, mode=retarget_mode, window=int(retarget_window)
+        )
+        st.dataframe(proposal_df, use_container_width=True, hide_index=True)
+        st.caption(
+            "Bảng đề xuất để xem xét; CSTK đang dùng vẫn là bảng tổng hợp ở trên cho đến khi "
+            "dữ liệu thiết lập được cập nhật."
+        )
+
 
 st.markdown("---")
 st.markdown("### 🖨️ Xuất Phiếu thiết lập CSTK (Word – A4)")
@@ -133,7 +171,14 @@ try:
     meta.phien_ban = (f"Phiên bản: {cfg.get('phien_ban','')}" if cfg.get("phien_ban","") else "Phiên bản: {{PHIEN_BAN}}")
     meta.ngay_hieu_luc = (f"Ngày hiệu lực: {cfg.get('ngay_hieu_luc','')}" if cfg.get("ngay_hieu_luc","") else "Ngày hiệu lực: {{NGAY_HIEU_LUC}}")
 
-    docx_buf = export_cstk(meta=meta, stats_df=stats_df, raw_df=None, num_levels=cfg.get('num_levels',3))
+    docx_buf = export_cstk(
+        meta=meta,
+        stats_df=stats_df,
+        raw_df=None,
+        num_levels=cfg.get('num_levels',3),
+        exclusions=exclusions_df if robust_method != "none" else None,
+        method_label=qc.ROBUST_METHODS[robust_method],
+    )
 
     st.download_button(
         f"📄 Tải Phiếu thiết lập CSTK ({cfg.get('num_levels',3)} mức) – .docx",
@@ -1,7 +1,9 @@
+import os
+
 import streamlit as st
 import pandas as pd
 import numpy as np
-from io import BytesIO
+import altair as alt
 
 import qc_core as qc
 from export.export_so_gn_dg_word import export_so_gn_dg
@@ -36,20 +38,12 @@ else:
 
     sd_mode = st.radio(
         "SD dùng để tính z-score",
-        ["SD thực nghiệm", "SD theo CVh"],
-        index=1,
+        list(qc.SD_MODES),
+        index=list(qc.SD_MODES).index(qc.DEFAULT_SD_MODE),
         horizontal=True,
     )
 
-    mean_dict = {}
-    sd_dict = {}
-    for _, row in qc_stats.iterrows():
-        ctrl = row["Control"]
-        mean_dict[ctrl] = row["Mean_X"]
-        if sd_mode == "SD thực nghiệm":
-            sd_dict[ctrl] = row["SD_empirical"]
-        else:
-            sd_dict[ctrl] = row["SD_from_CVh"]
+    mean_dict, sd_dict = qc.control_mean_sd(qc_stats, sd_mode)
 
     st.write("**Giá trị Mean & SD đang dùng:**")
     for ctrl in [f"Ctrl {i}" for i in range(1, num_levels + 1)]:
@@ -69,6 +63,59 @@ else:
         "(ngoài ra luôn có 1_2s là quy tắc cảnh báo)."
     )
 
+    with st.expander("📉 Hàm lực (power function) của các bộ quy tắc theo sigma"):
+        st.caption(
+            "Mô phỏng Monte Carlo: **Ped** = xác suất phát hiện sai số ở lần chạy đầu tiên, "
+            "**Pfr** = xác suất loại bỏ giả, **E_Nuf** = số KQ bệnh nhân không tin cậy kỳ vọng "
+            "được trả ra trước khi phát hiện (TEa = sigma hiện tại)."
+        )
+        pw_col1, pw_col2 = st.columns(2)
+        with pw_col1:
+            n_sims = st.select_slider(
+                "Số mô phỏng / điểm", [5000, 20000, 50000, 100000], value=20000
+            )
+        with pw_col2:
+            patients_per_run = st.number_input(
+                "Số KQ bệnh nhân giữa 2 lần QC", min_value=1, value=100, step=10
+            )
+        # Mô phỏng chạy nền (process pool), kết quả giữ theo bộ tham số trong phiên
+        power_params = (num_levels, float(cfg["sigma_value"]), int(n_sims), int(patients_per_run))
+        power_tables = st.session_state.setdefault("power_tables", {})
+        if power_params not in power_tables and st.button("▶️ Chạy mô phỏng"):
+            try:
+                qc.submit_job(
+                    "power_sim", qc.simulate_rule_power, num_levels, sigma=power_params[1],
+                    n_sims=power_params[2], patients_per_run=power_params[3],
+                    workers=os.cpu_count() or 1, progress=True,
+                )
+                st.session_state["power_sim_params"] = power_params
+            except qc.JobLimitError:
+                st.warning("Đang có quá nhiều tác vụ chạy nền trong phiên này. Vui lòng chờ hoặc huỷ bớt.")
+        power_job = qc.render_job("power_sim")
+        if power_job is not None:
+            power_tables[st.session_state["power_sim_params"]] = power_job.result
+            qc.forget_job("power_sim")
+        power_df = power_tables.get(power_params)
+        if power_df is not None:
+            re_pick = st.select_slider(
+                "RE (hệ số nhân SD)", sorted(power_df["RE"].unique()), value=1.0
+            )
+            view = power_df[power_df["RE"] == re_pick]
+            st.altair_chart(
+                alt.Chart(view).mark_line(point=True).encode(
+                    x=alt.X("SE:Q", title="Sai số hệ thống (SD)"),
+                    y=alt.Y("Ped:Q", title="Xác suất loại bỏ", scale=alt.Scale(domain=[0, 1])),
+                    color=alt.Color("Bộ quy tắc:N"),
+                    tooltip=["Bộ quy tắc", "SE", "RE",
+                             alt.Tooltip("Ped:Q", format=".3f"),
+                             alt.Tooltip("Pfr:Q", format=".4f"),
+                             alt.Tooltip("ARL:Q", format=".2f"),
+                             alt.Tooltip("E_Nuf:Q", format=".2f")],
+                ),
+                use_container_width=True,
+            )
+            st.dataframe(view, use_container_width=True, hide_index=True)
+
     st.markdown("### 📋 Nhập kết quả nội kiểm hằng ngày")
 
     daily_df = cur_state.get("daily_df")
@@ -78,9 +125,18 @@ else:
             data[ctrl] = [None] * 20
         daily_df = pd.DataFrame(data)
 
+    # Cột Ngày / Lô QC (nhóm run theo tháng / lô khi đề xuất CSTK mới ở trang 1);
+    # bảng cũ chưa có -> thêm, Lô QC lấy từ lô đang khai báo ở sidebar
+    info_defaults = {"Ngày": None, "Lô QC": cfg.get("qc_lot") or None}
+    missing_info = {
+        c: pd.Series([info_defaults[c]] * len(daily_df), index=daily_df.index, dtype=object)
+        for c in qc.DAILY_INFO_COLUMNS if c not in daily_df.columns
+    }
+    if missing_info:
+        daily_df = daily_df.assign(**missing_info)
 
     # Đồng bộ cột theo số mức QC (tránh lỗi khi đổi 2↔3 mức: thiếu/ thừa cột Ctrl)
-    required_cols = ["Ngày/Lần"] + [f"Ctrl {i}" for i in range(1, num_levels + 1)]
+    required_cols = ["Ngày/Lần"] + qc.DAILY_INFO_COLUMNS + [f"Ctrl {i}" for i in range(1, num_levels + 1)]
     # Thêm cột còn thiếu
     for c in required_cols:
         if c not in daily_df.columns:
@@ -99,6 +155,8 @@ else:
         key=f"daily_editor_{num_levels}_{cfg['test_name']}",
         column_config={
             "Ngày/Lần": st.column_config.NumberColumn("Ngày/Lần", disabled=True),
+            "Ngày": st.column_config.TextColumn("Ngày", help="dd/mm/yyyy; để trống = cùng tháng với lần trước"),
+            "Lô QC": st.column_config.TextColumn("Lô QC", help="Để trống = cùng lô với lần trước"),
             **{
                 f"Ctrl {i}": st.column_config.NumberColumn(f"Ctrl {i}")
                 for i in range(1, num_levels + 1)
@@ -107,28 +165,25 @@ else:
     )
     qc.update_current_analyte_state(daily_df=daily_df)
 
-    # Tính z-score
-    zscore_cols = {}
-    for lvl in range(1, num_levels + 1):
-        ctrl = f"Ctrl {lvl}"
-        mean = mean_dict.get(ctrl, np.nan)
-        sd = sd_dict.get(ctrl, np.nan)
-        z_col = f"z_Ctrl {lvl}"
-        zscore_cols[z_col] = [
-            qc.compute_zscore(v, mean, sd) if v not in (None, "") else np.nan
-            for v in daily_df.get(ctrl, pd.Series([np.nan]*len(daily_df))).tolist()
-        ]
-
-    z_df = pd.DataFrame({"Ngày/Lần": daily_df["Ngày/Lần"], **zscore_cols})
+    # Tính z-score (cả bảng 1 lượt; chỉ tính lại khi daily_df / Mean-SD / số mức đổi)
+    pipe = qc.get_analyte_pipeline().set_inputs(
+        qc_stats=qc_stats,
+        sd_mode=sd_mode,
+        num_levels=num_levels,
+        sigma=cfg["sigma_value"],
+        daily_df=daily_df,
+    )
+    z_df = pipe.get("z_df")
 
     st.markdown("### 📈 Bảng z-score")
     st.dataframe(z_df, use_container_width=True)
-    qc.update_current_analyte_state(z_df=z_df)
+    qc.update_current_analyte_state(z_df=z_df, sd_mode=sd_mode)
 
     if not z_df.drop(columns=["Ngày/Lần"]).isna().all().all():
-        sigma_cat2, active_rules2, summary_df, point_df = qc.evaluate_westgard(
-            z_df, num_levels=num_levels, sigma=cfg["sigma_value"]
-        )
+        wg_result = pipe.get("westgard")
+        sigma_cat2, active_rules2 = wg_result.sigma_cat, wg_result.active_rules
+        # wg_result có thể đến từ cache dùng chung giữa các phiên -> bảng lưu vào state là bản sao
+        summary_df, point_df = wg_result.summary_df, wg_result.point_df.copy()
 
         st.markdown("### ✅ Đánh giá theo quy tắc Westgard (theo sigma)")
         st.write(
@@ -153,9 +208,11 @@ else:
             },
             key="people_editor",
         )
-        # Ghi lại vào summary_df
-        summary_df = summary_df.drop(columns=["Người thực hiện"]).merge(edit_people, on="Ngày/Lần", how="left")
-        qc.update_current_analyte_state(summary_df=summary_df, point_df=point_df)
+        # Ghi lại vào summary_df (sửa 'Người thực hiện' không tính lại z-score / Westgard)
+        summary_df = pipe.set_input("people", edit_people).get("summary_df")
+        qc.update_current_analyte_state(
+            summary_df=summary_df, point_df=point_df, westgard_result=wg_result
+        )
 
         st.info(
             "• **Đạt**: không vi phạm quy tắc loại bỏ.\n"
@@ -166,43 +223,16 @@ else:
         )
 
         # Chuẩn bị dữ liệu xuất sổ theo dõi
-        export_df = daily_df.copy()
-        for col in z_df.columns:
-            if col != "Ngày/Lần":
-                export_df[col] = z_df[col]
-        export_df = export_df.merge(summary_df, on="Ngày/Lần", how="left")
-
-        ctrl_cols = [
-            f"Ctrl {i}"
-            for i in range(1, num_levels + 1)
-            if f"Ctrl {i}" in export_df.columns
-        ]
-        z_cols_out = [
-            f"z_Ctrl {i}"
-            for i in range(1, num_levels + 1)
-            if f"z_Ctrl {i}" in export_df.columns
-        ]
-        tail_cols = [
-            c
-            for c in ["Trạng thái", "Vi phạm loại bỏ", "Người thực hiện"]
-            if c in export_df.columns
-        ]
-        ordered_cols = ["Ngày/Lần"] + ctrl_cols + z_cols_out + tail_cols
-        export_df = export_df[ordered_cols]
+        export_df = pipe.get("export_df")
 
         st.markdown("### 📤 Xuất Excel 'Sổ theo dõi KQ NK'")
 
         file_name = (
             f"So_theo_doi_KQ_NK_{cfg['test_name'] if cfg['test_name'] else 'Xet_nghiem'}.xlsx"
         )
-        buffer = BytesIO()
-        with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
-            export_df.to_excel(writer, sheet_name="So theo doi KQ NK", index=False)
-        buffer.seek(0)
-
         st.download_button(
             label="⬇️ Tải file Excel 'Sổ theo dõi KQ NK'",
-            data=buffer,
+            data=pipe.get("export_xlsx"),
             file_name=file_name,
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         )
@@ -232,10 +262,13 @@ meta = ReportMeta(
 )
 
 
+# Dựng Word (kèm vẽ biểu đồ) chạy nền: trang không bị treo, các lần rerun sau hỏi trạng thái / lấy file
+word_job = f"so_gn_dg:{st.session_state.get('active_analyte', ten_xn)}"
 if st.button("📄 Tạo file Word A4 (Sổ ghi nhận & đánh giá)"):
     try:
         z_df_state = qc.get_current_analyte_state().get("z_df")
         point_df_state = qc.get_current_analyte_state().get("point_df")
+        result_state = qc.get_current_analyte_state().get("westgard_result")
 
         # Dùng summary_df làm bảng xuất (ổn định nhất)
         base_df = summary_df.copy()
@@ -244,20 +277,82 @@ if st.button("📄 Tạo file Word A4 (Sổ ghi nhận & đánh giá)"):
         if "Người thực hiện" not in base_df.columns:
             base_df["Người thực hiện"] = ""
 
-        docx_buf = export_so_gn_dg(
+        qc.submit_job(
+            word_job,
+            export_so_gn_dg,
             meta=meta,
             export_df=base_df,
             z_df=z_df_state,
             point_df=point_df_state,
             num_levels=int(cfg.get("num_levels", 3)),
+            westgard_result=result_state,
+            df_long=qc.get_analyte_pipeline().get("chart_df"),  # cùng bảng dạng dài với chart trang 3
+            progress=True,  # báo tiến độ + cho huỷ tại các mốc ghi bảng / vẽ biểu đồ / lưu
         )
-
-        st.download_button(
-            label=f"⬇️ Tải file Word A4 'Sổ ghi nhận & đánh giá ({cfg.get('num_levels',3)} mức)'",
-            data=docx_buf,
-            file_name=f"So_ghi_nhan_danh_gia_{cfg.get('num_levels',3)}muc_{ten_xn or 'IQC'}.docx",
-            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        )
-
+    except qc.JobLimitError:
+        st.warning("Đang có quá nhiều tác vụ chạy nền trong phiên này. Vui lòng chờ hoặc huỷ bớt.")
     except Exception as e:
         st.error(f"Không thể xuất Word: {e}")
+
+qc.render_job_status(
+    word_job,
+    download_label=f"⬇️ Tải file Word A4 'Sổ ghi nhận & đánh giá ({cfg.get('num_levels',3)} mức)'",
+    file_name=f"So_ghi_nhan_danh_gia_{cfg.get('num_levels',3)}muc_{ten_xn or 'IQC'}.docx",
+    mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+)
+
+
+# Báo cáo cuối tháng: mọi xét nghiệm trong phiên (hoặc dữ liệu đã lưu của PXN) -> 1 file ZIP
+st.markdown("### 📦 Xuất báo cáo cuối tháng (tất cả xét nghiệm)")
+with st.expander("Sổ ghi nhận & đánh giá (.docx), Sổ theo dõi KQ NK (.xlsx), Phiếu CSTK (.docx), biểu đồ LJ (.png)"):
+    user = st.session_state.get("current_user") or {}
+    sources = ["Các xét nghiệm trong phiên làm việc"]
+    if user.get("lab_id") and qc.supabase_is_configured():
+        sources.append(f"Dữ liệu đã lưu của PXN ({user['lab_id']})")
+    source = st.radio("Nguồn dữ liệu", sources, horizontal=True, key="month_end_source")
+    kind_labels = {"so_gn_dg": "Sổ ghi nhận & đánh giá", "xlsx": "Sổ theo dõi KQ NK", "cstk": "Phiếu CSTK"}
+    kinds = st.multiselect(
+        "Loại báo cáo", list(kind_labels), default=list(kind_labels), format_func=kind_labels.get,
+        key="month_end_kinds",
+    )
+
+    # job nền -> (hàm tạo ZIP trên đĩa, tham số thêm)
+    zip_jobs = {
+        "month_end": (qc.export_month_end_zip, {"kinds": tuple(kinds)}),
+        "month_end_png": (qc.export_lj_png_zip, {}),
+    }
+    col_reports, col_png = st.columns(2)
+    with col_reports:
+        clicked = "month_end" if st.button("📦 Tạo ZIP báo cáo cuối tháng", disabled=not kinds) else None
+    with col_png:
+        # Ảnh PNG Levey–Jennings của mọi xét nghiệm (vẽ song song, 1 file / xét nghiệm)
+        clicked = "month_end_png" if st.button("🖼️ Tạo ZIP biểu đồ Levey–Jennings (.png)") else clicked
+
+    if clicked:
+        lab_id = user.get("lab_id") or "IQC"
+        if source == sources[0]:
+            # bản chụp nông: job nền không thấy các thay đổi state sau khi bấm
+            store = {k: dict(v or {}) for k, v in st.session_state.get("iqc_multi", {}).items()}
+        else:
+            store = None  # nạp dữ liệu đã lưu của PXN trong job
+        old_zip = st.session_state.pop(f"{clicked}_zip", None)
+        if old_zip and os.path.exists(old_zip):
+            os.remove(old_zip)
+        fn, kwargs = zip_jobs[clicked]
+        try:
+            qc.submit_job(clicked, fn, {lab_id: store}, workers=os.cpu_count() or 1, progress=True, **kwargs)
+        except qc.JobLimitError:
+            st.warning("Đang có quá nhiều tác vụ chạy nền trong phiên này. Vui lòng chờ hoặc huỷ bớt.")
+
+    qc.render_zip_job_status(
+        "month_end",
+        download_label="⬇️ Tải ZIP báo cáo cuối tháng",
+        file_name=f"Bao_cao_cuoi_thang_{thang_nam or 'IQC'}.zip",
+        empty_message="Chưa có xét nghiệm nào đủ dữ liệu để xuất báo cáo.",
+    )
+    qc.render_zip_job_status(
+        "month_end_png",
+        download_label="⬇️ Tải ZIP biểu đồ Levey–Jennings",
+        file_name=f"Bieu_do_LJ_{thang_nam or 'IQC'}.zip",
+        empty_message="Chưa có xét nghiệm nào có z-score để vẽ biểu đồ.",
+    )
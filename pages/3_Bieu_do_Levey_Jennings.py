@@ -1,5 +1,4 @@
 import streamlit as st
-import pandas as pd
 import os
 
 import qc_core as qc
@@ -24,7 +23,6 @@ st.subheader("3️⃣ 📊 Biểu đồ Levey–Jennings (z-score)")
 
 cur_state = qc.get_current_analyte_state()
 z_df = cur_state.get("z_df")
-point_df = cur_state.get("point_df")
 num_levels = cfg["num_levels"]
 
 if z_df is None or z_df.empty:
@@ -33,56 +31,76 @@ if z_df is None or z_df.empty:
         "Vào trang **2 – Ghi nhận & đánh giá** để tính trước."
     )
 else:
-    if point_df is None or point_df.empty:
-        _, _, _, point_df = qc.evaluate_westgard(
-            z_df, num_levels=num_levels, sigma=cfg["sigma_value"]
+    # Trạng thái + mã quy tắc lấy từ mask bit của WestgardResult (không parse lại chuỗi);
+    # pipeline chỉ dựng lại dạng dài khi z_df / sigma / số mức đổi
+    pipe = qc.get_analyte_pipeline().set_inputs(
+        z_df=z_df, num_levels=num_levels, sigma=cfg["sigma_value"]
+    )
+    wg_result = pipe.get("westgard")
+    if cur_state.get("westgard_result") is not wg_result:
+        qc.update_current_analyte_state(point_df=wg_result.point_df.copy(), westgard_result=wg_result)
+
+    df_long_all = pipe.get("chart_df")
+
+    # Cửa sổ run: chỉ phần đang xem được gửi lên trình duyệt. Westgard đã đánh giá trên
+    # toàn chuỗi (pipeline cache) nên điểm đầu cửa sổ vẫn có đủ ngữ cảnh các run trước.
+    n_runs = len(z_df)
+    run_labels = z_df["Ngày/Lần"].astype(str).tolist()
+    win_start, win_stop = 0, n_runs
+    if n_runs > 30:
+        presets = {"30 run gần nhất": 30, "90 run gần nhất": 90, "365 run gần nhất": 365,
+                   "Tất cả": None, "Tuỳ chọn khoảng": "custom"}
+        presets = {k: v for k, v in presets.items() if not isinstance(v, int) or v < n_runs}
+        default = "365 run gần nhất" if "365 run gần nhất" in presets else "Tất cả"
+        preset = st.radio("Khoảng hiển thị", list(presets), index=list(presets).index(default),
+                          horizontal=True, key=f"lj_window_{cfg['test_name']}")
+        choice = presets[preset]
+        if choice == "custom":
+            lo, hi = st.slider("Chọn run (thứ tự)", 1, n_runs, (max(n_runs - 89, 1), n_runs),
+                               key=f"lj_range_{cfg['test_name']}")
+            win_start, win_stop = qc.lj_window_bounds(n_runs, start=lo - 1, stop=hi)
+        else:
+            win_start, win_stop = qc.lj_window_bounds(n_runs, last_n=choice)
+        st.caption(
+            f"Đang xem run {win_start + 1}–{win_stop} / {n_runs} "
+            f"({run_labels[win_start]} → {run_labels[win_stop - 1]})."
         )
-        qc.update_current_analyte_state(point_df=point_df)
-
-    point_idx = point_df.set_index(["Ngày/Lần", "Control"])
-
-    runs = z_df["Ngày/Lần"].tolist()
-    z_cols = [c for c in z_df.columns if c.startswith("z_Ctrl")]
-    z_cols = sorted(z_cols, key=lambda x: int(x.split("Ctrl ")[1]))
-
-    df_long_rows = []
-    for idx, run in enumerate(runs):
-        for lvl, z_col in enumerate(z_cols, start=1):
-            z_val = z_df.loc[idx, z_col]
-            if pd.isna(z_val):
-                continue
-            ctrl_name = f"Ctrl {lvl}"
-            key = (run, ctrl_name)
-            if key in point_idx.index:
-                row = point_idx.loc[key]
-                p_status = row["point_status"]
-                r_codes = row["rule_codes"]
-            else:
-                p_status = "Đạt"
-                r_codes = ""
-            short = qc.extract_rule_short(r_codes)
-            df_long_rows.append(
-                {
-                    "Run": int(run),
-                    "Control": ctrl_name,
-                    "z_score": float(z_val),
-                    "point_status": p_status,
-                    "rule_codes": r_codes,
-                    "rule_short": short,
-                }
-            )
 
-    df_long = pd.DataFrame(df_long_rows)
+    df_long = qc.slice_lj_window(df_long_all, win_start, win_stop)
 
     if df_long.empty:
         st.warning("Không có điểm z-score hợp lệ để vẽ biểu đồ.")
     else:
+        # Chuỗi dài: rút gọn điểm gửi lên trình duyệt (LTTB), luôn giữ điểm cảnh báo / vi phạm và |z| > 3
+        max_points = None
+        if len(df_long) > qc.LJ_MAX_POINTS:
+            ds_col, budget_col = st.columns([1, 1])
+            with ds_col:
+                use_ds = st.toggle(
+                    f"Rút gọn điểm hiển thị ({len(df_long):,} điểm)",
+                    value=True,
+                    help="Giữ hình dạng chuỗi bằng LTTB; mọi điểm cảnh báo / vi phạm và |z| > 3 luôn được giữ.",
+                )
+            with budget_col:
+                budget = st.number_input(
+                    "Số điểm tối đa",
+                    min_value=100,
+                    max_value=max(len(df_long), 100),
+                    value=qc.LJ_MAX_POINTS,
+                    step=100,
+                    disabled=not use_ds,
+                )
+            if use_ds:
+                max_points = int(budget)
+
         chart_col, info_col = st.columns([3, 2])
 
         with chart_col:
-            chart = qc.create_levey_jennings_chart(
+            # Chart đã cache theo nội dung: rerun không đổi dữ liệu không dựng lại chart
+            chart = qc.cached_levey_jennings_chart(
                 df_long,
                 title=f"Biểu đồ Levey–Jennings – {cfg['test_name'] or 'Xét nghiệm'}",
+                max_points=max_points,
             )
             if chart is not None:
                 st.altair_chart(chart, use_container_width=True)
@@ -111,7 +129,18 @@ else:
                 )
 
         st.markdown("### 🔎 Dữ liệu đang dùng để vẽ")
-        st.dataframe(df_long, use_container_width=True)
+        page_col, size_col = st.columns([1, 1])
+        with size_col:
+            page_size = st.selectbox("Số dòng / trang", [50, 100, 200, 500], index=1,
+                                     key=f"lj_page_size_{cfg['test_name']}")
+        n_pages = max((len(df_long) - 1) // page_size + 1, 1)
+        with page_col:
+            page = st.number_input("Trang", min_value=1, max_value=n_pages, value=n_pages, step=1,
+                                   key=f"lj_page_{cfg['test_name']}_{win_start}_{win_stop}_{page_size}")
+        row_lo = (int(page) - 1) * page_size
+        page_df = df_long.iloc[row_lo:row_lo + page_size]
+        st.dataframe(page_df, use_container_width=True)
+        st.caption(f"Dòng {row_lo + 1}–{row_lo + len(page_df)} / {len(df_long)} · trang {int(page)}/{n_pages}")
 
         st.success(
             "• Điểm bình thường: dấu tròn tại z-score.\n"
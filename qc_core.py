@@ -1,7 +1,13 @@
+import functools
 import math
 import os
+import itertools
 import json
-from io import BytesIO
+import tempfile
+import threading
+import time
+import uuid
+import warnings
 
 import altair as alt
 import numpy as np
@@ -9,6 +15,32 @@ import pandas as pd
 
 import streamlit as st
 
+from utils.westgard_rules import (
+    WestgardResult,
+    build_westgard_result,
+    build_westgard_results_batch,
+    extend_westgard_result,
+)
+from utils.westgard_batch import iter_westgard_pool
+from utils.qc_simulation import simulate_power
+from utils.levey_jennings import (
+    build_lj_long,
+    downsample_lj_long,
+    reduction_note,
+    short_rule_codes as extract_rule_short,
+    slice_lj_window,
+    window_bounds as lj_window_bounds,
+)
+from utils.cache import LRUCache, fingerprint
+from utils.jobs import JOB_CANCELLED, JOB_DONE, JOB_ERROR, JobLimitError, JobRunner
+from utils.statistics import (
+    ROBUST_METHODS,
+    column_stats,
+    robust_column_stats,
+    rolling_column_stats,
+    stack_columns,
+)
+
 # Optional dependencies (chỉ cần khi bật Supabase)
 try:
     from supabase import create_client  # type: ignore
@@ -81,15 +113,36 @@ def db_load_state(lab_id: str, analyte_key: str) -> dict | None:
         state = data[0].get("state")
         if not isinstance(state, dict):
             return None
-        # Restore DataFrames
-        for k in ["qc_stats", "daily_df", "summary_df", "chart_df"]:
-            if k in state and isinstance(state[k], list):
-                state[k] = _records_to_df(state[k])
-        return state
+        return _restore_state(state)
     except Exception:
         return None
 
 
+def _restore_state(state: dict) -> dict:
+    # Restore DataFrames
+    for k in ["qc_stats", "daily_df", "summary_df", "chart_df"]:
+        if k in state and isinstance(state[k], list):
+            state[k] = _records_to_df(state[k])
+    return state
+
+
+def db_load_lab_store(lab_id: str) -> dict:
+    """Load mọi xét nghiệm đã lưu của 1 labo -> store dạng iqc_multi ({} nếu chưa cấu hình DB / lỗi)."""
+    if not supabase_is_configured():
+        return {}
+    try:
+        client = _get_supabase_client()
+        resp = client.table("iqc_state").select("analyte_key,state").eq("lab_id", lab_id).execute()
+        store = {}
+        for row in getattr(resp, "data", None) or []:
+            state = row.get("state")
+            if row.get("analyte_key") and isinstance(state, dict):
+                store[row["analyte_key"]] = _restore_state(state)
+        return store
+    except Exception:
+        return {}
+
+
 def db_save_state(lab_id: str, analyte_key: str, state: dict) -> bool:
     """Upsert state về Supabase. Chỉ lưu các thành phần cần thiết."""
     if not supabase_is_configured():
@@ -638,7 +691,7 @@ def update_current_analyte_state(**kwargs):
     try:
         user = st.session_state.get("current_user")
         if user and user.get("lab_id") and supabase_is_configured():
-            db_save_state(user["lab_id"], active, cur)
+            db_save_state_background(user["lab_id"], active, cur)
     except Exception:
         pass
 
@@ -870,16 +923,13 @@ def render_top_info_cards(cfg, sigma_cat, active_rules):
 
 
 def compute_stats(values):
-    arr = np.array([v for v in values if v not in (None, "")])
-    arr = arr.astype(float) if arr.size > 0 else arr
-
-    if arr.size == 0:
-        return np.nan, np.nan, np.nan
-
-    mean = float(arr.mean())
-    sd = float(arr.std(ddof=1)) if arr.size > 1 else np.nan
-    cv = float(sd / mean * 100) if (mean != 0 and not np.isnan(sd)) else np.nan
-    return mean, sd, cv
+    """(mean, SD, CV%) của 1 mức QC; None / "" / NaN bị bỏ qua (xem column_stats)."""
+    if isinstance(values, (np.ndarray, pd.Series)) and values.dtype != object:
+        arr = np.asarray(values, dtype=float)
+    else:
+        arr = np.array([_to_float(v) for v in values], dtype=float)
+    mean, sd, cv, _ = column_stats(arr)
+    return float(mean[0]), float(sd[0]), float(cv[0])
 
 
 def compute_zscore(value, mean, sd):
@@ -892,50 +942,82 @@ def compute_zscore(value, mean, sd):
         return np.nan
 
 
-def extract_rule_short(text):
-    if not isinstance(text, str) or not text.strip():
-        return ""
-    codes = []
-    for part in text.split(";"):
-        part = part.strip()
-        if not part:
-            continue
-        token = part.split()[0]
-        if token not in codes:
-            codes.append(token)
-    return ", ".join(codes)
+# Lựa chọn SD để tính z-score (trang 2) -> cột tương ứng trong qc_stats
+SD_MODES = {"SD thực nghiệm": "SD_empirical", "SD theo CVh": "SD_from_CVh"}
+DEFAULT_SD_MODE = "SD theo CVh"
 
 
-def create_levey_jennings_chart(df_long, title):
-    if df_long.empty:
-        return None
+def control_mean_sd(qc_stats, sd_mode=DEFAULT_SD_MODE):
+    """Trả về (mean_dict, sd_dict) theo Control từ bảng qc_stats của trang 1."""
+    if qc_stats is None or qc_stats.empty:
+        return {}, {}
+    ctrls = qc_stats["Control"].tolist()
+    mean_dict = dict(zip(ctrls, qc_stats["Mean_X"].tolist()))
+    sd_dict = dict(zip(ctrls, qc_stats[SD_MODES[sd_mode]].tolist()))
+    return mean_dict, sd_dict
 
-    df = df_long.copy()
-    df["z_clip"] = df["z_score"].clip(-3, 3)
-    df["shape"] = np.where(df["z_score"].abs() > 3, "square", "circle")
 
-    base = alt.Chart(df).encode(
-        x=alt.X("Run:O", title="Ngày / Lần"),
-        y=alt.Y("z_clip:Q", title="Z-score"),
-    )
+def _to_float(value):
+    """float(value); None, "" hoặc giá trị không đổi được -> NaN (như compute_zscore)."""
+    if value is None or (isinstance(value, str) and value == ""):
+        return np.nan
+    try:
+        return float(value)
+    except Exception:
+        return np.nan
 
-    lines = base.mark_line().encode(
-        color=alt.Color("Control:N", title="Mức QC"),
-        detail="Control:N",
-    )
 
-    points = base.mark_point(filled=True, size=70).encode(
-        color=alt.Color("Control:N", title="Mức QC"),
-        shape=alt.Shape("shape:N", legend=None),
-        tooltip=[
-            "Run",
-            "Control",
-            alt.Tooltip("z_score:Q", format=".4f", title="z-score"),
-            "point_status",
-            "rule_codes",
-        ],
+def _column_to_float(col):
+    """Cột kết quả -> mảng float; cột số chuyển thẳng, cột object đổi từng ô."""
+    if pd.api.types.is_numeric_dtype(col.dtype):
+        return col.to_numpy(dtype=float, na_value=np.nan)
+    return np.fromiter((_to_float(v) for v in col), dtype=float, count=len(col))
+
+
+def control_matrix(df, num_levels):
+    """Các cột Ctrl 1..n của df -> ma trận float (n_rows, num_levels); thiếu cột / ô không phải số -> NaN."""
+    X = np.full((len(df), num_levels), np.nan)
+    for j in range(num_levels):
+        ctrl = f"Ctrl {j + 1}"
+        if ctrl in df.columns:
+            X[:, j] = _column_to_float(df[ctrl])
+    return X
+
+
+def compute_zscore_matrix(values, means, sds):
+    """
+    z = (X - mean) / SD cho cả ma trận (n_runs, n_levels) trong 1 phép broadcast.
+    Mức có SD None / 0 / NaN (hoặc mean không hợp lệ) -> cả cột NaN.
+    """
+    X = np.asarray(values, dtype=float)
+    m = np.array([_to_float(v) for v in means], dtype=float)
+    sd = np.array([_to_float(v) for v in sds], dtype=float)
+    bad = (sd == 0) | np.isnan(sd)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Z = (X - m) / np.where(bad, np.nan, sd)
+    return Z
+
+
+def compute_zscore_frame(daily_df, mean_dict, sd_dict, num_levels):
+    """
+    Dựng z_df ("Ngày/Lần", "z_Ctrl 1..n") từ daily_df và Mean/SD theo Control.
+    Ô trống (None, ""), không phải số, hoặc thiếu cột Ctrl -> NaN.
+    """
+    ctrls = [f"Ctrl {i}" for i in range(1, num_levels + 1)]
+    X = control_matrix(daily_df, num_levels)
+    Z = compute_zscore_matrix(
+        X,
+        [mean_dict.get(c, np.nan) for c in ctrls],
+        [sd_dict.get(c, np.nan) for c in ctrls],
+    )
+    return pd.DataFrame(
+        {"Ngày/Lần": daily_df["Ngày/Lần"], **{f"z_{c}": Z[:, j] for j, c in enumerate(ctrls)}}
     )
 
+
+@st.cache_resource
+def _lj_static_layers():
+    """Các lớp tĩnh của biểu đồ LJ (đường 0 / ±1 / ±2 / ±3 SD, nhãn, ±3.5): dựng 1 lần / process."""
     rules_data = pd.DataFrame(
         {
             "y": [0, 1, -1, 2, -2, 3, -3],
@@ -959,6 +1041,52 @@ def create_levey_jennings_chart(df_long, title):
     ext_rules = alt.Chart(ext_rules_data).mark_rule(
         strokeDash=[4, 4], color="black"
     ).encode(y="y:Q")
+    return rules + text_labels + ext_rules
+
+
+# Ngân sách điểm mặc định khi rút gọn biểu đồ LJ (LTTB, luôn giữ điểm vi phạm / |z| > 3)
+LJ_MAX_POINTS = int(os.environ.get("IQC_LJ_MAX_POINTS", "1500"))
+
+
+def create_levey_jennings_chart(df_long, title, max_points=None):
+    """
+    max_points: nếu số điểm vượt ngân sách thì rút gọn bằng downsample_lj_long
+    (giữ mọi điểm cảnh báo / vi phạm và |z| > 3); tiêu đề ghi tỉ lệ rút gọn.
+    """
+    if df_long.empty:
+        return None
+
+    df, total = downsample_lj_long(df_long, max_points)
+    reduced = len(df) < total
+    title = f"{title}{reduction_note(len(df), total)}"
+
+    df = df.copy()
+    df["z_clip"] = df["z_score"].clip(-3, 3)
+    df["shape"] = np.where(df["z_score"].abs() > 3, "square", "circle")
+
+    # Khi đã rút gọn, trục run dạng số để giữ đúng khoảng cách giữa các điểm còn lại
+    x_type = "Q" if reduced and pd.api.types.is_numeric_dtype(df["Run"]) else "O"
+    base = alt.Chart(df).encode(
+        x=alt.X(f"Run:{x_type}", title="Ngày / Lần"),
+        y=alt.Y("z_clip:Q", title="Z-score"),
+    )
+
+    lines = base.mark_line().encode(
+        color=alt.Color("Control:N", title="Mức QC"),
+        detail="Control:N",
+    )
+
+    points = base.mark_point(filled=True, size=70).encode(
+        color=alt.Color("Control:N", title="Mức QC"),
+        shape=alt.Shape("shape:N", legend=None),
+        tooltip=[
+            "Run",
+            "Control",
+            alt.Tooltip("z_score:Q", format=".4f", title="z-score"),
+            "point_status",
+            "rule_codes",
+        ],
+    )
 
     viol_points = base.transform_filter(
         "datum.point_status != 'Đạt'"
@@ -974,7 +1102,7 @@ def create_levey_jennings_chart(df_long, title):
 
     t = get_theme()
     chart = (
-        rules + text_labels + ext_rules + lines + points + viol_points + viol_text
+        _lj_static_layers() + lines + points + viol_points + viol_text
     ).properties(title=title, height=400, background=t.get("chartBg", "#FFFDF7"))
 
     chart = (
@@ -994,6 +1122,42 @@ def create_levey_jennings_chart(df_long, title):
     return chart
 
 
+# Biểu đồ Altair LJ đã dựng sẵn, dùng chung cho mọi phiên
+LJ_CHART_CACHE_SIZE = int(os.environ.get("IQC_LJ_CHART_CACHE_SIZE", "64"))
+
+
+@st.cache_resource
+def _lj_chart_cache() -> LRUCache:
+    """Cache biểu đồ LJ (1 / process server)."""
+    return LRUCache(maxsize=LJ_CHART_CACHE_SIZE)
+
+
+def lj_chart_cache_info() -> dict:
+    """Số hit / miss / kích thước hiện tại của cache biểu đồ LJ."""
+    return _lj_chart_cache().info()
+
+
+def cached_levey_jennings_chart(df_long, title, max_points=None):
+    """
+    create_levey_jennings_chart, cache theo dấu vân tay nội dung df_long + tiêu đề +
+    ngân sách điểm + theme. Rerun không đổi dữ liệu bỏ qua việc rút gọn điểm và dựng
+    chart Altair. Vẽ bằng st.altair_chart (chỉ đọc chart) -> coi kết quả là chỉ đọc.
+    """
+    if df_long.empty:
+        return None
+    theme = get_theme()
+    key = fingerprint(
+        pd.util.hash_pandas_object(df_long, index=True).to_numpy(),
+        list(df_long.columns),
+        title,
+        max_points,
+        sorted(theme.items()),
+    )
+    return _lj_chart_cache().get_or_compute(
+        key, lambda: create_levey_jennings_chart(df_long, title, max_points=max_points)
+    )
+
+
 def get_sigma_category_and_rules(sigma, num_levels):
     if sigma is None or (isinstance(sigma, float) and math.isnan(sigma)) or sigma == 0:
         cat = "<4"
@@ -1031,11 +1195,460 @@ def get_sigma_category_and_rules(sigma, num_levels):
     return cat, rules
 
 
-def evaluate_westgard(z_df, num_levels, sigma):
+# Engine đánh giá Westgard: "numpy" (vector hoá) hoặc "legacy" (vòng lặp gốc).
+# "crosscheck" chạy cả hai và cảnh báo nếu kết quả lệch (dùng khi đối chiếu trên production).
+WESTGARD_ENGINES = ("numpy", "legacy", "crosscheck")
+WESTGARD_ENGINE = os.environ.get("IQC_WESTGARD_ENGINE", "numpy")
+# Tăng khi đổi logic quy tắc / thông điệp để vô hiệu hoá cache kết quả cũ.
+WESTGARD_ENGINE_VERSION = "1"
+WESTGARD_CACHE_SIZE = int(os.environ.get("IQC_WESTGARD_CACHE_SIZE", "256"))
+# Từ bấy nhiêu xét nghiệm trở lên, đánh giá lại cuối tháng chạy bằng process pool thay vì lô 3-D 1 process
+WESTGARD_POOL_MIN_ANALYTES = int(os.environ.get("IQC_WESTGARD_POOL_MIN_ANALYTES", "64"))
+
+
+@st.cache_resource
+def _westgard_result_cache() -> LRUCache:
+    """Cache kết quả Westgard dùng chung cho mọi phiên (1 / process server)."""
+    return LRUCache(maxsize=WESTGARD_CACHE_SIZE)
+
+
+def westgard_cache_info() -> dict:
+    """Số hit / miss / kích thước hiện tại của cache kết quả Westgard."""
+    return _westgard_result_cache().info()
+
+
+def _z_matrix(z_df):
+    """Trả về (runs, Z) với các cột z_Ctrl sắp theo số mức."""
     runs = z_df["Ngày/Lần"].tolist()
     z_cols = [c for c in z_df.columns if c.startswith("z_Ctrl")]
     z_cols = sorted(z_cols, key=lambda x: int(x.split("Ctrl ")[1]))
     Z = z_df[z_cols].to_numpy(dtype=float)
+    return runs, Z
+
+
+# Sigma đại diện cho từng nhóm (để lấy bộ quy tắc khi mô phỏng)
+SIGMA_CATEGORY_REPR = {"6": 6.0, "5": 5.0, "4": 4.0, "<4": 3.0}
+
+
+def simulate_rule_power(num_levels, sigma=None, n_sims=20000, patients_per_run=100,
+                        workers=1, seed=0, **kwargs):
+    """
+    Mô phỏng Ped / Pfr / E_Nuf cho các bộ quy tắc theo nhóm sigma (6, 5, 4, <4)
+    của get_sigma_category_and_rules. sigma (nếu có) dùng làm TEa theo SD cho E_Nuf.
+    kwargs khác (se_grid, re_grid, post_runs, chunk_size, on_progress) chuyển cho simulate_power.
+    """
+    rule_sets = {}
+    for cat, rep in SIGMA_CATEGORY_REPR.items():
+        _, rules = get_sigma_category_and_rules(rep, num_levels)
+        rule_sets[f"{cat}-sigma: {', '.join(sorted(rules))}"] = rules
+    tea = float(sigma) if sigma else None
+    return simulate_power(
+        rule_sets,
+        num_levels,
+        n_sims=n_sims,
+        patients_per_run=patients_per_run,
+        tea=tea,
+        workers=workers,
+        seed=seed,
+        **kwargs,
+    )
+
+
+def evaluate_westgard(z_df, num_levels, sigma, engine=None):
+    """
+    Đánh giá Westgard theo sigma.
+    engine: None (dùng WESTGARD_ENGINE), "numpy", "legacy" hoặc "crosscheck".
+    Trả về (sigma_cat, active_rules, summary_df, point_df).
+    """
+    engine = _check_engine(engine)
+    if engine == "legacy":
+        return _evaluate_westgard_legacy(z_df, num_levels, sigma)
+
+    result = evaluate_westgard_result(z_df, num_levels, sigma, engine=engine)
+    # Kết quả có thể đến từ cache dùng chung -> trả bản sao để người gọi sửa thoải mái
+    return result.sigma_cat, set(result.active_rules), result.summary_df.copy(), result.point_df.copy()
+
+
+def _check_engine(engine):
+    engine = engine or WESTGARD_ENGINE
+    if engine not in WESTGARD_ENGINES:
+        raise ValueError(f"Unknown Westgard engine: {engine!r} (expected one of {WESTGARD_ENGINES})")
+    return engine
+
+
+def evaluate_westgard_result(z_df, num_levels, sigma, engine=None, use_cache=True, previous=None) -> WestgardResult:
+    """
+    Đánh giá Westgard và trả về WestgardResult dạng cột:
+    mask bit theo điểm; summary_df / point_df chỉ dựng khi truy cập.
+    Với engine "legacy"/"crosscheck", bảng thông điệp lấy từ engine gốc.
+
+    previous (tuỳ chọn): kết quả lần đánh giá trước của cùng xét nghiệm. Nếu z_df chỉ
+    nối thêm run vào cuối (run cũ không đổi, cùng bộ quy tắc) thì chỉ các run mới được
+    đánh giá qua WestgardStream; sửa / xoá run -> đánh giá lại toàn bộ.
+
+    Kết quả được nhớ theo nội dung (hash z + Ngày/Lần + nhóm sigma/bộ quy tắc + engine),
+    dùng chung giữa các lần rerun và các phiên -> coi kết quả là chỉ đọc.
+    """
+    engine = _check_engine(engine)
+    sigma_cat, active_rules = get_sigma_category_and_rules(sigma, num_levels)
+    runs, Z = _z_matrix(z_df)
+
+    def compute():
+        if engine == "numpy" and _is_append(previous, runs, Z, active_rules):
+            return extend_westgard_result(previous, Z, runs)
+        return _evaluate_westgard_uncached(z_df, runs, Z, num_levels, sigma, sigma_cat, active_rules, engine)
+
+    if not use_cache:
+        return compute()
+    key = fingerprint(
+        Z, runs, num_levels, sigma_cat, tuple(sorted(active_rules)), engine, WESTGARD_ENGINE_VERSION
+    )
+    return _westgard_result_cache().get_or_compute(key, compute)
+
+
+def _is_append(previous, runs, Z, active_rules):
+    """True nếu (runs, Z) = lịch sử của previous (giữ nguyên) + ít nhất 1 run mới ở cuối."""
+    if not isinstance(previous, WestgardResult) or previous.active_rules != set(active_rules):
+        return False
+    n = previous.n_runs
+    return (
+        previous.n_levels == Z.shape[1]
+        and 0 < n < Z.shape[0]
+        and list(runs[:n]) == list(previous.runs)
+        and np.array_equal(Z[:n], previous.z, equal_nan=True)
+    )
+
+
+def _evaluate_westgard_uncached(z_df, runs, Z, num_levels, sigma, sigma_cat, active_rules, engine):
+    result = build_westgard_result(Z, runs, active_rules, sigma_cat)
+
+    if engine in ("legacy", "crosscheck"):
+        _, _, ref_summary, ref_point = _evaluate_westgard_legacy(z_df, num_levels, sigma)
+        if engine == "crosscheck" and not (
+            result.summary_df.equals(ref_summary) and result.point_df.equals(ref_point)
+        ):
+            warnings.warn(
+                "Westgard engine mismatch: numpy result differs from legacy; using legacy result.",
+                RuntimeWarning,
+                stacklevel=3,
+            )
+        result.use_frames(ref_summary, ref_point)
+
+    return result
+
+
+def _state_z_df(state, num_levels):
+    """z_df từ daily_df + qc_stats của 1 state (SD theo sd_mode đã chọn ở trang 2)."""
+    daily_df, qc_stats = state.get("daily_df"), state.get("qc_stats")
+    if not isinstance(daily_df, pd.DataFrame) or not isinstance(qc_stats, pd.DataFrame):
+        return None
+    if daily_df.empty or qc_stats.empty or "Ngày/Lần" not in daily_df.columns:
+        return None
+    mean_dict, sd_dict = control_mean_sd(qc_stats, state.get("sd_mode", DEFAULT_SD_MODE))
+    return compute_zscore_frame(daily_df, mean_dict, sd_dict, num_levels)
+
+
+def _westgard_jobs(store, key_prefix=None):
+    """Dựng job (key, Z, runs, active_rules, sigma_cat) cho các xét nghiệm có z_df (hoặc daily_df + qc_stats)."""
+    for name, state in store.items():
+        state = state or {}
+        cfg = state.get("config", {})
+        z_df = state.get("z_df")
+        if not isinstance(z_df, pd.DataFrame):
+            # State nạp từ DB không có z_df -> tính lại từ daily_df + qc_stats
+            z_df = _state_z_df(state, cfg.get("num_levels", 2))
+        if not isinstance(z_df, pd.DataFrame) or z_df.empty:
+            continue
+        sigma_cat, active_rules = get_sigma_category_and_rules(
+            cfg.get("sigma_value", 6.0), cfg.get("num_levels", 2)
+        )
+        runs, Z = _z_matrix(z_df)
+        key = name if key_prefix is None else (key_prefix, name)
+        yield key, Z, runs, active_rules, sigma_cat
+
+
+def evaluate_westgard_store(store=None) -> dict:
+    """
+    Đánh giá Westgard cho mọi xét nghiệm trong store (mặc định
+    st.session_state["iqc_multi"]) trong 1 lượt vector hoá 3-D.
+    Trả về {tên xét nghiệm: WestgardResult}; bỏ qua xét nghiệm chưa có z_df.
+    """
+    if store is None:
+        store = st.session_state.get("iqc_multi", {})
+
+    jobs = list(_westgard_jobs(store))
+    results = build_westgard_results_batch(
+        [j[1] for j in jobs], [j[2] for j in jobs], [j[3] for j in jobs], [j[4] for j in jobs]
+    )
+    return {j[0]: r for j, r in zip(jobs, results)}
+
+
+def reevaluate_westgard_labs(stores: dict, workers=None, on_progress=None):
+    """
+    Đánh giá lại Westgard cho mọi xét nghiệm của nhiều labo (vd sau khi đổi sigma).
+    stores: {lab_id: store dạng iqc_multi}. Chạy song song bằng process pool
+    (z gửi qua shared memory), yield ((lab_id, tên xét nghiệm), WestgardResult)
+    ngay khi từng shard xong; on_progress nhận BatchProgress (có .rate = xét nghiệm/giây).
+    """
+    jobs = [job for lab_id, store in stores.items() for job in _westgard_jobs(store, lab_id)]
+    yield from iter_westgard_pool(jobs, workers=workers, on_progress=on_progress)
+
+
+def _z_frame(runs, Z):
+    return pd.DataFrame({"Ngày/Lần": list(runs), **{f"z_Ctrl {i + 1}": Z[:, i] for i in range(Z.shape[1])}})
+
+
+def lj_png_jobs(stores: dict, max_points=None, evaluated=None):
+    """
+    Job xuất PNG Levey–Jennings cho mọi xét nghiệm của nhiều labo (generator: z_df / df_long
+    của mỗi xét nghiệm chỉ được dựng khi pool lấy job đó).
+    stores: {lab_id: store dạng iqc_multi}. Westgard đánh giá theo lô 3-D cho từng labo
+    (evaluated: kết quả _month_end_evaluate đã có sẵn); file đặt tại "<lab_id>/<tên xét nghiệm>.png".
+    """
+    from export.batch_lj_png import LJPngJob, safe_filename
+
+    if evaluated is None:
+        evaluated = _month_end_evaluate(stores)
+    for lab_id, store in stores.items():
+        lab_evaluated = evaluated.get(lab_id, {})
+        for name, state in store.items():
+            if name not in lab_evaluated:
+                continue
+            runs, Z, result = lab_evaluated[name]
+            cfg = (state or {}).get("config", {})
+            z_df = _z_frame(runs, Z)
+            yield LJPngJob(
+                key=(lab_id, name),
+                filename=f"{safe_filename(lab_id)}/{safe_filename(name)}.png",
+                z_df=z_df,
+                df_long=build_lj_long(z_df, westgard_result=result),
+                title=f"{cfg.get('test_name') or name} – Levey–Jennings (Z-score)",
+                max_points=max_points,
+            )
+
+
+def export_lj_png_labs(stores: dict, fileobj, workers=None, on_progress=None, max_points=None):
+    """
+    PNG Levey–Jennings cho mọi xét nghiệm / mọi labo vào 1 ZIP ghi luồng (process pool) + timing.csv.
+    Trả về list ChartResult (thời gian từng biểu đồ, lỗi nếu có — lỗi không dừng cả lô).
+    """
+    from export.batch_lj_png import write_lj_png_zip
+
+    evaluated = _month_end_evaluate(stores, workers)
+    return write_lj_png_zip(
+        lj_png_jobs(stores, max_points, evaluated), fileobj,
+        workers=workers, on_progress=on_progress, total=sum(len(v) for v in evaluated.values()),
+    )
+
+
+def report_meta(cfg: dict):
+    """ReportMeta từ config xét nghiệm (ô trống -> giữ placeholder {{...}} của mẫu)."""
+    from export.word_reports import ReportMeta
+
+    meta = ReportMeta(
+        ten_xet_nghiem=cfg.get("test_name", ""),
+        thiet_bi_phuong_phap=f'{cfg.get("device", "")} / {cfg.get("method", "")}'.strip(" /"),
+        lo_qc_han_dung=f'Lô: {cfg.get("qc_lot", "")}  |  HSD: {cfg.get("qc_expiry", "")}'.strip(),
+        thang_nam=cfg.get("report_period", ""),
+    )
+    if cfg.get("don_vi"):
+        meta.don_vi = cfg["don_vi"]
+    if cfg.get("phien_ban"):
+        meta.phien_ban = f"Phiên bản: {cfg['phien_ban']}"
+    if cfg.get("ngay_hieu_luc"):
+        meta.ngay_hieu_luc = f"Ngày hiệu lực: {cfg['ngay_hieu_luc']}"
+    return meta
+
+
+def _state_people(state):
+    """Cột 'Người thực hiện' đã ghi tay (từ summary_df đã lưu) để ghép vào kết quả đánh giá lại."""
+    summary_df = state.get("summary_df")
+    if not isinstance(summary_df, pd.DataFrame) or not {"Ngày/Lần", "Người thực hiện"} <= set(summary_df.columns):
+        return None
+    people = summary_df.drop_duplicates("Ngày/Lần")
+    return pd.Series(people["Người thực hiện"].to_numpy(), index=people["Ngày/Lần"].astype(str))
+
+
+def _month_end_evaluate(stores: dict, workers=None) -> dict:
+    """
+    {lab_id: {tên xét nghiệm: (runs, Z, WestgardResult)}}: Westgard đánh giá theo lô 3-D cho từng labo.
+    workers > 1 và tổng số xét nghiệm >= WESTGARD_POOL_MIN_ANALYTES (vd dữ liệu đã lưu của nhiều labo)
+    -> đánh giá lại bằng process pool (reevaluate_westgard_labs).
+    """
+    out = {lab_id: {} for lab_id in stores}
+    n_analytes = sum(len(store) for store in stores.values())
+    if workers and int(workers) > 1 and n_analytes >= WESTGARD_POOL_MIN_ANALYTES:
+        for (lab_id, name), result in reevaluate_westgard_labs(stores, workers=workers):
+            out[lab_id][name] = (result.runs, result.z, result)
+        return out
+    for lab_id, store in stores.items():
+        wg_jobs = list(_westgard_jobs(store, lab_id))
+        results = build_westgard_results_batch(
+            [j[1] for j in wg_jobs], [j[2] for j in wg_jobs], [j[3] for j in wg_jobs], [j[4] for j in wg_jobs]
+        )
+        out[lab_id] = {j[0][1]: (j[2], j[1], r) for j, r in zip(wg_jobs, results)}
+    return out
+
+
+def _month_end_kinds(state: dict, evaluated: bool, kinds) -> list:
+    """Các loại báo cáo xuất được cho 1 xét nghiệm (evaluated: đã có kết quả Westgard)."""
+    daily_df = state.get("daily_df")
+    qc_stats = state.get("qc_stats")
+    out = []
+    if evaluated and "so_gn_dg" in kinds:
+        out.append("so_gn_dg")
+    if evaluated and "xlsx" in kinds and isinstance(daily_df, pd.DataFrame) and not daily_df.empty:
+        out.append("xlsx")
+    if "cstk" in kinds and isinstance(qc_stats, pd.DataFrame) and not qc_stats.empty:
+        out.append("cstk")
+    return out
+
+
+def month_end_report_jobs(stores: dict, kinds=("so_gn_dg", "xlsx", "cstk"), evaluated=None):
+    """
+    Job dựng báo cáo cuối tháng cho mọi xét nghiệm của nhiều labo.
+    stores: {lab_id: store dạng iqc_multi}. Westgard đánh giá theo lô 3-D cho từng labo
+    (evaluated: kết quả _month_end_evaluate đã có sẵn).
+    kinds: "so_gn_dg" (Sổ ghi nhận & đánh giá .docx), "xlsx" (Sổ theo dõi KQ NK, cần daily_df),
+    "cstk" (Phiếu thiết lập CSTK, cần qc_stats). File đặt tại "<lab_id>/<tên file như trên trang>";
+    2 xét nghiệm trùng tên hiển thị -> thêm khoá xét nghiệm (và số thứ tự nếu vẫn trùng).
+    """
+    from export.batch_lj_png import safe_filename
+    from export.batch_reports import REPORT_KINDS, ReportJob
+
+    def job(lab_id, name, title, kind, suffix, used, **kwargs):
+        prefix, ext = REPORT_KINDS[kind]
+        base = f"{safe_filename(lab_id)}/{safe_filename(f'{prefix}{suffix}_{title}')}"
+        filename = f"{base}{ext}"
+        if filename in used:
+            base = f"{base}_{safe_filename(name)}"
+            filename, k = f"{base}{ext}", 2
+            while filename in used:
+                filename, k = f"{base}_{k}{ext}", k + 1
+        used.add(filename)
+        return ReportJob(key=(lab_id, name, kind), filename=filename, kind=kind, kwargs=kwargs)
+
+    if evaluated is None:
+        evaluated = _month_end_evaluate(stores)
+    for lab_id, store in stores.items():
+        lab_evaluated = evaluated.get(lab_id, {})
+        used = set()
+        for name, state in store.items():
+            state = state or {}
+            lab_kinds = _month_end_kinds(state, name in lab_evaluated, kinds)
+            if not lab_kinds:
+                continue
+            cfg = state.get("config", {})
+            num_levels = int(cfg.get("num_levels", 2))
+            meta = report_meta(cfg)
+            title = cfg.get("test_name") or name
+
+            if name in lab_evaluated:
+                runs, Z, result = lab_evaluated[name]
+                z_df = _z_frame(runs, Z)
+                summary_df = result.summary_df.copy()
+                people = _state_people(state)
+                if people is not None:
+                    summary_df["Người thực hiện"] = (
+                        summary_df["Ngày/Lần"].astype(str).map(people).fillna("").to_numpy()
+                    )
+                if "so_gn_dg" in lab_kinds:
+                    yield job(lab_id, name, title, "so_gn_dg", f"_{num_levels}muc", used,
+                              meta=meta, export_df=summary_df, z_df=z_df, point_df=result.point_df,
+                              num_levels=num_levels, westgard_result=result,
+                              df_long=build_lj_long(z_df, westgard_result=result))
+                if "xlsx" in lab_kinds:
+                    export_df = _stage_export_df(state["daily_df"], z_df, summary_df, num_levels)
+                    yield job(lab_id, name, title, "xlsx", "", used, df=export_df)
+
+            if "cstk" in lab_kinds:
+                robust_method = state.get("robust_method", "none")
+                exclusions = state.get("baseline_exclusions")
+                if isinstance(exclusions, list):
+                    exclusions = _records_to_df(exclusions)
+                yield job(lab_id, name, title, "cstk", "", used,
+                          meta=meta, stats_df=state["qc_stats"], raw_df=None, num_levels=num_levels,
+                          exclusions=exclusions if robust_method != "none" else None,
+                          method_label=ROBUST_METHODS.get(robust_method, robust_method))
+
+
+def export_month_end_labs(stores: dict, fileobj, workers=None, on_progress=None, kinds=("so_gn_dg", "xlsx", "cstk")):
+    """
+    Báo cáo cuối tháng (Sổ ghi nhận .docx, Sổ theo dõi .xlsx, Phiếu CSTK .docx) cho mọi xét nghiệm /
+    mọi labo vào 1 ZIP ghi luồng (process pool) + timing.csv.
+    Trả về list ReportResult (thời gian từng file, lỗi nếu có — lỗi không dừng cả lô).
+    """
+    from export.batch_reports import write_report_zip
+
+    evaluated = _month_end_evaluate(stores, workers)
+    total = sum(
+        len(_month_end_kinds(state or {}, name in evaluated[lab_id], kinds))
+        for lab_id, store in stores.items()
+        for name, state in store.items()
+    )
+    return write_report_zip(
+        month_end_report_jobs(stores, kinds, evaluated), fileobj,
+        workers=workers, on_progress=on_progress, total=total,
+    )
+
+
+# ZIP cuối tháng tạo ở job nền được giữ trên đĩa bấy nhiêu giây (như job đã xong trong JobRunner)
+MONTH_END_ZIP_PREFIX = "iqc_month_end_"
+MONTH_END_ZIP_KEEP_SECONDS = 1800
+
+
+def _sweep_month_end_zips():
+    """Xoá các ZIP cuối tháng cũ (phiên đã đóng / job đã bị bỏ) trong thư mục tạm."""
+    cutoff = time.time() - MONTH_END_ZIP_KEEP_SECONDS
+    tmp_dir = tempfile.gettempdir()
+    for name in os.listdir(tmp_dir):
+        if not name.startswith(MONTH_END_ZIP_PREFIX):
+            continue
+        path = os.path.join(tmp_dir, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _export_zip_file(export, stores: dict, **kwargs):
+    """
+    Chạy export(stores, fileobj, **kwargs) ghi ZIP ra file tạm trên đĩa (dùng trong job nền; trang
+    phục vụ file từ đĩa). Store None -> nạp dữ liệu đã lưu của labo từ DB ngay trong job.
+    Trả về (đường dẫn ZIP, kết quả của export); lỗi / huỷ giữa chừng -> xoá file.
+    """
+    _sweep_month_end_zips()
+    stores = {lab_id: db_load_lab_store(lab_id) if store is None else store for lab_id, store in stores.items()}
+    fd, path = tempfile.mkstemp(prefix=MONTH_END_ZIP_PREFIX, suffix=".zip")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            results = export(stores, f, **kwargs)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, results
+
+
+def export_month_end_zip(stores: dict, workers=None, on_progress=None, kinds=("so_gn_dg", "xlsx", "cstk")):
+    """Như export_month_end_labs nhưng ghi ZIP ra file tạm; trả về (đường dẫn ZIP, list ReportResult)."""
+    return _export_zip_file(export_month_end_labs, stores, workers=workers, on_progress=on_progress, kinds=kinds)
+
+
+def export_lj_png_zip(stores: dict, workers=None, on_progress=None, max_points=None):
+    """Như export_lj_png_labs nhưng ghi ZIP ra file tạm; trả về (đường dẫn ZIP, list ChartResult)."""
+    return _export_zip_file(export_lj_png_labs, stores, workers=workers, on_progress=on_progress,
+                            max_points=max_points)
+
+
+def read_file_bytes(path) -> bytes:
+    """Đọc file (dùng làm data trì hoãn của st.download_button: chỉ đọc khi người dùng bấm tải)."""
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _evaluate_westgard_legacy(z_df, num_levels, sigma):
+    runs, Z = _z_matrix(z_df)
     n_runs, n_levels = Z.shape
 
     sigma_cat, active_rules = get_sigma_category_and_rules(sigma, num_levels)
@@ -1317,3 +1930,470 @@ def evaluate_westgard(z_df, num_levels, sigma):
     point_df = pd.DataFrame(point_rows)
 
     return sigma_cat, active_rules, summary_df, point_df
+
+
+# =====================================================
+# PIPELINE THEO XÉT NGHIỆM (chỉ tính lại stage có đầu vào đổi)
+# =====================================================
+
+
+def sd_from_cvh(mean, cvh):
+    """SD theo CV% mục tiêu: Mean x CVh / 100 (NaN nếu chưa có Mean)."""
+    return mean * cvh / 100.0 if not np.isnan(mean) else np.nan
+
+
+def _value_fingerprint(value):
+    """Fingerprint nội dung cho đầu vào pipeline (DataFrame hash theo cột, còn lại theo repr)."""
+    if isinstance(value, pd.DataFrame):
+        try:
+            hashed = pd.util.hash_pandas_object(value, index=True).to_numpy()
+        except TypeError:
+            hashed = value.to_json(orient="split", default_handler=str)
+        return fingerprint(list(value.columns), [str(t) for t in value.dtypes], hashed)
+    if isinstance(value, dict):
+        return fingerprint(sorted(value.items(), key=lambda kv: str(kv[0])))
+    return fingerprint(value)
+
+
+def _stats_frame(mean, sd, cv, n, controls):
+    return pd.DataFrame(
+        {"Control": controls, "Mean_X": mean, "SD_empirical": sd, "CV_empirical_%": cv, "n": n}
+    )
+
+
+def baseline_exclusions_frame(X, excluded, method):
+    """Bảng các điểm thiết lập bị loại: Control, Lần đo (1-based), Giá trị, Tiêu chí."""
+    rows, cols = np.nonzero(excluded)
+    return pd.DataFrame(
+        {
+            "Control": [f"Ctrl {j + 1}" for j in cols],
+            "Lần đo": rows + 1,
+            "Giá trị": X[rows, cols],
+            "Tiêu chí": ROBUST_METHODS.get(method, method),
+        }
+    )
+
+
+def _stage_baseline_screen(baseline_df, num_levels, robust_method):
+    X = control_matrix(baseline_df, num_levels)
+    mean, sd, cv, n, excluded = robust_column_stats(X, robust_method)
+    return {
+        "stats": _stats_frame(mean, sd, cv, n, [f"Ctrl {i}" for i in range(1, num_levels + 1)]),
+        "excluded": baseline_exclusions_frame(X, excluded, robust_method),
+    }
+
+
+def _stage_baseline_stats(baseline_screen):
+    return baseline_screen["stats"]
+
+
+def _stage_baseline_exclusions(baseline_screen):
+    return baseline_screen["excluded"]
+
+
+def baseline_stats_store(store=None, robust_method=None) -> pd.DataFrame:
+    """
+    Mean / SD / CV% / n của mọi mức QC, mọi xét nghiệm trong store (mặc định
+    st.session_state["iqc_multi"]) trong 1 lượt: các baseline_df được ghép thành
+    khối 3-D đệm NaN. Trả về bảng dài có thêm cột "Xét nghiệm".
+    robust_method: None -> theo "robust_method" đã chọn của từng xét nghiệm
+    (các xét nghiệm cùng phương pháp được tính chung 1 lượt).
+    """
+    if store is None:
+        store = st.session_state.get("iqc_multi", {})
+    names, mats, methods = [], [], []
+    for name, state in store.items():
+        baseline_df = (state or {}).get("baseline_df")
+        if not isinstance(baseline_df, pd.DataFrame) or baseline_df.empty:
+            continue
+        num_levels = (state.get("config") or {}).get("num_levels", 2)
+        names.append(name)
+        mats.append(control_matrix(baseline_df, num_levels))
+        methods.append(robust_method or state.get("robust_method", "none"))
+    if not mats:
+        return pd.DataFrame(columns=["Xét nghiệm", "Control", "Mean_X", "SD_empirical", "CV_empirical_%", "n"])
+
+    frames = [None] * len(names)
+    for method in dict.fromkeys(methods):
+        idx = [a for a, m in enumerate(methods) if m == method]
+        mean, sd, cv, n, _ = robust_column_stats(stack_columns([mats[a] for a in idx]), method)
+        for k, a in enumerate(idx):
+            L = mats[a].shape[1]
+            df = _stats_frame(mean[k, :L], sd[k, :L], cv[k, :L], n[k, :L], [f"Ctrl {i}" for i in range(1, L + 1)])
+            df.insert(0, "Xét nghiệm", names[a])
+            frames[a] = df
+    return pd.concat(frames, ignore_index=True)
+
+
+# Cột thông tin của bảng IQC hằng ngày (trang 2) dùng để nhóm run theo tháng / lô khi thiết lập lại Mean/SD
+DAILY_INFO_COLUMNS = ["Ngày", "Lô QC"]
+
+# Cách lấy dữ liệu IQC tích luỹ để thiết lập lại Mean/SD
+RETARGET_MODES = {
+    "last_n": "N lần chạy gần nhất",
+    "month": "Tháng (tính đến nay)",
+    "lot": "Lô QC (tính đến nay)",
+}
+
+
+def _retarget_groups(daily_df, mode):
+    """Mã nhóm theo run cho cửa sổ tháng / lô (ô trống thuộc nhóm của run trước); None -> cả bảng là 1 nhóm."""
+    if mode == "month" and "Ngày" in daily_df.columns:
+        dates = pd.to_datetime(daily_df["Ngày"], errors="coerce", dayfirst=True)
+        return dates.dt.to_period("M").astype(str).where(dates.notna()).ffill().fillna("").to_numpy()
+    if mode == "lot" and "Lô QC" in daily_df.columns:
+        lots = daily_df["Lô QC"].map(lambda v: "" if pd.isna(v) else str(v).strip())
+        return lots.where(lots != "").ffill().fillna("").to_numpy(dtype=object)
+    return None
+
+
+def retarget_group(daily_df, mode):
+    """Tháng / lô của lần chạy cuối ("" nếu bảng chưa ghi Ngày / Lô QC -> cả bảng là 1 nhóm)."""
+    groups = _retarget_groups(daily_df, mode)
+    return str(groups[-1]) if groups is not None and len(groups) else ""
+
+
+def propose_qc_stats(daily_df, qc_stats, num_levels, mode="last_n", window=20):
+    """
+    Đề xuất bảng qc_stats mới từ kết quả IQC hằng ngày (để người dùng xem xét):
+    - "last_n": window lần chạy gần nhất;
+    - "month": tháng của lần chạy cuối, tính đến nay (theo cột "Ngày");
+    - "lot": lô QC của lần chạy cuối, tính đến nay (theo cột "Lô QC").
+    Cột Ngày / Lô QC chưa ghi -> cả bảng là 1 nhóm.
+    Giữ CVh hiện tại (SD theo CVh tính lại từ Mean mới); kèm Mean/SD cũ để so sánh.
+    """
+    ctrls = [f"Ctrl {i}" for i in range(1, num_levels + 1)]
+    X = control_matrix(daily_df, num_levels)
+    if X.shape[0] == 0:
+        mean = sd = cv = np.full(num_levels, np.nan)
+        n = np.zeros(num_levels, dtype=int)
+    else:
+        # N run gần nhất, hoặc tích luỹ trong tháng / lô của run cuối
+        if mode == "last_n":
+            m, s, c, k = rolling_column_stats(X, window)
+        else:
+            m, s, c, k = rolling_column_stats(X, None, groups=_retarget_groups(daily_df, mode))
+        mean, sd, cv, n = m[-1], s[-1], c[-1], k[-1]
+
+    if isinstance(qc_stats, pd.DataFrame) and "Control" in qc_stats.columns:
+        cur = qc_stats.drop_duplicates("Control").set_index("Control").reindex(ctrls)
+    else:
+        cur = pd.DataFrame(index=ctrls)
+
+    def col(name):
+        return cur[name].to_numpy(dtype=float) if name in cur.columns else np.full(num_levels, np.nan)
+
+    cvh = col("CVh_target_%")
+    proposal = _stats_frame(mean, sd, cv, n, ctrls)
+    proposal["CVh_target_%"] = cvh
+    proposal["SD_from_CVh"] = [sd_from_cvh(mm, h) for mm, h in zip(mean, cvh)]
+    proposal["Mean_X_cũ"] = col("Mean_X")
+    proposal["SD_empirical_cũ"] = col("SD_empirical")
+    with np.errstate(divide="ignore", invalid="ignore"):
+        proposal["Δ Mean (%)"] = (mean - proposal["Mean_X_cũ"]) / proposal["Mean_X_cũ"] * 100.0
+    return proposal
+
+
+def _stage_qc_stats(baseline_stats, cvh):
+    stats_df = baseline_stats.copy()
+    cvh_col = [cvh.get(c, np.nan) for c in stats_df["Control"]]
+    stats_df["CVh_target_%"] = cvh_col
+    stats_df["SD_from_CVh"] = [sd_from_cvh(m, c) for m, c in zip(stats_df["Mean_X"], cvh_col)]
+    return stats_df
+
+
+def _stage_z_df(daily_df, qc_stats, sd_mode, num_levels):
+    mean_dict, sd_dict = control_mean_sd(qc_stats, sd_mode)
+    return compute_zscore_frame(daily_df, mean_dict, sd_dict, num_levels)
+
+
+def _stage_westgard(z_df, num_levels, sigma, previous=None):
+    # previous: kết quả lần trước -> nhập thêm run chỉ đánh giá run mới (WestgardStream)
+    return evaluate_westgard_result(z_df, num_levels=num_levels, sigma=sigma, previous=previous)
+
+
+def _stage_summary_df(westgard, people):
+    summary_df = westgard.summary_df
+    if people is None:
+        return summary_df.copy()
+    return summary_df.drop(columns=["Người thực hiện"]).merge(people, on="Ngày/Lần", how="left")
+
+
+def _stage_export_df(daily_df, z_df, summary_df, num_levels):
+    export_df = daily_df.copy()
+    for col in z_df.columns:
+        if col != "Ngày/Lần":
+            export_df[col] = z_df[col]
+    export_df = export_df.merge(summary_df, on="Ngày/Lần", how="left")
+
+    ctrl_cols = [f"Ctrl {i}" for i in range(1, num_levels + 1) if f"Ctrl {i}" in export_df.columns]
+    z_cols_out = [f"z_Ctrl {i}" for i in range(1, num_levels + 1) if f"z_Ctrl {i}" in export_df.columns]
+    info_cols = [c for c in DAILY_INFO_COLUMNS if c in export_df.columns]
+    tail_cols = [c for c in ["Trạng thái", "Vi phạm loại bỏ", "Người thực hiện"] if c in export_df.columns]
+    return export_df[["Ngày/Lần"] + info_cols + ctrl_cols + z_cols_out + tail_cols]
+
+
+def _stage_export_xlsx(export_df):
+    from export.batch_reports import xlsx_bytes
+
+    return xlsx_bytes(export_df, sheet_name="So theo doi KQ NK")
+
+
+def _stage_chart_df(z_df, westgard):
+    return build_lj_long(z_df, westgard_result=westgard)
+
+
+# stage -> (các đầu vào / stage phía trên, hàm tính)
+PIPELINE_STAGES = {
+    "baseline_screen": (("baseline_df", "num_levels", "robust_method"), _stage_baseline_screen),
+    "baseline_stats": (("baseline_screen",), _stage_baseline_stats),
+    "baseline_exclusions": (("baseline_screen",), _stage_baseline_exclusions),
+    "qc_stats": (("baseline_stats", "cvh"), _stage_qc_stats),
+    "z_df": (("daily_df", "qc_stats", "sd_mode", "num_levels"), _stage_z_df),
+    "westgard": (("z_df", "num_levels", "sigma"), _stage_westgard),
+    "summary_df": (("westgard", "people"), _stage_summary_df),
+    "export_df": (("daily_df", "z_df", "summary_df", "num_levels"), _stage_export_df),
+    "export_xlsx": (("export_df",), _stage_export_xlsx),
+    "chart_df": (("z_df", "westgard"), _stage_chart_df),
+}
+
+# stage nhận thêm giá trị lần tính trước (previous=...) để tính tăng dần
+INCREMENTAL_STAGES = {"westgard"}
+
+
+class MissingInput(KeyError):
+    """Đầu vào pipeline chưa được set (khác với KeyError phát sinh bên trong hàm stage)."""
+
+
+class AnalytePipeline:
+    """
+    Chuỗi tính toán của 1 xét nghiệm:
+    baseline_df -> qc_stats -> (daily_df) z_df -> westgard (summary/point) -> export_df / chart_df.
+    (đầu vào: baseline_df, num_levels, robust_method, cvh, daily_df, sd_mode, sigma, people)
+
+    Đầu vào chỉ được hash 1 lần khi set_input (bỏ qua nếu vẫn là cùng object);
+    khoá của mỗi stage ghép từ fingerprint các đầu vào trực tiếp nên stage phía dưới
+    không phải hash lại dữ liệu. Stage chỉ tính lại khi khoá đổi.
+    Một stage cũng có thể được set_input trực tiếp (vd qc_stats nạp từ state ở trang 2):
+    giá trị đó được giữ nguyên (pinned) cho tới khi khoá các đầu vào phía trên khác với
+    lúc set (vd đổi baseline_df / cvh ở trang 1) thì mới tính lại.
+    """
+
+    def __init__(self, stages=None):
+        self.stages = PIPELINE_STAGES if stages is None else stages
+        self._nodes = {}  # tên -> (fingerprint, giá trị, khoá stage hoặc None nếu là đầu vào)
+        self.computed = {name: 0 for name in self.stages}
+
+    def set_input(self, name, value):
+        node = self._nodes.get(name)
+        if node is not None and node[1] is value:
+            return self
+        pin = ("pinned", self._stage_key(name)) if name in self.stages else None
+        self._nodes[name] = (_value_fingerprint(value), value, pin)
+        return self
+
+    def set_inputs(self, **values):
+        for name, value in values.items():
+            self.set_input(name, value)
+        return self
+
+    def _stage_key(self, name):
+        """Khoá hiện tại của stage theo các đầu vào phía trên (None nếu còn thiếu đầu vào)."""
+        try:
+            return fingerprint(name, [self._resolve(d)[0] for d in self.stages[name][0]])
+        except MissingInput:
+            return None
+
+    def _resolve(self, name):
+        """Trả về node (fingerprint, giá trị, khoá) của name, tính stage nếu cần."""
+        node = self._nodes.get(name)
+        if name not in self.stages:
+            if node is None:
+                raise MissingInput(f"Pipeline input not set: {name!r}")
+            return node
+
+        deps, fn = self.stages[name]
+        try:
+            dep_nodes = [self._resolve(d) for d in deps]
+        except MissingInput:
+            if node is not None:
+                return node  # đầu vào thiếu -> dùng giá trị đã set trực tiếp
+            raise
+        key = fingerprint(name, [n[0] for n in dep_nodes])
+        if node is not None and node[2] in (key, ("pinned", key)):
+            return node  # chưa đổi / giá trị set trực tiếp khi đầu vào phía trên vẫn như lúc set
+        kwargs = {"previous": node[1]} if name in INCREMENTAL_STAGES and node is not None else {}
+        value = fn(*[n[1] for n in dep_nodes], **kwargs)
+        self.computed[name] += 1
+        node = (key, value, key)
+        self._nodes[name] = node
+        return node
+
+    def get(self, name):
+        return self._resolve(name)[1]
+
+
+def get_analyte_pipeline() -> AnalytePipeline:
+    """Pipeline của xét nghiệm đang chọn (giữ trong session_state, không lưu DB)."""
+    _, active = _init_multi_analyte_store()
+    pipelines = st.session_state.setdefault("iqc_pipelines", {})
+    if active not in pipelines:
+        pipelines[active] = AnalytePipeline()
+    return pipelines[active]
+
+
+# =====================================================
+# TÁC VỤ NỀN (dựng Word, vẽ biểu đồ, lưu DB không chặn script)
+# =====================================================
+
+JOB_WORKERS = int(os.environ.get("IQC_JOB_WORKERS", "4"))
+JOB_SESSION_LIMIT = int(os.environ.get("IQC_JOB_SESSION_LIMIT", "3"))
+
+
+@st.cache_resource
+def job_runner() -> JobRunner:
+    """Thread pool tác vụ nền dùng chung cho cả server (1 instance / process)."""
+    return JobRunner(max_workers=JOB_WORKERS, per_session_limit=JOB_SESSION_LIMIT)
+
+
+def _session_id():
+    return st.session_state.setdefault("iqc_session_id", uuid.uuid4().hex)
+
+
+def submit_job(name, fn, *args, progress=False, replace=True, limit=True, **kwargs):
+    """
+    Chạy fn(*args, **kwargs) ở thread nền, trả về Job. fn không được đọc / ghi st.session_state:
+    mọi đầu vào phải được lấy ra trước khi submit.
+    name: tên job trong phiên (job_id giữ ở session_state["iqc_jobs"][name] để các lần rerun lấy lại);
+    replace=True huỷ job cùng tên còn đang chờ / chạy. progress=True truyền on_progress cho fn.
+    limit=False: job nội bộ (vd tự lưu DB) không tính vào JOB_SESSION_LIMIT.
+    Ném JobLimitError khi phiên đã đủ JOB_SESSION_LIMIT job đang chạy.
+    """
+    job = job_runner().submit(_session_id(), name, fn, *args, progress=progress, replace=replace, limit=limit,
+                              **kwargs)
+    st.session_state.setdefault("iqc_jobs", {})[name] = job.id
+    return job
+
+
+def get_job(name):
+    """Job gần nhất có tên name của phiên (None nếu chưa có / đã bị dọn)."""
+    job_id = st.session_state.get("iqc_jobs", {}).get(name)
+    job = job_runner().get(job_id) if job_id else None
+    return job if job is not None and job.session_id == _session_id() else None
+
+
+def cancel_job(name) -> bool:
+    job = get_job(name)
+    return job is not None and job_runner().cancel(job.id)
+
+
+def forget_job(name):
+    """Bỏ kết quả job đã xong (vd sau khi tải về)."""
+    job_id = st.session_state.get("iqc_jobs", {}).pop(name, None)
+    if job_id:
+        job_runner().forget(job_id)
+
+
+def _job_progress(name):
+    job = get_job(name)
+    if job is None or not job.active:
+        st.rerun()  # job vừa xong -> chạy lại cả trang để hiện kết quả, dừng hỏi định kỳ
+    text = "Đang chờ..." if job.started is None else f"Đang chạy {job.elapsed:.0f}s {job.message}".rstrip()
+    st.progress(job.progress, text=text)
+    if st.button("✖️ Huỷ", key=f"job_cancel_{name}"):
+        cancel_job(name)
+        st.rerun()
+
+
+def render_job(name, poll_seconds=1.0):
+    """
+    Trạng thái job name: đang chạy -> thanh tiến độ + nút huỷ (fragment tự hỏi lại mỗi poll_seconds);
+    lỗi / đã huỷ -> thông báo. Trả về Job khi đã xong (lấy job.result), ngược lại None.
+    """
+    job = get_job(name)
+    if job is None:
+        return None
+    if job.active:
+        st.fragment(_job_progress, run_every=poll_seconds)(name)
+    elif job.status == JOB_ERROR:
+        st.error(f"Tác vụ nền lỗi: {job.error}")
+    elif job.status == JOB_CANCELLED:
+        st.info("Đã huỷ tác vụ.")
+    return job if job.status == JOB_DONE else None
+
+
+def render_job_status(name, download_label, file_name, mime, poll_seconds=1.0):
+    """Như render_job; job xong -> nút tải kết quả (bytes)."""
+    job = render_job(name, poll_seconds)
+    if job is not None and job.result_bytes() is not None:
+        st.download_button(label=download_label, data=job.result_bytes(), file_name=file_name, mime=mime,
+                           key=f"job_download_{name}")
+        st.caption(f"Đã tạo xong trong {job.elapsed:.1f}s.")
+
+
+def render_zip_job_status(name, download_label, file_name, empty_message, poll_seconds=1.0):
+    """
+    Như render_job cho job trả về (đường dẫn ZIP trên đĩa, list kết quả từng file)
+    (export_month_end_zip / export_lj_png_zip): bảng thời gian / lỗi từng file + nút tải.
+    Đường dẫn giữ ở session_state[f"{name}_zip"] để lần tạo lại xoá file cũ.
+    """
+    job = render_job(name, poll_seconds)
+    if job is None:
+        return
+    zip_path, results = job.result
+    st.session_state[f"{name}_zip"] = zip_path
+    if not results:
+        st.warning(empty_message)
+    elif os.path.exists(zip_path):
+        n_err = sum(not r.ok for r in results)
+        st.caption(f"Xong {len(results) - n_err}/{len(results)} file trong {job.elapsed:.1f} s")
+        st.dataframe(
+            pd.DataFrame({
+                "File": [r.filename for r in results],
+                "Thời gian (s)": [round(r.seconds, 3) for r in results],
+                "Kích thước (KB)": [round(r.size / 1024, 1) for r in results],
+                "Lỗi": [r.error or "" for r in results],
+            }),
+            use_container_width=True,
+            hide_index=True,
+        )
+        if n_err:
+            st.warning(f"{n_err} file lỗi (xem cột 'Lỗi'); các file khác vẫn có trong ZIP.")
+        st.download_button(
+            label=download_label,
+            data=functools.partial(read_file_bytes, zip_path),  # đọc từ đĩa khi bấm tải
+            file_name=file_name.replace("/", "-"),
+            mime="application/zip",
+            key=f"job_download_{name}",
+        )
+    else:
+        st.info("File ZIP đã hết hạn, vui lòng tạo lại.")
+
+
+@st.cache_resource
+def _db_save_order():
+    """Thứ tự lưu DB theo (lab_id, xét nghiệm): bản lưu cũ chạy xong sau không ghi đè bản mới."""
+    return {"seq": itertools.count(), "lock": threading.Lock(), "locks": {}, "saved": {}}
+
+
+def _db_save_in_order(order, lab_id, analyte_key, state, seq):
+    key = (lab_id, analyte_key)
+    with order["lock"]:
+        lock = order["locks"].setdefault(key, threading.Lock())
+    with lock:
+        if order["saved"].get(key, -1) > seq:
+            return False  # đã lưu bản mới hơn
+        ok = db_save_state(lab_id, analyte_key, state)
+        order["saved"][key] = seq
+        return ok
+
+
+def db_save_state_background(lab_id: str, analyte_key: str, state: dict):
+    """
+    Lưu state về DB ở thread nền (bản chụp nông của state tại thời điểm gọi).
+    Gộp theo xét nghiệm: bản lưu mới bỏ bản đang chờ (replace) nên mỗi xét nghiệm chỉ còn
+    tối đa 1 lần lưu chờ; không tính vào giới hạn job của phiên.
+    """
+    order = _db_save_order()
+    args = (order, lab_id, analyte_key, dict(state), next(order["seq"]))
+    submit_job(f"db_save:{analyte_key}", _db_save_in_order, *args, replace=True, limit=False)
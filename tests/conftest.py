@@ -0,0 +1,5 @@
+import os
+import sys
+
+# cho phép `pytest` chạy từ thư mục gốc repo mà không cần cài đặt gói
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
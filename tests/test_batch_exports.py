@@ -0,0 +1,148 @@
+"""Xuất hàng loạt (PNG LJ, báo cáo cuối tháng): job được lấy dần (tối đa 2 x workers trong pool),
+ZIP / thư mục ghi luồng kèm timing.csv, 1 file lỗi không dừng cả lô."""
+import csv
+import io
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import qc_core as qc
+from export import batch_lj_png, batch_reports
+from export.batch_lj_png import LJPngJob, iter_pool, write_lj_png_dir, write_lj_png_zip
+from export.word_reports import render_lj_png
+from utils.cache import DiskCache
+
+
+def _z_df(seed, n_runs=30):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"Ngày/Lần": range(1, n_runs + 1),
+                         **{f"z_Ctrl {l}": rng.normal(0, 1.3, n_runs) for l in (1, 2)}})
+
+
+def _timing(data: bytes):
+    return list(csv.DictReader(io.StringIO(data.decode("utf-8-sig"))))
+
+
+def _png_jobs():
+    return [LJPngJob(key=("LAB", name), filename=f"LAB/{name}.png", z_df=_z_df(i), title=name)
+            for i, name in enumerate(["Glucose", "Lỗi", "Ure"])]
+
+
+def _failing_render(monkeypatch, tmp_path):
+    from export import word_reports
+
+    monkeypatch.setattr(word_reports, "chart_png_cache", DiskCache(str(tmp_path / "cache"), 0))
+
+    def render(z_df, title="", **kwargs):
+        if title == "Lỗi":
+            raise ValueError("dữ liệu hỏng")
+        return render_lj_png(z_df, title=title, **kwargs)
+
+    monkeypatch.setattr(batch_lj_png, "render_lj_png", render)
+
+
+def test_png_zip_keeps_other_charts_when_one_fails(tmp_path, monkeypatch):
+    _failing_render(monkeypatch, tmp_path)
+    progress = []
+    buf = io.BytesIO()
+    results = write_lj_png_zip(iter(_png_jobs()), buf, workers=1, dpi=50, on_progress=progress.append, total=3)
+
+    assert [r.filename for r in results if r.ok] == ["LAB/Glucose.png", "LAB/Ure.png"]
+    failed = [r for r in results if not r.ok]
+    assert len(failed) == 1 and failed[0].error == "ValueError: dữ liệu hỏng"
+    assert all(r.png is None for r in results)
+    assert [(p.done, p.total) for p in progress] == [(1, 3), (2, 3), (3, 3)]
+
+    with zipfile.ZipFile(buf) as zf:
+        assert zf.namelist() == ["LAB/Glucose.png", "LAB/Ure.png", "timing.csv"]
+        assert zf.read("LAB/Ure.png").startswith(b"\x89PNG")
+        timing = _timing(zf.read("timing.csv"))
+    assert [row["file"] for row in timing] == ["LAB/Glucose.png", "LAB/Lỗi.png", "LAB/Ure.png"]
+    assert timing[1]["lỗi"] == "ValueError: dữ liệu hỏng" and timing[1]["bytes"] == "0"
+    assert int(timing[0]["bytes"]) == results[0].size > 0
+
+
+def test_png_dir_writes_charts_and_timing(tmp_path, monkeypatch):
+    _failing_render(monkeypatch, tmp_path)
+    out = tmp_path / "out"
+    results = write_lj_png_dir(_png_jobs(), str(out), workers=1, dpi=50)
+
+    assert sorted(p.name for p in (out / "LAB").iterdir()) == ["Glucose.png", "Ure.png"]
+    assert (out / "LAB" / "Glucose.png").read_bytes().startswith(b"\x89PNG")
+    timing = _timing((out / "timing.csv").read_bytes())
+    assert [row["lỗi"] != "" for row in timing] == [not r.ok for r in results] == [False, True, False]
+
+
+def test_pool_takes_jobs_lazily_with_bounded_window():
+    taken = []
+
+    def jobs():
+        for i in range(20):
+            taken.append(i)
+            yield -i
+
+    results = iter_pool(abs, jobs(), lambda job, e: None, workers=2)
+    first = next(results)
+    assert first in range(20) and len(taken) <= 2 * 2 + 1
+    assert sorted([first, *results]) == list(range(20))
+    assert len(taken) == 20
+
+
+def _analyte(seed, test_name, num_levels, n_runs=25):
+    rng = np.random.default_rng(seed)
+    ctrls = [f"Ctrl {i}" for i in range(1, num_levels + 1)]
+    baseline = pd.DataFrame({c: rng.normal(100 * (i + 1), 3 * (i + 1), 20) for i, c in enumerate(ctrls)})
+    qc_stats = qc.AnalytePipeline().set_inputs(
+        baseline_df=baseline, num_levels=num_levels, robust_method="none", cvh={c: 4.0 for c in ctrls}
+    ).get("qc_stats")
+    daily_df = pd.DataFrame({"Ngày/Lần": range(1, n_runs + 1),
+                             **{c: rng.normal(100 * (i + 1), 4 * (i + 1), n_runs) for i, c in enumerate(ctrls)}})
+    return {
+        "config": {"test_name": test_name, "num_levels": num_levels, "sigma_value": 4.2},
+        "daily_df": daily_df,
+        "qc_stats": qc_stats,
+    }
+
+
+def test_month_end_zip_streams_every_report_with_timing(tmp_path, monkeypatch):
+    from export import word_reports
+
+    monkeypatch.setattr(word_reports, "chart_png_cache", DiskCache(str(tmp_path), 0))
+    build = batch_reports._build
+
+    def failing_build(kind, kwargs):
+        if kind == "cstk" and kwargs["meta"].ten_xet_nghiem == "Ure":
+            raise ValueError("thiếu CVh")
+        return build(kind, kwargs)
+
+    monkeypatch.setattr(batch_reports, "_build", failing_build)  # workers=1: chạy trong process này
+    stores = {"LAB1": {"GLU": _analyte(0, "Glucose", 2), "URE": _analyte(1, "Ure", 3), "trống": {"config": {}}}}
+    progress = []
+    buf = io.BytesIO()
+    results = qc.export_month_end_labs(stores, buf, workers=1, on_progress=progress.append)
+
+    expected = [
+        "LAB1/So_ghi_nhan_danh_gia_2muc_Glucose.docx",
+        "LAB1/So_theo_doi_KQ_NK_Glucose.xlsx",
+        "LAB1/Phieu_thiet_lap_CSTK_Glucose.docx",
+        "LAB1/So_ghi_nhan_danh_gia_3muc_Ure.docx",
+        "LAB1/So_theo_doi_KQ_NK_Ure.xlsx",
+        "LAB1/Phieu_thiet_lap_CSTK_Ure.docx",
+    ]
+    assert [r.filename for r in results] == expected
+    assert [r.key for r in results][:3] == [("LAB1", "GLU", kind) for kind in ("so_gn_dg", "xlsx", "cstk")]
+    assert [r.error for r in results] == [None] * 5 + ["ValueError: thiếu CVh"]
+    assert all(r.data is None for r in results)
+    assert [(p.done, p.total) for p in progress] == [(i, 6) for i in range(1, 7)]
+
+    with zipfile.ZipFile(buf) as zf:
+        assert zf.namelist() == expected[:5] + ["timing.csv"]
+        for name in expected[:5]:
+            assert zf.read(name)[:2] == b"PK"  # docx / xlsx hợp lệ (bản thân là ZIP)
+        timing = _timing(zf.read("timing.csv"))
+    assert [row["file"] for row in timing] == expected
+    assert [int(row["bytes"]) for row in timing] == [r.size for r in results]
+    assert all(int(row["bytes"]) > 0 for row in timing[:5])
+    assert timing[5]["lỗi"] == "ValueError: thiếu CVh"
+    assert all(float(row["giây"]) >= 0 for row in timing)
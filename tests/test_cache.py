@@ -0,0 +1,64 @@
+"""Cache PNG trên đĩa: xoá theo LRU khi vượt dung lượng, khoá ảnh LJ không kéo theo pyplot."""
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from export import word_reports
+from utils.cache import DiskCache, fingerprint
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=1000, suffix=".bin")
+    keys = [fingerprint(i) for i in range(5)]
+    t0 = time.time() - 100
+    for i, key in enumerate(keys):
+        cache.put(key, bytes([i]) * 200)
+        os.utime(cache._path(key), (t0 + i, t0 + i))  # mtime tăng dần, tránh phụ thuộc độ phân giải đồng hồ
+    assert cache.info()["bytes"] == 1000
+
+    assert cache.get(keys[0]) == bytes([0]) * 200  # đọc trúng -> thành mới nhất
+    cache.put(fingerprint("new"), b"x" * 200)
+
+    info = cache.info()
+    assert info["bytes"] <= 0.9 * cache.max_bytes
+    assert cache.get(keys[0]) is not None and cache.get(fingerprint("new")) == b"x" * 200
+    assert cache.get(keys[1]) is None and cache.get(keys[2]) is None  # 2 file cũ nhất bị xoá
+    assert cache.get(keys[3]) is not None and cache.get(keys[4]) is not None
+
+    cache.put(fingerprint("big"), b"x" * 1001)  # lớn hơn cả cache: bỏ qua
+    assert cache.get(fingerprint("big")) is None
+
+
+def _z_df(n_runs=60):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({"Ngày/Lần": range(1, n_runs + 1),
+                         **{f"z_Ctrl {l}": rng.normal(0, 1.3, n_runs) for l in (1, 2, 3)}})
+
+
+def test_render_lj_png_served_from_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(word_reports, "chart_png_cache", DiskCache(str(tmp_path), 10 * 1024 * 1024, suffix=".png"))
+    z_df = _z_df()
+    first = word_reports.render_lj_png(z_df, title="LJ", dpi=60)
+    assert first.startswith(b"\x89PNG")
+    assert word_reports.render_lj_png(z_df, title="LJ", dpi=60) == first
+    assert word_reports.chart_png_cache.info()["hits"] == 1
+    assert word_reports.render_lj_png(z_df, title="LJ khác", dpi=60) != first
+
+
+def test_png_cache_key_does_not_import_pyplot(tmp_path):
+    code = (
+        "import sys, numpy as np, pandas as pd\n"
+        "from export.word_reports import render_lj_png\n"
+        "z = pd.DataFrame({'Ngày/Lần': range(1, 21), 'z_Ctrl 1': np.linspace(-2, 2, 20)})\n"
+        "render_lj_png(z, dpi=50); render_lj_png(z, dpi=50)\n"
+        "assert 'matplotlib.pyplot' not in sys.modules, 'pyplot imported'\n"
+    )
+    env = dict(os.environ, IQC_CHART_CACHE_DIR=str(tmp_path))
+    env.pop("MPLBACKEND", None)  # backend chưa chọn: đọc rcParams["backend"] sẽ import pyplot
+    subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, check=True, timeout=120)
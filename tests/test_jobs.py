@@ -0,0 +1,89 @@
+"""JobRunner: thay thế job cùng tên, giới hạn job mỗi phiên, huỷ job đang chờ / đang chạy."""
+import threading
+import time
+
+import pytest
+
+from utils.jobs import JOB_CANCELLED, JOB_DONE, JOB_ERROR, JOB_RUNNING, JobLimitError, JobRunner
+
+
+def wait_until(pred, timeout=10):
+    deadline = time.time() + timeout
+    while not pred():
+        assert time.time() < deadline, "timeout"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def runner():
+    r = JobRunner(max_workers=1, per_session_limit=2)
+    yield r
+    r.shutdown(wait=True)
+
+
+@pytest.fixture
+def gate(runner):
+    """Chiếm thread duy nhất của runner (phiên khác) để các job sau nằm chờ trong hàng đợi."""
+    ev = threading.Event()
+    job = runner.submit("other", "gate", ev.wait, 10)
+    wait_until(lambda: job.status == JOB_RUNNING)
+    yield ev
+    ev.set()
+
+
+def test_replace_keeps_only_latest_queued_job(runner, gate):
+    jobs = [runner.submit("s1", "save", lambda i=i: i, replace=True, limit=False) for i in range(3)]
+    assert [j.status for j in jobs[:2]] == [JOB_CANCELLED, JOB_CANCELLED]
+    assert jobs[2].active
+
+    gate.set()
+    wait_until(lambda: not jobs[2].active)
+    assert jobs[2].status == JOB_DONE and jobs[2].result == 2
+
+
+def test_session_limit_counts_only_limited_jobs(runner, gate):
+    a = runner.submit("s1", "word", int)
+    runner.submit("s1", "save", int, limit=False)  # job nội bộ: không tính vào giới hạn
+    runner.submit("s1", "png", int)
+    with pytest.raises(JobLimitError):
+        runner.submit("s1", "zip", int)
+    runner.submit("s2", "zip", int)  # phiên khác không bị ảnh hưởng
+    runner.submit("s1", "save", int, limit=False)  # job miễn giới hạn vẫn được thêm
+
+    assert runner.cancel(a.id)
+    assert runner.submit("s1", "zip", int).active  # huỷ xong thì có chỗ trống
+
+
+def test_cancel_queued_job_never_runs(runner, gate):
+    ran = []
+    job = runner.submit("s1", "word", ran.append, 1)
+    assert runner.cancel(job.id)
+    gate.set()
+    wait_until(lambda: runner.info()[JOB_RUNNING] == 0)
+    assert job.status == JOB_CANCELLED and ran == []
+    assert not runner.cancel(job.id)  # đã kết thúc
+
+
+def test_cancel_running_job_stops_at_next_report(runner):
+    started, steps = threading.Event(), []
+
+    def work(on_progress):
+        for i in range(1000):
+            on_progress(i / 1000, f"bước {i}")
+            steps.append(i)
+            started.set()
+            time.sleep(0.005)
+        return "xong"
+
+    job = runner.submit("s1", "zip", work, progress=True)
+    started.wait(10)
+    assert runner.cancel(job.id)
+    wait_until(lambda: not job.active)
+    assert job.status == JOB_CANCELLED and job.result is None
+    assert 0 < len(steps) < 1000 and job.message.startswith("bước")
+
+
+def test_failed_job_reports_error(runner):
+    job = runner.submit("s1", "word", lambda: 1 / 0)
+    wait_until(lambda: not job.active)
+    assert job.status == JOB_ERROR and job.error.startswith("ZeroDivisionError")
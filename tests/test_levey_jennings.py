@@ -0,0 +1,207 @@
+"""Bảng dạng dài cho biểu đồ LJ (vector hoá) phải trùng với vòng lặp cũ;
+rút gọn điểm (LTTB) không được làm mất điểm vi phạm; cửa sổ run giữ cờ tính trên toàn chuỗi;
+chart cache phải vẽ được qua st.altair_chart."""
+import numpy as np
+import pandas as pd
+import pytest
+from streamlit.testing.v1 import AppTest
+
+import qc_core as qc
+from utils.cache import LRUCache
+from utils.levey_jennings import (
+    LJ_COLUMNS,
+    build_lj_long,
+    downsample_lj_long,
+    lttb_indices,
+    slice_lj_window,
+    window_bounds,
+)
+from utils.westgard_rules import build_westgard_result
+
+
+def legacy_lj_long(z_df, westgard):
+    """_stage_chart_df cũ (duyệt từng run × mức), giữ làm chuẩn so sánh."""
+    runs = z_df["Ngày/Lần"].tolist()
+    z_cols = sorted([c for c in z_df.columns if c.startswith("z_Ctrl")], key=lambda x: int(x.split("Ctrl ")[1]))
+    p_status_arr = westgard.point_status()
+    short_arr = westgard.rule_short()
+    codes_arr = westgard.point_df["rule_codes"].to_numpy(dtype=object).reshape(westgard.flags.shape)
+
+    df_long_rows = []
+    for idx, run in enumerate(runs):
+        for lvl, z_col in enumerate(z_cols, start=1):
+            z_val = z_df.loc[idx, z_col]
+            if pd.isna(z_val):
+                continue
+            df_long_rows.append(
+                {
+                    "Run": int(run),
+                    "Control": f"Ctrl {lvl}",
+                    "z_score": float(z_val),
+                    "point_status": p_status_arr[idx, lvl - 1],
+                    "rule_codes": codes_arr[idx, lvl - 1],
+                    "rule_short": short_arr[idx, lvl - 1],
+                }
+            )
+    return pd.DataFrame(df_long_rows)
+
+
+def _case(seed):
+    rng = np.random.default_rng(seed)
+    n_runs, n_levels = int(rng.integers(5, 60)), int(rng.choice([2, 3]))
+    Z = np.round(rng.normal(0, 1.8, size=(n_runs, n_levels)), 1)
+    Z[rng.random(Z.shape) < 0.15] = np.nan
+    runs = list(range(1, n_runs + 1))
+    _, rules = qc.get_sigma_category_and_rules(4.2, n_levels)
+    z_df = pd.DataFrame({"Ngày/Lần": runs, **{f"z_Ctrl {l + 1}": Z[:, l] for l in range(n_levels)}})
+    return z_df, build_westgard_result(Z, runs, rules)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_build_lj_long_matches_legacy_loop(seed):
+    z_df, result = _case(seed)
+    expected = legacy_lj_long(z_df, result)
+    assert (expected["rule_codes"] != "").any()
+
+    got = build_lj_long(z_df, westgard_result=result)
+    pd.testing.assert_frame_equal(got.reset_index(drop=True), expected, check_dtype=False)
+    # index = vị trí run (trục x của biểu đồ)
+    np.testing.assert_array_equal(got.index, got["Run"].to_numpy() - 1)
+
+    # chỉ có point_df (state nạp lại, không còn mask bit) -> cùng kết quả
+    from_points = build_lj_long(z_df, point_df=result.point_df)
+    pd.testing.assert_frame_equal(from_points, got, check_dtype=False)
+
+
+def test_lttb_indices_shape():
+    rng = np.random.default_rng(0)
+    y = np.cumsum(rng.normal(size=500))
+    x = np.arange(500.0)
+    idx = lttb_indices(x, y, 50)
+    assert len(idx) == 50
+    assert idx[0] == 0 and idx[-1] == 499
+    assert np.all(np.diff(idx) > 0)
+    np.testing.assert_array_equal(lttb_indices(x, y, 600), np.arange(500))
+
+
+def test_lttb_keeps_spike():
+    y = np.zeros(300)
+    y[137] = 10.0
+    assert 137 in lttb_indices(np.arange(300.0), y, 20)
+
+
+def test_downsample_keeps_flagged_and_out_of_range_points():
+    rng = np.random.default_rng(1)
+    n_runs, controls = 1000, ["Ctrl 1", "Ctrl 2"]
+    df = pd.DataFrame({
+        "Control": np.tile(controls, n_runs),
+        "z_score": rng.normal(0, 1.2, 2 * n_runs),
+        "rule_codes": "",
+    })
+    flagged = rng.choice(len(df), 40, replace=False)
+    df.loc[flagged, "rule_codes"] = "1-2s"
+
+    out, total = downsample_lj_long(df, 200)
+
+    assert total == len(df)
+    assert len(out) < len(df) // 4
+    assert set(flagged) <= set(out.index)
+    assert set(df.index[df["z_score"].abs() > 3]) <= set(out.index)
+    assert out.index.is_monotonic_increasing
+    same, _ = downsample_lj_long(df, len(df))
+    assert same is df
+
+
+@pytest.mark.parametrize("kwargs, expected", [
+    ({}, (0, 10)),
+    ({"last_n": 3}, (7, 10)),
+    ({"last_n": 25}, (0, 10)),  # last_n > n_runs -> cả chuỗi
+    ({"last_n": 3, "start": 1, "stop": 2}, (7, 10)),  # last_n ưu tiên hơn start/stop
+    ({"start": 2, "stop": 5}, (2, 5)),
+    ({"start": 7, "stop": 3}, (7, 7)),  # start > stop -> cửa sổ rỗng
+    ({"start": -4, "stop": 40}, (0, 10)),
+    ({"start": 15}, (10, 10)),
+])
+def test_window_bounds_clamps(kwargs, expected):
+    assert window_bounds(10, **kwargs) == expected
+
+
+def test_window_bounds_without_runs():
+    assert window_bounds(0, last_n=30) == (0, 0)
+    assert window_bounds(0, start=3, stop=5) == (0, 0)
+
+
+def test_slice_window_follows_run_positions_across_nan_gaps():
+    z_df, result = _case(2)
+    z_df.loc[[3, 4, 5], ["z_Ctrl 1", "z_Ctrl 2"]] = np.nan  # run không có điểm nào -> index có lỗ
+    df_long = build_lj_long(z_df, westgard_result=result)
+    pos = df_long.index.to_numpy()
+    assert not set(pos) & {3, 4, 5}
+
+    for start, stop in [(3, 6), (4, 9), (0, len(z_df)), (2, 4), (6, 6), (len(z_df) - 1, len(z_df))]:
+        got = slice_lj_window(df_long, start, stop)
+        pd.testing.assert_frame_equal(got, df_long[(pos >= start) & (pos < stop)])
+    assert slice_lj_window(df_long, 3, 6).empty
+
+    empty = pd.DataFrame(columns=LJ_COLUMNS)
+    assert slice_lj_window(empty, *window_bounds(0, last_n=30)).empty
+
+
+def test_window_start_keeps_flags_from_runs_before_it():
+    # 12 run liên tiếp cùng phía ≥1SD, 2 run cuối ở Ctrl 1 > 2SD -> run 12 vi phạm 2_2s, 4_1s và 10x
+    Z = np.zeros((20, 2))
+    Z[:12] = 1.5
+    Z[10:12, 0] = 2.5
+    runs = list(range(1, 21))
+    _, rules = qc.get_sigma_category_and_rules(3.0, 2)
+    z_df = pd.DataFrame({"Ngày/Lần": runs, "z_Ctrl 1": Z[:, 0], "z_Ctrl 2": Z[:, 1]})
+    df_long = build_lj_long(z_df, westgard_result=build_westgard_result(Z, runs, rules))
+
+    start, stop = window_bounds(len(z_df), start=11)
+    window = slice_lj_window(df_long, start, stop)
+    first = window[(window.index == start) & (window["Control"] == "Ctrl 1")].iloc[0]
+    assert {"2_2s", "4_1s", "10x"} <= set(first["rule_short"].split(", "))
+    assert first["point_status"] == df_long.loc[df_long["Control"] == "Ctrl 1", "point_status"].loc[start]
+
+    # đánh giá riêng phần cửa sổ thì mất ngữ cảnh -> chỉ còn cảnh báo 1_2s
+    alone = build_westgard_result(Z[start:], runs[start:], rules)
+    alone_long = build_lj_long(z_df.iloc[start:].reset_index(drop=True), westgard_result=alone)
+    assert alone_long["rule_short"].iloc[0] == "1_2s"
+
+
+def test_chart_cache_reuses_built_chart(monkeypatch):
+    cache = LRUCache(maxsize=8)
+    monkeypatch.setattr(qc, "_lj_chart_cache", lambda: cache)
+    monkeypatch.setattr(qc, "get_theme", lambda: {"text": "#000000"})
+    z_df, result = _case(1)
+    df_long = build_lj_long(z_df, westgard_result=result)
+
+    chart = qc.cached_levey_jennings_chart(df_long, "LJ")
+    assert qc.cached_levey_jennings_chart(df_long.copy(), "LJ") is chart
+    assert qc.cached_levey_jennings_chart(df_long, "LJ khác") is not chart
+    changed = df_long.copy()
+    changed.iloc[0, changed.columns.get_loc("z_score")] += 0.5
+    assert qc.cached_levey_jennings_chart(changed, "LJ") is not chart
+    assert cache.info()["hits"] == 1 and cache.info()["misses"] == 3
+    assert qc.cached_levey_jennings_chart(df_long.iloc[:0], "LJ") is None
+
+
+def _lj_chart_app():
+    import numpy as np
+    import pandas as pd
+    import streamlit as st
+
+    import qc_core as qc
+
+    z_df = pd.DataFrame({"Ngày/Lần": range(1, 41), "z_Ctrl 1": np.linspace(-3.5, 3.5, 40), "z_Ctrl 2": np.zeros(40)})
+    df_long = qc.build_lj_long(z_df)
+    for _ in range(2):  # lần 2 lấy chart từ cache
+        st.altair_chart(qc.cached_levey_jennings_chart(df_long, "LJ"), use_container_width=True)
+
+
+def test_cached_chart_renders_through_altair_chart():
+    at = AppTest.from_function(_lj_chart_app).run(timeout=60)
+    assert not at.exception
+    charts = [el.proto for el in at.main if getattr(el, "type", None) in ("arrow_vega_lite_chart", "vega_lite_chart")]
+    assert len(charts) == 2
+    assert charts[0].spec == charts[1].spec
@@ -0,0 +1,71 @@
+"""AnalytePipeline: chỉ tính lại stage khi khoá đầu vào đổi; stage set trực tiếp được giữ (pinned)."""
+import numpy as np
+import pandas as pd
+import pytest
+
+import qc_core as qc
+
+
+def toy_pipeline():
+    return qc.AnalytePipeline({
+        "a": (("x",), lambda x: x * 2),
+        "b": (("a", "y"), lambda a, y: a + y),
+    })
+
+
+def test_recompute_only_when_inputs_change():
+    p = toy_pipeline().set_inputs(x=1, y=10)
+    assert p.get("b") == 12
+    p.get("b")
+    p.set_inputs(x=1, y=10)  # cùng nội dung -> cùng fingerprint
+    assert p.get("b") == 12
+    assert p.computed == {"a": 1, "b": 1}
+
+    p.set_input("y", 20)  # chỉ b phụ thuộc y
+    assert p.get("b") == 22
+    assert p.computed == {"a": 1, "b": 2}
+
+
+def test_directly_set_stage_is_pinned_until_upstream_changes():
+    p = toy_pipeline().set_inputs(x=1, y=10)
+    assert p.get("b") == 12
+    p.set_input("a", 100)
+    assert p.get("b") == 110
+    p.set_input("y", 20)  # đầu vào phía dưới đổi: a vẫn giữ giá trị đã set
+    assert p.get("b") == 120
+    p.set_input("x", 5)  # đầu vào phía trên của a đổi -> tính lại
+    assert (p.get("a"), p.get("b")) == (10, 30)
+
+    q = qc.AnalytePipeline({"a": (("x",), lambda x: x * 2)})
+    q.set_input("a", 7)  # chưa có x: dùng giá trị đã set
+    assert q.get("a") == 7
+    q.set_input("x", 3)
+    assert q.get("a") == 6
+
+
+def test_missing_input_vs_stage_error():
+    p = qc.AnalytePipeline({
+        "a": (("x",), lambda x: x["col"].tolist()),
+        "b": (("a",), lambda a: a),
+    })
+    with pytest.raises(qc.MissingInput):
+        p.get("b")
+    p.set_input("x", pd.DataFrame({"col": [2]}))
+    assert p.get("b") == [2]
+    p.set_input("x", pd.DataFrame({"other": [3]}))
+    with pytest.raises(KeyError) as exc:  # lỗi thật trong stage không bị nuốt
+        p.get("b")
+    assert not isinstance(exc.value, qc.MissingInput)
+
+
+def test_real_stages_follow_baseline_changes():
+    rng = np.random.default_rng(0)
+    baseline = pd.DataFrame({"Ctrl 1": rng.normal(100, 3, 20), "Ctrl 2": rng.normal(200, 6, 20)})
+    p = qc.AnalytePipeline().set_inputs(
+        baseline_df=baseline, num_levels=2, robust_method="none", cvh={"Ctrl 1": 5.0, "Ctrl 2": 5.0}
+    )
+    stats = p.get("qc_stats")
+    assert stats["Mean_X"].tolist() == pytest.approx(baseline.mean().tolist())
+    p.set_input("cvh", {"Ctrl 1": 4.0, "Ctrl 2": 5.0})
+    p.get("qc_stats")
+    assert p.computed["baseline_screen"] == 1 and p.computed["qc_stats"] == 2
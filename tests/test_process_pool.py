@@ -0,0 +1,26 @@
+"""Process pool dùng chung: không fork, không chạy lại trang Streamlit (__main__) trong worker."""
+import os
+import sys
+import types
+
+from utils.process_pool import pool_context, process_pool
+
+
+def test_pool_does_not_fork():
+    assert pool_context().get_start_method() in ("forkserver", "spawn")
+    assert pool_context("spawn").get_start_method() == "spawn"
+    assert pool_context("không-có").get_start_method() == "spawn"
+
+
+def test_workers_do_not_rerun_streamlit_page(tmp_path, monkeypatch):
+    # giống ScriptRunner của Streamlit: trang đang chạy được đặt làm __main__
+    page = tmp_path / "page.py"
+    page.write_text("raise SystemExit('page re-executed in worker')\n")
+    fake_main = types.ModuleType("__main__")
+    fake_main.__file__ = str(page)
+    monkeypatch.setitem(sys.modules, "__main__", fake_main)
+
+    with process_pool(2) as pool:
+        pids = {f.result(timeout=60) for f in [pool.submit(os.getpid) for _ in range(4)]}
+    assert os.getpid() not in pids
+    assert sys.modules["__main__"] is fake_main
@@ -0,0 +1,35 @@
+"""Mô phỏng power của bộ quy tắc Westgard: so với giá trị lý thuyết của 1_3s."""
+import math
+
+import pytest
+
+from utils.qc_simulation import simulate_power
+
+P_IN_3SD = 0.9973  # P(|z| < 3)
+
+
+@pytest.fixture(scope="module")
+def power_1_3s():
+    return simulate_power({"1_3s": {"1_3s"}}, 2, se_grid=(0.0, 4.0), re_grid=(1.0,), n_sims=20000, tea=4.0)
+
+
+def test_false_rejection_matches_theory(power_1_3s):
+    pfr = 1 - P_IN_3SD ** 2
+    row = power_1_3s.set_index("SE").loc[0.0]
+    assert row["Pfr"] == pytest.approx(pfr, abs=0.002)
+    assert row["Ped"] == pytest.approx(pfr, abs=0.002)  # SE=0, RE=1: không có sai số
+    assert row["ARL"] == pytest.approx(1 / pfr, rel=0.15)  # không bị cắt ở post_runs
+
+
+def test_error_detection_for_large_shift(power_1_3s):
+    row = power_1_3s.set_index("SE").loc[4.0]
+    p_miss = (0.5 * (1 + math.erf(-1 / math.sqrt(2)))) ** 2  # SE = 4: cả 2 mức đều có z < 3
+    assert row["Ped"] == pytest.approx(1 - p_miss, abs=0.01)
+    assert row["ARL"] == pytest.approx(1 / (1 - p_miss), rel=0.05)
+    assert row["E_Nuf"] >= 0
+
+
+def test_workers_give_identical_results(power_1_3s):
+    pooled = simulate_power({"1_3s": {"1_3s"}}, 2, se_grid=(0.0, 4.0), re_grid=(1.0,), n_sims=20000, tea=4.0,
+                            workers=2)
+    assert pooled.equals(power_1_3s)
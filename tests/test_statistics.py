@@ -0,0 +1,107 @@
+"""Thống kê cột (chuẩn / bền vững / trượt / tích luỹ theo tháng, lô) so với tính trực tiếp bằng numpy."""
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import qc_core as qc
+from utils.statistics import (
+    ROBUST_METHODS,
+    column_stats,
+    robust_column_stats,
+    rolling_column_stats,
+    stack_columns,
+)
+
+
+def _data(seed, n_runs=25, n_levels=3, nan_rate=0.1):
+    rng = np.random.default_rng(seed)
+    X = rng.normal(100, 5, size=(n_runs, n_levels))
+    X[rng.random(X.shape) < nan_rate] = np.nan
+    X[3, 0] = 160.0  # 1 ngoại lai rõ
+    return X
+
+
+@pytest.mark.parametrize("mode, column, values, start", [
+    ("month", "Ngày", ["05/01/2026"] * 8 + ["02/02/2026"] * 7, 8),
+    # ô trống / không đọc được -> cùng tháng với lần trước
+    ("month", "Ngày", ["05/01/2026", None, "28/01/2026", "", "03/02/2026", None] + ["x"] * 9, 4),
+    ("month", "Ngày", [None] * 15, 0),  # chưa ghi ngày -> cả bảng
+    ("lot", "Lô QC", ["A"] * 6 + ["B"] * 9, 6),
+    ("lot", "Lô QC", ["A", None, " A ", "B", "", None] + [np.nan] * 9, 3),
+])
+def test_propose_cumulative_modes_use_current_group(mode, column, values, start):
+    X = _data(1, n_runs=15, n_levels=2)
+    daily = pd.DataFrame({"Ngày/Lần": range(1, 16), "Ngày": None, "Lô QC": None,
+                          "Ctrl 1": X[:, 0], "Ctrl 2": X[:, 1]})
+    daily[column] = pd.Series(values, dtype=object)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        proposal = qc.propose_qc_stats(daily, None, 2, mode=mode)
+    m, s, _, n = column_stats(X[start:])
+    np.testing.assert_allclose(proposal["Mean_X"], m)
+    np.testing.assert_allclose(proposal["SD_empirical"], s)
+    np.testing.assert_array_equal(proposal["n"], n)
+    assert (qc.retarget_group(daily, mode) == "") == (start == 0)
+
+
+def test_column_stats_matches_numpy():
+    X = _data(0)
+    mean, sd, cv, n = column_stats(X)
+    np.testing.assert_allclose(mean, np.nanmean(X, axis=0))
+    np.testing.assert_allclose(sd, np.nanstd(X, axis=0, ddof=1))
+    np.testing.assert_allclose(cv, sd / mean * 100)
+    np.testing.assert_array_equal(n, (~np.isnan(X)).sum(axis=0))
+
+
+def test_column_stats_edge_cases():
+    X = np.array([[np.nan, 1.0, 0.0], [np.nan, np.nan, 0.0]])
+    mean, sd, cv, n = column_stats(X)
+    assert np.isnan(mean[0]) and n[0] == 0
+    assert mean[1] == 1.0 and np.isnan(sd[1])  # n=1 -> không có SD
+    assert np.isnan(cv[2])  # mean=0 -> không có CV
+
+
+@pytest.mark.parametrize("method", list(ROBUST_METHODS))
+def test_robust_stats_3d_matches_per_analyte(method):
+    mats = [_data(s, n_runs=10 + 5 * s, n_levels=2 + s % 2) for s in range(4)]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        mean, sd, cv, n, excluded = robust_column_stats(stack_columns(mats), method)
+        for a, X in enumerate(mats):
+            m, s, c, k, e = robust_column_stats(X, method)
+            L = X.shape[1]
+            np.testing.assert_allclose(mean[a, :L], m)
+            np.testing.assert_allclose(sd[a, :L], s)
+            np.testing.assert_array_equal(n[a, :L], k)
+            np.testing.assert_array_equal(excluded[a, : X.shape[0], :L], e)
+
+
+@pytest.mark.parametrize("method", ["trim3sd", "grubbs", "tukey", "mad"])
+def test_robust_methods_flag_gross_outlier(method):
+    X = _data(1, nan_rate=0)
+    mean, sd, _, n, excluded = robust_column_stats(X, method)
+    assert excluded[3, 0]
+    if method == "mad":
+        assert mean[0] == pytest.approx(np.median(X[:, 0]))
+    else:
+        keep = X[~excluded[:, 0], 0]
+        assert mean[0] == pytest.approx(keep.mean())
+        assert sd[0] == pytest.approx(keep.std(ddof=1))
+        assert n[0] == keep.size
+
+
+def test_rolling_stats_match_direct_windows():
+    X = _data(2, n_runs=40)
+    groups = np.repeat(["2026-01", "2026-02", "2026-03"], [12, 15, 13])
+    for window, grp in [(None, None), (7, None), (None, groups), (5, groups)]:
+        mean, sd, _, n = rolling_column_stats(X, window, grp)
+        for t in range(X.shape[0]):
+            lo = 0 if window is None else max(t + 1 - window, 0)
+            if grp is not None:
+                lo = max(lo, int(np.flatnonzero(grp == grp[t])[0]))
+            m, s, _, k = column_stats(X[lo:t + 1])
+            np.testing.assert_allclose(mean[t], m, rtol=1e-10)
+            np.testing.assert_allclose(sd[t], s, rtol=1e-8)
+            np.testing.assert_array_equal(n[t], k)
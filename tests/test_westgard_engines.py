@@ -0,0 +1,229 @@
+"""Các engine Westgard phải cho cùng kết quả: numpy vs gốc (legacy), tăng dần vs toàn bộ,
+theo lô vs từng xét nghiệm, process pool vs 1 process."""
+import warnings
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import qc_core as qc
+from utils.cache import LRUCache
+from utils.westgard_rules import (
+    WestgardStream,
+    build_westgard_result,
+    build_westgard_results_batch,
+    extend_westgard_result,
+    westgard_flags_batch,
+)
+from utils.westgard_batch import run_westgard_pool
+
+SIGMAS = [0, 3, 4.2, 5.5, 6.5]
+
+
+def random_z(rng, n_runs, n_levels):
+    Z = rng.normal(rng.choice([0, 1, -1.5]), rng.choice([0.8, 1.5, 2.5]), size=(n_runs, n_levels))
+    Z = np.round(Z, int(rng.choice([0, 1, 3])))  # làm tròn -> có giá trị đúng bằng ngưỡng 2 / 3
+    Z[rng.random(Z.shape) < rng.choice([0, 0.1, 0.4])] = np.nan
+    return Z
+
+
+def z_frame(Z, runs=None):
+    runs = list(range(1, len(Z) + 1)) if runs is None else runs
+    return pd.DataFrame({"Ngày/Lần": runs, **{f"z_Ctrl {l + 1}": Z[:, l] for l in range(Z.shape[1])}})
+
+
+@pytest.fixture(autouse=True)
+def _quiet():
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        yield
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_numpy_engine_matches_legacy(seed):
+    rng = np.random.default_rng(seed)
+    for _ in range(60):
+        n_levels = int(rng.choice([1, 2, 3]))
+        Z = random_z(rng, int(rng.integers(0, 40)), n_levels)
+        runs = list(range(1, len(Z) + 1)) if rng.random() < 0.7 else [f"d{i}" for i in range(len(Z))]
+        df = z_frame(Z, runs)
+        num_levels = max(n_levels, 2)
+        sigma = float(rng.choice(SIGMAS))
+        cat_a, rules_a, summary_a, point_a = qc.evaluate_westgard(df, num_levels, sigma, engine="legacy")
+        cat_b, rules_b, summary_b, point_b = qc.evaluate_westgard(df, num_levels, sigma, engine="numpy")
+        assert (cat_a, rules_a) == (cat_b, rules_b)
+        pd.testing.assert_frame_equal(summary_a, summary_b)
+        pd.testing.assert_frame_equal(point_a, point_b)
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_stream_matches_full_evaluation(seed):
+    rng = np.random.default_rng(100 + seed)
+    for _ in range(30):
+        n_levels = int(rng.choice([2, 3]))
+        Z = random_z(rng, int(rng.integers(1, 35)), n_levels)
+        runs = list(range(1, len(Z) + 1))
+        _, rules = qc.get_sigma_category_and_rules(float(rng.choice(SIGMAS)), n_levels)
+        full = build_westgard_result(Z, runs, rules)
+
+        stream = WestgardStream(rules, n_levels)
+        for i, run in enumerate(runs):
+            summary_row, point_rows = stream.push(run, Z[i])
+            assert summary_row == full.summary_df.iloc[i].to_dict()
+            expected = full.point_df.iloc[i * n_levels:(i + 1) * n_levels]
+            assert point_rows == expected[list(point_rows[0])].to_dict("records")
+
+        k = int(rng.integers(0, len(Z) + 1))
+        extended = extend_westgard_result(build_westgard_result(Z[:k], runs[:k], rules), Z, runs)
+        np.testing.assert_array_equal(extended.flags, full.flags)
+        pd.testing.assert_frame_equal(extended.summary_df, full.summary_df)
+
+
+def test_append_reuses_previous_result_and_edits_reevaluate():
+    rng = np.random.default_rng(7)
+    Z = random_z(rng, 30, 3)
+    previous = qc.evaluate_westgard_result(z_frame(Z[:20]), 3, 4.2, engine="numpy", use_cache=False)
+
+    appended = qc.evaluate_westgard_result(z_frame(Z), 3, 4.2, engine="numpy", use_cache=False, previous=previous)
+    full = qc.evaluate_westgard_result(z_frame(Z), 3, 4.2, engine="numpy", use_cache=False)
+    np.testing.assert_array_equal(appended.flags, full.flags)
+
+    edited = Z.copy()
+    edited[5] = [3.5, -3.5, 0.0]  # sửa run cũ -> phải đánh giá lại toàn bộ
+    got = qc.evaluate_westgard_result(z_frame(edited), 3, 4.2, engine="numpy", use_cache=False, previous=previous)
+    ref = qc.evaluate_westgard_result(z_frame(edited), 3, 4.2, engine="legacy", use_cache=False)
+    pd.testing.assert_frame_equal(got.summary_df, ref.summary_df)
+
+
+def test_result_cache_hits_on_same_content_and_misses_on_changes(monkeypatch):
+    cache = LRUCache(maxsize=16)
+    monkeypatch.setattr(qc, "_westgard_result_cache", lambda: cache)
+    rng = np.random.default_rng(8)
+    Z = random_z(rng, 25, 2)
+    Z[3] = [0.5, -0.5]
+
+    first = qc.evaluate_westgard_result(z_frame(Z), 2, 4.2, engine="numpy")
+    assert cache.info()["misses"] == 1 and cache.info()["hits"] == 0
+    # cùng nội dung (frame mới) -> hit, trả đúng object đã cache
+    assert qc.evaluate_westgard_result(z_frame(Z.copy()), 2, 4.2, engine="numpy") is first
+    # cùng nhóm sigma (4.2 và 4.8 đều là 4-sigma) -> cùng bộ quy tắc -> hit
+    assert qc.evaluate_westgard_result(z_frame(Z), 2, 4.8, engine="numpy") is first
+    assert cache.info()["hits"] == 2 and cache.info()["misses"] == 1
+
+    changed_z = Z.copy()
+    changed_z[3, 1] = 0.25
+    misses = [
+        qc.evaluate_westgard_result(z_frame(Z), 2, 6.5, engine="numpy"),  # đổi nhóm sigma
+        qc.evaluate_westgard_result(z_frame(Z, [f"d{i}" for i in range(len(Z))]), 2, 4.2, engine="numpy"),
+        qc.evaluate_westgard_result(z_frame(changed_z), 2, 4.2, engine="numpy"),  # đổi 1 giá trị z
+    ]
+    assert all(r is not first for r in misses)
+    assert cache.info() == {"hits": 2, "misses": 4, "size": 4, "maxsize": 16}
+
+
+def test_columnar_result_renders_lazily_and_consistently():
+    rng = np.random.default_rng(3)
+    Z = random_z(rng, 40, 3)
+    runs = list(range(1, 41))
+    _, rules = qc.get_sigma_category_and_rules(3.0, 3)
+    result = build_westgard_result(Z, runs, rules)
+
+    assert result.flags.dtype == np.uint16 and result.flags.shape == Z.shape
+    codes = result.point_rule_codes()  # chỉ dựng thông điệp cho ô có cờ
+    assert "_frames" not in result.__dict__
+    np.testing.assert_array_equal(result.rule_mask("1_3s"), np.abs(np.nan_to_num(Z)) >= 3)
+
+    _, _, summary, point = qc.evaluate_westgard(z_frame(Z, runs), 3, 3.0, engine="legacy")
+    pd.testing.assert_frame_equal(result.summary_df, summary)
+    pd.testing.assert_frame_equal(result.point_df, point)
+    np.testing.assert_array_equal(codes.ravel(), point["rule_codes"].to_numpy(dtype=object))
+    assert list(result.run_status()) == summary["Trạng thái"].tolist()
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_batch_matches_single_analyte(seed):
+    rng = np.random.default_rng(200 + seed)
+    Z_list, runs_list, rule_sets = [], [], []
+    for _ in range(int(rng.integers(1, 12))):
+        n_levels = int(rng.choice([1, 2, 3]))
+        Z = random_z(rng, int(rng.integers(0, 60)), n_levels)
+        Z_list.append(Z)
+        runs_list.append(list(range(1, len(Z) + 1)))
+        rule_sets.append(qc.get_sigma_category_and_rules(float(rng.choice(SIGMAS)), max(n_levels, 2))[1])
+
+    batch = build_westgard_results_batch(Z_list, runs_list, rule_sets)
+    for result, Z, runs, rules in zip(batch, Z_list, runs_list, rule_sets):
+        single = build_westgard_result(Z, runs, rules)
+        np.testing.assert_array_equal(result.flags, single.flags)
+        pd.testing.assert_frame_equal(result.point_df, single.point_df)
+
+
+def test_store_batch_matches_legacy_per_analyte():
+    rng = np.random.default_rng(4)
+    store = {"empty": {"config": {}, "z_df": None}}
+    for a in range(6):
+        n_levels = int(rng.choice([2, 3]))
+        Z = random_z(rng, int(rng.integers(1, 50)), n_levels)
+        store[f"A{a}"] = {
+            "config": {"num_levels": n_levels, "sigma_value": float(rng.choice(SIGMAS))},
+            "z_df": z_frame(Z),
+        }
+    results = qc.evaluate_westgard_store(store)
+    assert set(results) == set(store) - {"empty"}
+    for name, result in results.items():
+        cfg = store[name]["config"]
+        _, _, summary, point = qc.evaluate_westgard(store[name]["z_df"], cfg["num_levels"], cfg["sigma_value"],
+                                                    engine="legacy")
+        pd.testing.assert_frame_equal(result.summary_df, summary)
+        pd.testing.assert_frame_equal(result.point_df, point)
+
+
+def test_process_pool_matches_in_process_batch():
+    rng = np.random.default_rng(5)
+    jobs = []
+    for a in range(9):
+        n_levels = int(rng.choice([1, 2, 3]))
+        Z = random_z(rng, int(rng.integers(0, 40)), n_levels)
+        _, rules = qc.get_sigma_category_and_rules(float(rng.choice(SIGMAS)), max(n_levels, 2))
+        jobs.append((f"A{a}", Z, list(range(1, len(Z) + 1)), rules, ""))
+    expected = westgard_flags_batch([j[1] for j in jobs], [j[3] for j in jobs])
+
+    progress = []
+    results, info = run_westgard_pool(jobs, workers=2, shard_size=2, on_progress=progress.append)
+
+    assert info.done == info.total == len(jobs)
+    assert [p.done for p in progress][-1] == len(jobs)
+    for (key, Z, runs, rules, _), flags in zip(jobs, expected):
+        np.testing.assert_array_equal(results[key].flags, flags)
+        np.testing.assert_array_equal(results[key].z, Z)
+        assert results[key].runs == runs
+
+
+
+def test_month_end_backfill_uses_pool_for_large_batches(monkeypatch):
+    rng = np.random.default_rng(6)
+    stores = {}
+    for lab in ("LAB1", "LAB2"):
+        stores[lab] = {"trống": {"config": {}}}
+        for a in range(4):
+            n_levels = int(rng.choice([2, 3]))
+            stores[lab][f"A{a}"] = {
+                "config": {"num_levels": n_levels, "sigma_value": float(rng.choice(SIGMAS))},
+                "z_df": z_frame(random_z(rng, int(rng.integers(1, 40)), n_levels)),
+            }
+    expected = qc._month_end_evaluate(stores)
+
+    pooled = []
+    backfill = qc.reevaluate_westgard_labs
+    monkeypatch.setattr(qc, "reevaluate_westgard_labs", lambda *a, **kw: pooled.append(1) or backfill(*a, **kw))
+    monkeypatch.setattr(qc, "WESTGARD_POOL_MIN_ANALYTES", 10)
+    got = qc._month_end_evaluate(stores, workers=2)
+
+    assert pooled
+    assert {lab: set(v) for lab, v in got.items()} == {lab: set(v) for lab, v in expected.items()}
+    for lab, results in expected.items():
+        for name, (runs, Z, result) in results.items():
+            g_runs, g_Z, g_result = got[lab][name]
+            assert list(g_runs) == list(runs)
+            np.testing.assert_array_equal(g_Z, Z)
+            np.testing.assert_array_equal(g_result.flags, result.flags)
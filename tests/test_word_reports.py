@@ -0,0 +1,98 @@
+"""Bảng Word dựng trực tiếp bằng XML phải giống hệt cách python-docx; mẫu Word dùng lại không bị sửa chéo;
+placeholder {{KEY}} được thay cả khi Word tách token qua nhiều run."""
+import pytest
+from docx import Document
+from docx.shared import Cm
+from lxml import etree
+
+from export.word_reports import _append_rows, _replace_placeholders_in_doc, template_document
+
+CELL_TEXTS = ["", "12.5", "Đạt", " lề trái", "lề phải ", "a\tb", "dòng 1\ndòng 2", "x\r\ny", "<&> \"'", "1_3s, R_4s"]
+
+
+def _table(widths):
+    table = Document().add_table(rows=1, cols=len(widths))
+    for cell, gc, w in zip(table.rows[0].cells, table._tbl.tblGrid.gridCol_lst, widths):
+        cell.text = "H"
+        gc.w = None if w is None else Cm(w)  # None -> ô mới không có tcW
+    return table
+
+
+@pytest.mark.parametrize("widths", [[2.0, 3.5, 1.2], [None, 2.0, None]])
+def test_append_rows_xml_matches_add_row(widths):
+    columns = [CELL_TEXTS, CELL_TEXTS[::-1], [str(i) for i in range(len(CELL_TEXTS))]]
+
+    expected = _table(widths)
+    for i in range(len(CELL_TEXTS)):
+        cells = expected.add_row().cells
+        for c, col in enumerate(columns):
+            cells[c].text = col[i]
+
+    got = _table(widths)
+    _append_rows(got, columns)
+
+    assert etree.tostring(got._tbl) == etree.tostring(expected._tbl)
+    assert [c.text for c in got.rows[7].cells] == [c.text for c in expected.rows[7].cells]
+
+
+def _paragraph(doc, parts, bold=()):
+    p = doc.add_paragraph()
+    for text in parts:
+        p.add_run(text).bold = text in bold
+    return p
+
+
+def test_tokens_split_across_runs_are_replaced():
+    doc = Document()
+    p = _paragraph(doc, ["Tên: {{TEN_", "XET", "_NGHIEM}} / {{A}}{{B", "}} x {{UNKNOWN}} {", "{C}}"], bold=("XET",))
+    cell = doc.add_table(rows=1, cols=1).cell(0, 0).paragraphs[0]
+    cell.add_run("{{")
+    cell.add_run("A}} end")
+
+    n = _replace_placeholders_in_doc(doc, {"{{TEN_XET_NGHIEM}}": "Glucose", "{{A}}": " 1 ", "{{B}}": "2", "{{C}}": "3"})
+
+    assert n == 5
+    assert p.text == "Tên: Glucose /  1 2 x {{UNKNOWN}} 3"
+    assert cell.text == " 1  end"
+    # giá trị dồn vào run đầu của token; định dạng các run khác giữ nguyên
+    assert [r.text for r in p.runs][:3] == ["Tên: Glucose", "", " /  1 2"]
+    assert not p.runs[0].bold
+
+
+def test_none_values_and_header_footer():
+    doc = Document()
+    doc.sections[0].header.paragraphs[0].add_run("Đơn vị: {{DON_VI}}")
+    doc.sections[0].footer.paragraphs[0].add_run("{{PHIEN_BAN}}")
+    p = _paragraph(doc, ["{{X}}|{{X}}"])
+
+    n = _replace_placeholders_in_doc(doc, {"{{DON_VI}}": "Khoa XN", "{{PHIEN_BAN}}": None, "{{X}}": 7})
+
+    assert n == 4
+    assert doc.sections[0].header.paragraphs[0].text == "Đơn vị: Khoa XN"
+    assert doc.sections[0].footer.paragraphs[0].text == ""
+    assert p.text == "7|7"
+
+
+def test_template_copies_are_independent():
+    a = template_document("so_ghi_nhan_3muc")
+    _replace_placeholders_in_doc(a, {"{{TEN_XET_NGHIEM}}": "Glucose"})
+    b = template_document("so_ghi_nhan_3muc")
+    text = "\n".join(p.text for p in b.paragraphs) + "\n".join(
+        c.text for t in b.tables for r in t.rows for c in r.cells
+    )
+    assert "{{TEN_XET_NGHIEM}}" in text
+
+
+@pytest.mark.parametrize("builder, template_builder", [
+    ("build_cstk_3muc_docx", "_build_cstk_3muc_from_template"),
+    ("build_so_ghi_nhan_3muc_docx", "_build_so_ghi_nhan_3muc_from_template"),
+])
+def test_three_level_reports_use_template_by_default(monkeypatch, builder, template_builder):
+    from export import word_reports
+
+    calls = []
+    monkeypatch.setattr(word_reports, template_builder, lambda *args, **kwargs: calls.append(args) or "docx")
+    assert word_reports.DOCX_TEMPLATE_MODE
+    args = (None,) * (3 if builder == "build_cstk_3muc_docx" else 4)
+    assert getattr(word_reports, builder)(*args) == "docx"
+    assert len(calls) == 1
@@ -0,0 +1,37 @@
+"""z-score cả bảng (1 phép broadcast) phải trùng với compute_zscore tính từng ô."""
+import numpy as np
+import pandas as pd
+import pytest
+
+import qc_core as qc
+
+
+def per_cell(daily_df, mean_dict, sd_dict, num_levels):
+    """Vòng lặp cũ của trang 2 (trước khi vector hoá), giữ làm chuẩn so sánh."""
+    zscore_cols = {}
+    for lvl in range(1, num_levels + 1):
+        ctrl = f"Ctrl {lvl}"
+        mean = mean_dict.get(ctrl, np.nan)
+        sd = sd_dict.get(ctrl, np.nan)
+        zscore_cols[f"z_Ctrl {lvl}"] = [
+            qc.compute_zscore(v, mean, sd) if v not in (None, "") else np.nan
+            for v in daily_df.get(ctrl, pd.Series([np.nan] * len(daily_df))).tolist()
+        ]
+    return pd.DataFrame({"Ngày/Lần": daily_df["Ngày/Lần"], **zscore_cols})
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_frame_matches_per_cell(seed):
+    rng = np.random.default_rng(seed)
+    n = 30
+    daily = pd.DataFrame({
+        "Ngày/Lần": range(1, n + 1),
+        "Ctrl 1": rng.normal(100, 4, n),  # cột số
+        "Ctrl 2": [None if r < 0.1 else "" if r < 0.2 else "abc" if r < 0.25 else f"{v:.2f}"
+                   for r, v in zip(rng.random(n), rng.normal(200, 8, n))],  # cột object lẫn ô trống / chữ
+    })
+    means = {"Ctrl 1": 100.0, "Ctrl 2": 200.0, "Ctrl 3": 300.0}
+    for sds in ({"Ctrl 1": 4.0, "Ctrl 2": 8.0, "Ctrl 3": 9.0},
+                {"Ctrl 1": 0.0, "Ctrl 2": np.nan, "Ctrl 3": None}):
+        got = qc.compute_zscore_frame(daily, means, sds, 3)  # Ctrl 3 không có trong daily_df
+        pd.testing.assert_frame_equal(got, per_cell(daily, means, sds, 3), check_dtype=False)
@@ -0,0 +1,196 @@
+"""
+Cache LRU trong bộ nhớ, an toàn đa luồng, có đếm hit/miss.
+Dùng chung giữa các phiên Streamlit khi được tạo qua st.cache_resource.
+DiskCache: cache bytes trên đĩa theo khoá nội dung, giới hạn dung lượng, loại LRU.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def fingerprint(*parts) -> str:
+    """
+    Hash nội dung (blake2b) cho các khoá cache.
+    ndarray được hash theo bytes + dtype + shape; phần còn lại theo repr.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    for p in parts:
+        if isinstance(p, np.ndarray):
+            a = np.ascontiguousarray(p)
+            h.update(f"nd:{a.dtype.str}:{a.shape}".encode())
+            h.update(a.tobytes())
+        else:
+            h.update(repr(p).encode("utf-8"))
+        h.update(b"\x1f")
+    return h.hexdigest()
+
+
+class LRUCache:
+    """Cache LRU giới hạn số phần tử; get_or_compute tính ngoài lock."""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = int(maxsize)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
+
+
+class DiskCache:
+    """
+    Cache bytes trên đĩa, địa chỉ theo nội dung (khoá = fingerprint): mỗi khoá 1 file
+    <dir>/<2 ký tự đầu>/<khoá><suffix>. Đọc trúng cập nhật mtime; vượt max_bytes thì
+    xoá file có mtime cũ nhất (LRU). Ghi qua file tạm + os.replace nên an toàn khi
+    nhiều process (worker xuất ảnh) dùng chung thư mục.
+    """
+
+    def __init__(self, directory, max_bytes, suffix=""):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        self._total = None  # tổng dung lượng, quét lười lần đầu
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}{self.suffix}")
+
+    def _entries(self):
+        """[(mtime, size, path)] mọi file trong cache."""
+        out = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, path))
+        return out
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data: bytes):
+        if self.max_bytes <= 0 or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            existed = os.path.exists(path)
+            os.replace(tmp, path)
+        except OSError:
+            return  # đĩa đầy / không ghi được: chỉ mất cache, không lỗi
+        with self._lock:
+            if self._total is None:
+                self._total = sum(size for _, size, _ in self._entries())
+            elif not existed:
+                self._total += len(data)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Xoá file cũ nhất tới khi còn <= 90% max_bytes (quét lại vì process khác cũng ghi)."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._total = total
+
+    def get_or_compute(self, key, compute):
+        data = self.get(key)
+        if data is None:
+            data = compute()
+            self.put(key, data)
+        return data
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._total = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> dict:
+        entries = self._entries()
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "files": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
@@ -0,0 +1,197 @@
+"""
+Chạy tác vụ nặng (dựng Word + biểu đồ, lưu DB...) ở thread nền để không chặn script Streamlit.
+Không phụ thuộc streamlit: qc_core giữ 1 JobRunner cho cả server (st.cache_resource).
+
+Trang submit job -> nhận Job (id), các lần rerun sau đọc status / progress và lấy
+kết quả khi xong. Huỷ: job chưa chạy bị bỏ khỏi hàng đợi; job đang chạy dừng ở lần
+báo tiến độ kế tiếp (on_progress ném JobCancelled). Mỗi phiên chỉ được chạy đồng thời
+tối đa per_session_limit job người dùng bấm (job nội bộ như tự lưu DB được miễn: limit=False).
+"""
+import io
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Optional
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_ERROR = "error"
+JOB_CANCELLED = "cancelled"
+ACTIVE_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+
+
+class JobCancelled(Exception):
+    """Ném ra trong job khi người dùng đã yêu cầu huỷ."""
+
+
+class JobLimitError(RuntimeError):
+    """Phiên đã chạy đủ số job đồng thời cho phép."""
+
+
+@dataclass
+class Job:
+    """Trạng thái 1 job (được worker cập nhật, trang chỉ đọc)."""
+    id: str
+    name: str
+    session_id: str
+    status: str = JOB_QUEUED
+    progress: float = 0.0
+    message: str = ""
+    result: object = None
+    error: Optional[str] = None
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    cancel_requested: bool = False
+    limited: bool = True
+    future: object = field(default=None, repr=False)
+
+    @property
+    def active(self):
+        return self.status in ACTIVE_STATUSES
+
+    @property
+    def elapsed(self):
+        """Số giây đã chạy (0 nếu chưa bắt đầu)."""
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+    def result_bytes(self) -> Optional[bytes]:
+        """Kết quả dạng bytes (BytesIO -> getvalue); None nếu chưa xong / không phải dữ liệu nhị phân."""
+        if isinstance(self.result, (bytes, bytearray)):
+            return bytes(self.result)
+        if isinstance(self.result, io.BytesIO):
+            return self.result.getvalue()
+        return None
+
+    def report(self, progress=None, message=None):
+        """
+        Callback tiến độ cho job (truyền vào dưới tên on_progress):
+        progress là tỉ lệ 0..1 hoặc đối tượng có done / total (vd BatchProgress).
+        Ném JobCancelled nếu đã có yêu cầu huỷ.
+        """
+        if self.cancel_requested:
+            raise JobCancelled(self.id)
+        if progress is not None:
+            if hasattr(progress, "done") and hasattr(progress, "total"):
+                if message is None:
+                    message = f"{progress.done}/{progress.total}"
+                progress = progress.done / progress.total if progress.total else 1.0
+            self.progress = min(max(float(progress), 0.0), 1.0)
+        if message is not None:
+            self.message = str(message)
+
+
+class JobRunner:
+    """
+    Thread pool dùng chung + bảng job theo id.
+    max_workers: số thread; per_session_limit: số job queued/running tối đa mỗi phiên;
+    keep_seconds: job đã kết thúc được giữ lại (để trang lấy kết quả) trong bấy nhiêu giây.
+    Tác vụ CPU nặng nên tự dùng process pool bên trong job (vd export_month_end_labs).
+    """
+
+    def __init__(self, max_workers=4, per_session_limit=3, keep_seconds=1800):
+        self.per_session_limit = int(per_session_limit)
+        self.keep_seconds = keep_seconds
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="iqc-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, name, fn, *args, progress=False, replace=False, limit=True, **kwargs) -> Job:
+        """
+        Đưa fn(*args, **kwargs) vào hàng đợi, trả về Job.
+        progress=True: truyền thêm on_progress=job.report cho fn.
+        replace=True: yêu cầu huỷ job cùng tên đang chờ / chạy của phiên trước khi thêm job mới
+        (job còn chờ bị bỏ hẳn -> mỗi tên chỉ còn tối đa 1 job chờ).
+        limit=False: job không tính vào (và không bị chặn bởi) per_session_limit.
+        Ném JobLimitError nếu phiên đã đủ per_session_limit job (limit=True) đang chờ / chạy.
+        """
+        with self._lock:
+            self._purge()
+            if replace:
+                for job in self._jobs.values():
+                    if job.session_id == session_id and job.name == name and job.active:
+                        self._cancel(job)
+            if limit:
+                n_active = sum(1 for j in self._jobs.values()
+                               if j.session_id == session_id and j.active and j.limited)
+                if n_active >= self.per_session_limit:
+                    raise JobLimitError(f"Session already has {n_active} active jobs (limit {self.per_session_limit})")
+            job = Job(id=uuid.uuid4().hex, name=name, session_id=session_id, limited=bool(limit))
+            if progress:
+                kwargs["on_progress"] = job.report
+            self._jobs[job.id] = job
+            job.future = self._pool.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def _run(self, job, fn, args, kwargs):
+        if job.cancel_requested:
+            job.status = JOB_CANCELLED
+            job.finished = time.time()
+            return
+        job.started = time.time()
+        job.status = JOB_RUNNING
+        try:
+            result = fn(*args, **kwargs)
+        except JobCancelled:
+            job.status = JOB_CANCELLED
+        except Exception as e:  # lỗi job -> hiển thị trên trang, không làm chết thread
+            job.error = f"{type(e).__name__}: {e}"
+            job.status = JOB_ERROR
+        else:
+            job.result = result
+            job.progress = 1.0
+            job.status = JOB_DONE
+        finally:
+            job.finished = time.time()
+
+    def get(self, job_id) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def session_jobs(self, session_id) -> list:
+        """Các job của 1 phiên (mới nhất trước)."""
+        with self._lock:
+            jobs = [j for j in self._jobs.values() if j.session_id == session_id]
+        return sorted(jobs, key=lambda j: j.submitted, reverse=True)
+
+    def _cancel(self, job) -> bool:
+        if not job.active:
+            return False
+        job.cancel_requested = True
+        if job.future is not None and job.future.cancel():
+            job.status = JOB_CANCELLED
+            job.finished = time.time()
+        return True
+
+    def cancel(self, job_id) -> bool:
+        """Yêu cầu huỷ; True nếu job còn đang chờ / chạy."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job is not None and self._cancel(job)
+
+    def forget(self, job_id):
+        """Bỏ job đã kết thúc khỏi bảng (giải phóng kết quả)."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and not job.active:
+                del self._jobs[job_id]
+
+    def _purge(self):
+        cutoff = time.time() - self.keep_seconds
+        for job_id in [j.id for j in self._jobs.values() if not j.active and (j.finished or 0) < cutoff]:
+            del self._jobs[job_id]
+
+    def info(self) -> dict:
+        with self._lock:
+            statuses = [j.status for j in self._jobs.values()]
+        return {s: statuses.count(s) for s in (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_ERROR, JOB_CANCELLED)}
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            for job in self._jobs.values():
+                self._cancel(job)
+        self._pool.shutdown(wait=wait, cancel_futures=True)
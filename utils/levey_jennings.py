@@ -0,0 +1,183 @@
+"""
+Dữ liệu dạng dài cho biểu đồ Levey–Jennings (dùng chung cho chart Altair và ảnh matplotlib).
+Không phụ thuộc streamlit để dùng được trong worker xuất ảnh hàng loạt.
+"""
+import numpy as np
+import pandas as pd
+
+from utils.westgard_rules import STATUS_OK
+
+LJ_COLUMNS = ["Run", "Control", "z_score", "point_status", "rule_codes", "rule_short"]
+
+
+def short_rule_codes(text):
+    """"1_3s (Ctrl 1) ...; 2_2s ..." -> "1_3s, 2_2s" (mã đầu mỗi thông điệp, không lặp)."""
+    if not isinstance(text, str) or not text.strip():
+        return ""
+    codes = []
+    for part in text.split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        token = part.split()[0]
+        if token not in codes:
+            codes.append(token)
+    return ", ".join(codes)
+
+
+def _map_unique(values, fn):
+    """Áp fn lên từng giá trị khác nhau rồi trải lại (ít giá trị khác nhau hơn nhiều so với số điểm)."""
+    values = np.asarray(values, dtype=object)
+    if values.size == 0:
+        return values
+    uniq, inverse = np.unique(values.astype(str), return_inverse=True)
+    return np.array([fn(u) for u in uniq], dtype=object)[inverse]
+
+
+def _run_labels(runs):
+    """Nhãn run: số nguyên nếu mọi run là số nguyên, ngược lại giữ nguyên."""
+    num = pd.to_numeric(pd.Series(runs, dtype=object), errors="coerce").to_numpy(dtype=float)
+    if num.size and np.isfinite(num).all() and (num == np.round(num)).all():
+        return num.astype(np.int64)
+    return np.asarray(runs, dtype=object)
+
+
+def build_lj_long(z_df, westgard_result=None, point_df=None):
+    """
+    Bảng dạng dài (mỗi điểm z hợp lệ 1 dòng): Run, Control, z_score, point_status,
+    rule_codes, rule_short. Index = vị trí run trong z_df (trục x của biểu đồ).
+
+    Trạng thái / mã quy tắc lấy từ westgard_result (mask bit) nếu khớp kích thước,
+    ngược lại merge từ point_df theo (Ngày/Lần, Control); không có cả hai -> "Đạt".
+    """
+    runs = z_df["Ngày/Lần"].tolist()
+    z_cols = sorted(
+        [c for c in z_df.columns if c.startswith("z_Ctrl")], key=lambda x: int(x.split("Ctrl ")[1])
+    )
+    Z = z_df[z_cols].to_numpy(dtype=float)
+    n_runs, n_levels = Z.shape
+    controls = np.array([c[len("z_"):] for c in z_cols], dtype=object)
+
+    run_idx = np.repeat(np.arange(n_runs), n_levels)
+    lvl_idx = np.tile(np.arange(n_levels), n_runs)
+    z_flat = Z.ravel()
+    keep = ~np.isnan(z_flat)
+    run_idx, lvl_idx, z_flat = run_idx[keep], lvl_idx[keep], z_flat[keep]
+
+    df = pd.DataFrame(
+        {
+            "Run": _run_labels(runs)[run_idx] if n_runs else np.array([], dtype=object),
+            "Control": controls[lvl_idx] if n_levels else np.array([], dtype=object),
+            "z_score": z_flat,
+        },
+        index=pd.Index(run_idx, name=None),
+    )
+
+    if westgard_result is not None and westgard_result.flags.shape == Z.shape:
+        df["point_status"] = westgard_result.point_status().ravel()[keep]
+        df["rule_codes"] = westgard_result.point_rule_codes().ravel()[keep]
+        df["rule_short"] = westgard_result.rule_short().ravel()[keep]
+    elif point_df is not None and not point_df.empty and {"Ngày/Lần", "Control"} <= set(point_df.columns):
+        pts = point_df.drop_duplicates(["Ngày/Lần", "Control"])
+        keys = pd.DataFrame({"Ngày/Lần": np.asarray(runs, dtype=object)[run_idx], "Control": df["Control"].to_numpy()})
+        cols = [c for c in ("point_status", "rule_codes") if c in pts.columns]
+        merged = keys.merge(pts[["Ngày/Lần", "Control"] + cols], on=["Ngày/Lần", "Control"], how="left")
+        df["point_status"] = merged["point_status"].fillna(STATUS_OK).to_numpy() if "point_status" in merged else STATUS_OK
+        df["rule_codes"] = merged["rule_codes"].fillna("").to_numpy() if "rule_codes" in merged else ""
+        df["rule_short"] = _map_unique(df["rule_codes"].to_numpy(), short_rule_codes)
+    else:
+        df["point_status"] = STATUS_OK
+        df["rule_codes"] = ""
+        df["rule_short"] = ""
+    return df[LJ_COLUMNS]
+
+
+def lttb_indices(x, y, n_out):
+    """
+    Largest-Triangle-Three-Buckets: chọn n_out chỉ số (luôn giữ điểm đầu, cuối)
+    giữ hình dạng chuỗi. Vòng lặp theo bucket, trong bucket tính vector.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = x.size
+    if n_out >= n:
+        return np.arange(n)
+    if n_out <= 2:
+        return np.unique(np.array([0, n - 1]))[: max(n_out, 0)]
+
+    bounds = (np.floor(np.arange(n_out - 1) * (n - 2) / (n_out - 2)) + 1).astype(int)
+    bounds = np.r_[bounds, n - 1]
+    out = np.empty(n_out, dtype=int)
+    out[0], out[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = bounds[i], bounds[i + 1]
+        nlo, nhi = bounds[i + 1], (bounds[i + 2] if i + 2 < len(bounds) else n)
+        nhi = max(nhi, nlo + 1)
+        avg_x, avg_y = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        out[i + 1] = a
+    return out
+
+
+def downsample_lj_long(df_long, max_points):
+    """
+    Rút gọn bảng dạng dài còn khoảng max_points điểm (chia đều theo Control):
+    luôn giữ mọi điểm có cảnh báo / vi phạm (rule_codes khác rỗng) và mọi điểm |z| > 3,
+    phần ngân sách còn lại chọn bằng LTTB trên (vị trí run, z đã kẹp ±3).
+    Trả về (bảng đã rút gọn, số điểm ban đầu); giữ nguyên thứ tự dòng.
+    """
+    total = len(df_long)
+    if not max_points or total <= max_points:
+        return df_long, total
+
+    x_all = df_long.index.to_numpy(dtype=float)
+    y_all = np.clip(df_long["z_score"].to_numpy(dtype=float), -3, 3)
+    must = (df_long["rule_codes"].astype(str).str.strip() != "").to_numpy() | (
+        np.abs(df_long["z_score"].to_numpy(dtype=float)) > 3
+    )
+    controls = df_long["Control"].to_numpy()
+    levels = pd.unique(controls)
+    budget = max(2, int(max_points) // max(len(levels), 1))
+
+    keep = must.copy()
+    for ctrl in levels:
+        pos = np.flatnonzero(controls == ctrl)
+        free = pos[~must[pos]]
+        n_free = budget - int(must[pos].sum())
+        if free.size == 0:
+            continue
+        if n_free >= free.size:
+            keep[free] = True
+        elif n_free > 0:
+            keep[free[lttb_indices(x_all[free], y_all[free], n_free)]] = True
+    return df_long[keep], total
+
+
+def reduction_note(shown, total):
+    """Chú thích tỉ lệ rút gọn cho tiêu đề biểu đồ ('' nếu không rút gọn)."""
+    if shown >= total or not total:
+        return ""
+    return f" (hiển thị {shown:,}/{total:,} điểm, giảm {total / max(shown, 1):.1f}×)"
+
+
+def window_bounds(n_runs, start=None, stop=None, last_n=None):
+    """Khoảng run [start, stop) (vị trí 0-based) đã kẹp vào [0, n_runs]; last_n ưu tiên hơn start/stop."""
+    n_runs = max(int(n_runs), 0)
+    if last_n:
+        return max(n_runs - int(last_n), 0), n_runs
+    start = 0 if start is None else min(max(int(start), 0), n_runs)
+    stop = n_runs if stop is None else min(max(int(stop), start), n_runs)
+    return start, stop
+
+
+def slice_lj_window(df_long, start, stop):
+    """
+    Cắt bảng dạng dài theo vị trí run [start, stop) (index đã sắp tăng -> searchsorted).
+    Trạng thái / mã quy tắc giữ nguyên từ lần đánh giá toàn chuỗi, nên các quy tắc
+    nhiều run (nhìn lại tới WINDOW_RUNS run) vẫn đúng ở đầu cửa sổ.
+    """
+    pos = df_long.index.to_numpy()
+    lo, hi = np.searchsorted(pos, [start, stop], side="left")
+    return df_long.iloc[lo:hi]
@@ -0,0 +1,75 @@
+"""
+Process pool dùng chung cho các batch (Westgard, xuất PNG / Word, mô phỏng power).
+
+Không dùng "fork": pool được mở từ thread của JobRunner trong server Streamlit nhiều
+luồng, fork lúc đó chép cả lock đang bị giữ sang worker -> worker có thể treo.
+Dùng forkserver (hoặc spawn nếu nền tảng không có); IQC_MP_START_METHOD để đổi.
+
+Streamlit đặt trang đang chạy làm sys.modules["__main__"]; spawn / forkserver sẽ chạy
+lại file đó trong mỗi worker. Worker chỉ cần hàm ở module import được, nên lúc khởi
+động process __main__ được tạm thay bằng module rỗng.
+"""
+import multiprocessing
+import multiprocessing.context
+import os
+import sys
+import threading
+import types
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+MP_START_METHOD = os.environ.get("IQC_MP_START_METHOD", "forkserver")
+
+_EMPTY_MAIN = types.ModuleType("__main__")
+_MAIN_LOCK = threading.Lock()
+
+
+@contextmanager
+def _empty_main():
+    """Tạm thay __main__ bằng module rỗng (không __file__ / __spec__) khi khởi động worker."""
+    with _MAIN_LOCK:
+        main = sys.modules.get("__main__")
+        sys.modules["__main__"] = _EMPTY_MAIN
+        try:
+            yield
+        finally:
+            # trang Streamlit khác có thể đã đặt __main__ mới trong lúc đó: giữ nguyên
+            if sys.modules.get("__main__") is _EMPTY_MAIN:
+                sys.modules["__main__"] = main
+
+
+class _SpawnProcess(multiprocessing.context.SpawnProcess):
+    def start(self):
+        with _empty_main():
+            super().start()
+
+
+class _SpawnContext(multiprocessing.context.SpawnContext):
+    Process = _SpawnProcess
+
+
+_CONTEXTS = {"spawn": _SpawnContext}
+
+if hasattr(multiprocessing.context, "ForkServerContext"):  # không có trên Windows
+    class _ForkServerProcess(multiprocessing.context.ForkServerProcess):
+        def start(self):
+            with _empty_main():
+                super().start()
+
+    class _ForkServerContext(multiprocessing.context.ForkServerContext):
+        Process = _ForkServerProcess
+
+    _CONTEXTS["forkserver"] = _ForkServerContext
+
+
+def pool_context(method=None):
+    """Context multiprocessing cho process_pool (forkserver; không có thì spawn)."""
+    method = method or MP_START_METHOD
+    if method not in _CONTEXTS or method not in multiprocessing.get_all_start_methods():
+        method = "spawn"
+    return _CONTEXTS[method]()
+
+
+def process_pool(max_workers):
+    """ProcessPoolExecutor dùng chung cho mọi batch (xem docstring module)."""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=pool_context())
@@ -0,0 +1,157 @@
+"""
+Mô phỏng Monte Carlo hàm lực (power function) của các bộ quy tắc Westgard.
+
+Mỗi mô phỏng là 1 chuỗi: WINDOW_RUNS run trong kiểm soát (lịch sử cho các quy tắc
+nhìn lại nhiều run) rồi post_runs run sau khi xuất hiện sai số
+(SE: sai số hệ thống, đơn vị SD; RE: hệ số nhân SD của sai số ngẫu nhiên).
+Toàn bộ chunk mô phỏng được đánh giá 1 lượt bằng westgard_masks_batch
+(mỗi chuỗi như 1 "xét nghiệm"), nên không có vòng lặp Python theo run.
+
+- Ped: xác suất loại bỏ ở run đầu tiên sau khi có sai số.
+- Pfr: xác suất loại bỏ 1 run khi không có sai số (SE=0, RE=1).
+- ARL: số run trung bình đến khi phát hiện (phần sau post_runs ước lượng theo đuôi hình học).
+- E_Nuf: số KQ bệnh nhân không tin cậy kỳ vọng được trả ra trước khi phát hiện
+  = patients_per_run x P(|sai số| > TEa) x số run được chấp nhận trước run loại bỏ.
+"""
+import math
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.westgard_rules import (
+    REJECT_MASK,
+    WINDOW_RUNS,
+    pack_flags,
+    rule_set_bits,
+    westgard_masks_batch,
+)
+from utils.process_pool import process_pool
+from utils.westgard_batch import BatchProgress
+
+DEFAULT_SE_GRID = tuple(np.round(np.arange(0.0, 4.01, 0.5), 2))
+DEFAULT_RE_GRID = (1.0, 1.5, 2.0, 2.5, 3.0)
+
+
+def _norm_cdf(x):
+    return 0.5 * (1.0 + math.erf(x / math.sqrt(2.0)))
+
+
+def patient_error_probability(se, re, tea):
+    """P(|sai số KQ bệnh nhân| > TEa) với sai số ~ N(SE, RE²), mọi đại lượng tính theo SD."""
+    if tea is None or not np.isfinite(tea) or tea <= 0:
+        return np.nan
+    return _norm_cdf((-tea - se) / re) + 1.0 - _norm_cdf((tea - se) / re)
+
+
+def _simulate_point(rules, n_levels, se, re, n_sims, post_runs, chunk_size, seed):
+    """
+    Mô phỏng 1 điểm lưới (SE, RE) cho 1 bộ quy tắc, theo từng chunk để giới hạn bộ nhớ.
+    Trả về (Ped, tỉ lệ loại bỏ trung bình mỗi run, ARL, số run chấp nhận trước phát hiện).
+
+    Chuỗi chưa bị loại sau post_runs run được nối đuôi hình học: xác suất loại bỏ mỗi run
+    (hazard) ước lượng trên nửa sau cửa sổ, ở các chuỗi chưa bị loại trước run đó
+    -> số run còn lại kỳ vọng = 1 / hazard. Nhờ vậy ARL / E_Nuf không bị cắt ở post_runs
+    (vd ARL trong kiểm soát ~ 1 / Pfr chứ không phải ~ post_runs).
+    """
+    rng = np.random.default_rng(seed)
+    bits = np.uint16(rule_set_bits(rules) & REJECT_MASK)
+    n_runs = WINDOW_RUNS + post_runs
+    t0 = post_runs // 2
+    first_rej = 0
+    rej_rate = 0.0
+    det_len = 0      # tổng (run phát hiện) của các chuỗi đã bị loại trong cửa sổ
+    undetected = 0
+    events = 0       # lần loại bỏ đầu tiên rơi vào nửa sau cửa sổ
+    at_risk = 0      # số run (ở nửa sau) mà chuỗi chưa bị loại trước đó
+    done = 0
+    while done < n_sims:
+        c = min(chunk_size, n_sims - done)
+        Z = rng.standard_normal((c, n_runs, n_levels))
+        Z[:, WINDOW_RUNS:] = Z[:, WINDOW_RUNS:] * re + se
+        masks = westgard_masks_batch(Z, np.full(c, n_levels), rules)
+        flags = pack_flags(masks, Z.shape)[:, WINDOW_RUNS:]
+        rej = ((flags & bits) != 0).any(axis=-1)  # (c, post_runs)
+
+        detected = rej.any(axis=1)
+        first = np.argmax(rej, axis=1)
+        first_rej += int(rej[:, 0].sum())
+        rej_rate += float(rej.mean(axis=1).sum())
+        det_len += int((first[detected] + 1).sum())
+        undetected += int((~detected).sum())
+        events += int((detected & (first >= t0)).sum())
+        at_risk += int(np.clip(np.where(detected, first, post_runs - 1) - t0 + 1, 0, None).sum())
+        done += c
+
+    hazard = max(events, 0.5) / max(at_risk, 1)  # không có sự kiện -> chặn trên ARL thay vì vô hạn
+    tail = post_runs + 1.0 / hazard               # run phát hiện kỳ vọng của chuỗi chưa bị loại
+    arl = (det_len + undetected * tail) / n_sims
+    return first_rej / n_sims, rej_rate / n_sims, arl, arl - 1.0
+
+
+def _simulate_task(args):
+    return _simulate_point(*args)
+
+
+def simulate_power(rule_sets, n_levels, se_grid=DEFAULT_SE_GRID, re_grid=DEFAULT_RE_GRID,
+                   n_sims=20000, post_runs=2 * WINDOW_RUNS, patients_per_run=100, tea=None,
+                   chunk_size=5000, workers=1, seed=0, on_progress=None):
+    """
+    Tính đường power cho từng bộ quy tắc trên lưới SE x RE.
+
+    rule_sets: {nhãn: tập quy tắc}. tea: sai số tổng cho phép theo SD
+    (= sigma phương pháp khi bias = 0); None -> E_Nuf = NaN.
+    workers > 1: chia các điểm lưới cho process pool.
+    on_progress: callback(BatchProgress) sau mỗi điểm lưới; lỗi ném ra từ callback
+    (vd huỷ job) dừng mô phỏng và bỏ các điểm chưa chạy.
+    Trả về DataFrame dạng dài: Bộ quy tắc, SE, RE, Ped, Pfr, ARL, E_Nuf.
+    """
+    grid = [(float(se), float(re)) for re in re_grid for se in se_grid]
+    labels = list(rule_sets)
+    seeds = np.random.SeedSequence(seed).spawn(len(labels) * (len(grid) + 1))
+
+    tasks = []
+    for k, label in enumerate(labels):
+        rules = frozenset(rule_sets[label])
+        base = k * (len(grid) + 1)
+        # điểm (0, 1) dùng để ước lượng Pfr
+        tasks.append((rules, n_levels, 0.0, 1.0, n_sims, post_runs, chunk_size, seeds[base]))
+        for j, (se, re) in enumerate(grid):
+            tasks.append((rules, n_levels, se, re, n_sims, post_runs, chunk_size, seeds[base + j + 1]))
+
+    t_start = time.perf_counter()
+    out = []
+
+    def collect(results):
+        for res in results:
+            out.append(res)
+            if on_progress:
+                on_progress(BatchProgress(len(out), len(tasks), time.perf_counter() - t_start))
+
+    if workers and workers > 1:
+        pool = process_pool(workers)
+        try:
+            collect(pool.map(_simulate_task, tasks, chunksize=max(1, len(tasks) // (workers * 4))))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+    else:
+        collect(_simulate_task(t) for t in tasks)
+
+    rows = []
+    for k, label in enumerate(labels):
+        base = k * (len(grid) + 1)
+        pfr = out[base][1]
+        for j, (se, re) in enumerate(grid):
+            ped, _, arl, acc = out[base + j + 1]
+            rows.append(
+                {
+                    "Bộ quy tắc": label,
+                    "SE": se,
+                    "RE": re,
+                    "Ped": ped,
+                    "Pfr": pfr,
+                    "ARL": arl,
+                    "E_Nuf": patients_per_run * patient_error_probability(se, re, tea) * acc,
+                }
+            )
+    return pd.DataFrame(rows)
@@ -1,13 +1,245 @@
+import math
+import warnings
+from statistics import NormalDist
 
 import numpy as np
-import pandas as pd
+
+
+def column_stats(X):
+    """
+    Thống kê theo cột, bỏ qua NaN, 1 lượt vector hoá.
+    X: (n_runs,) | (n_runs, n_levels) | (n_analytes, n_runs, n_levels) — rút gọn theo trục run.
+    Trả về (mean, sd, cv, n) cùng shape (bỏ trục run); n=0 -> NaN, n=1 -> SD/CV NaN,
+    mean=0 -> CV NaN.
+    """
+    X = np.asarray(X, dtype=float)
+    if X.ndim == 1:
+        X = X[:, None]
+    axis = X.ndim - 2
+    valid = ~np.isnan(X)
+    n = valid.sum(axis=axis)
+    Xz = np.where(valid, X, 0.0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(n > 0, Xz.sum(axis=axis) / n, np.nan)
+        dev = np.where(valid, X - np.expand_dims(mean, axis), 0.0)
+        sd = np.where(n > 1, np.sqrt((dev ** 2).sum(axis=axis) / (n - 1)), np.nan)
+        cv = np.where((mean != 0) & ~np.isnan(sd), sd / mean * 100.0, np.nan)
+    return mean, sd, cv, n
+
+
+def stack_columns(arrays):
+    """Ghép các bảng (n_runs_i, n_levels_i) thành khối (A, max_runs, max_levels) đệm NaN."""
+    arrays = [np.asarray(a, dtype=float) for a in arrays]
+    arrays = [a if a.ndim == 2 else a.reshape(-1, 1) for a in arrays]
+    n_runs = max((a.shape[0] for a in arrays), default=0)
+    n_levels = max((a.shape[1] for a in arrays), default=0)
+    out = np.full((len(arrays), n_runs, n_levels), np.nan)
+    for i, a in enumerate(arrays):
+        out[i, : a.shape[0], : a.shape[1]] = a
+    return out
+
 
 def mean_sd_cv(values):
-    arr = np.asarray(values, dtype=float)
-    arr = arr[~np.isnan(arr)]
-    if arr.size == 0:
-        return np.nan, np.nan, np.nan
-    mean = float(np.mean(arr))
-    sd = float(np.std(arr, ddof=1)) if arr.size > 1 else np.nan
-    cv = (sd/mean*100.0) if mean not in (0.0, np.nan) and not np.isnan(mean) and not np.isnan(sd) else np.nan
-    return mean, sd, cv
+    mean, sd, cv, _ = column_stats(np.ravel(np.asarray(values, dtype=float)))
+    return float(mean[0]), float(sd[0]), float(cv[0])
+
+
+# ---------- Ước lượng bền vững / sàng lọc ngoại lai cho dữ liệu thiết lập ----------
+# (vector hoá theo cột; vòng lặp chỉ theo số lần lặp loại bỏ, không theo từng giá trị)
+
+ROBUST_METHODS = {
+    "none": "Chuẩn (Mean / SD)",
+    "mad": "Median / MAD",
+    "trim3sd": "Loại lặp ±3SD",
+    "grubbs": "Grubbs (α = 0,05)",
+    "tukey": "Tukey (1,5 IQR)",
+}
+
+MAD_SCALE = 1.4826
+
+
+def _as_columns(X):
+    X = np.asarray(X, dtype=float)
+    return X[:, None] if X.ndim == 1 else X
+
+
+def _run_axis_expand(v, X):
+    """Đưa thống kê theo cột về shape broadcast được với X (thêm lại trục run)."""
+    return np.expand_dims(v, X.ndim - 2)
+
+
+def median_mad(X):
+    """(median, SD ước lượng = 1,4826 x MAD, n) theo cột, bỏ qua NaN."""
+    X = _as_columns(X)
+    axis = X.ndim - 2
+    n = (~np.isnan(X)).sum(axis=axis)
+    if X.shape[axis] == 0:
+        return np.full(n.shape, np.nan), np.full(n.shape, np.nan), n
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # cột toàn NaN
+        med = np.nanmedian(X, axis=axis)
+        mad = np.nanmedian(np.abs(X - _run_axis_expand(med, X)), axis=axis)
+    return med, MAD_SCALE * mad, n
+
+
+def mad_outlier_mask(X, k=3.5):
+    """Điểm có |x - median| > k x SD(MAD) (modified z-score > k)."""
+    X = _as_columns(X)
+    med, sd, _ = median_mad(X)
+    with np.errstate(invalid="ignore"):
+        return np.abs(X - _run_axis_expand(med, X)) > k * _run_axis_expand(sd, X)
+
+
+def sd_trim_mask(X, k=3.0, max_iter=20):
+    """Loại lặp các điểm ngoài Mean ± k·SD (tính lại trên phần còn lại) đến khi ổn định."""
+    X = _as_columns(X)
+    keep = ~np.isnan(X)
+    for _ in range(max_iter):
+        mean, sd, _, _ = column_stats(np.where(keep, X, np.nan))
+        with np.errstate(invalid="ignore"):
+            out = keep & (np.abs(X - _run_axis_expand(mean, X)) > k * _run_axis_expand(sd, X))
+        if not out.any():
+            break
+        keep &= ~out
+    return ~keep & ~np.isnan(X)
+
+
+def _t_quantile(p, df):
+    """Phân vị Student t (không cần scipy): chính xác với df 1-2, khai triển Cornish–Fisher với df >= 3."""
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    z = NormalDist().inv_cdf(p)
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    g4 = (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+    return z + g1 / df + g2 / df ** 2 + g3 / df ** 3 + g4 / df ** 4
+
+
+def grubbs_critical(n, alpha=0.05):
+    """Giá trị tới hạn Grubbs 2 phía cho cỡ mẫu n (NaN nếu n < 3)."""
+    n = int(n)
+    if n < 3:
+        return np.nan
+    t = _t_quantile(1 - alpha / (2 * n), n - 2)
+    return (n - 1) / math.sqrt(n) * math.sqrt(t * t / (n - 2 + t * t))
+
+
+def grubbs_mask(X, alpha=0.05, max_iter=None):
+    """Grubbs lặp: mỗi lượt loại điểm xa Mean nhất của mỗi cột nếu G > G tới hạn."""
+    X = _as_columns(X)
+    axis = X.ndim - 2
+    keep = ~np.isnan(X)
+    max_iter = X.shape[axis] if max_iter is None else max_iter
+    crit = {}
+    for _ in range(max_iter):
+        mean, sd, _, n = column_stats(np.where(keep, X, np.nan))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dev = np.abs(X - _run_axis_expand(mean, X)) / _run_axis_expand(sd, X)
+        dev = np.where(keep & np.isfinite(dev), dev, -np.inf)
+        idx = np.argmax(dev, axis=axis)
+        g = np.take_along_axis(dev, _run_axis_expand(idx, X), axis=axis).squeeze(axis)
+        for m in np.unique(n):
+            crit.setdefault(int(m), grubbs_critical(m, alpha))
+        g_crit = np.vectorize(crit.get, otypes=[float])(n) if n.size else np.zeros(n.shape)
+        with np.errstate(invalid="ignore"):
+            hit = (n >= 3) & (g > g_crit)
+        if not hit.any():
+            break
+        drop = np.zeros_like(keep)
+        np.put_along_axis(drop, _run_axis_expand(idx, X), _run_axis_expand(hit, X), axis=axis)
+        keep &= ~drop
+    return ~keep & ~np.isnan(X)
+
+
+def tukey_mask(X, k=1.5):
+    """Điểm ngoài hàng rào Tukey [Q1 - k·IQR, Q3 + k·IQR]."""
+    X = _as_columns(X)
+    axis = X.ndim - 2
+    if X.shape[axis] == 0:
+        return np.zeros(X.shape, dtype=bool)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        q1, q3 = np.nanpercentile(X, [25, 75], axis=axis)
+    iqr = q3 - q1
+    lo = _run_axis_expand(q1 - k * iqr, X)
+    hi = _run_axis_expand(q3 + k * iqr, X)
+    with np.errstate(invalid="ignore"):
+        return (X < lo) | (X > hi)
+
+
+def robust_column_stats(X, method="none"):
+    """
+    Mean / SD / CV% / n theo cột theo phương pháp trong ROBUST_METHODS.
+    Trả về (mean, sd, cv, n, excluded) — excluded: mask các điểm bị loại (cùng shape X).
+    "mad": Mean = median, SD = 1,4826 x MAD trên toàn bộ điểm; excluded chỉ để báo cáo
+    (modified z > 3,5). Các phương pháp còn lại tính Mean/SD trên các điểm giữ lại.
+    """
+    X = _as_columns(X)
+    if method == "none":
+        mean, sd, cv, n = column_stats(X)
+        return mean, sd, cv, n, np.zeros(X.shape, dtype=bool)
+    if method == "mad":
+        mean, sd, n = median_mad(X)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            sd = np.where(n > 1, sd, np.nan)
+            cv = np.where((mean != 0) & ~np.isnan(sd), sd / mean * 100.0, np.nan)
+        return mean, sd, cv, n, mad_outlier_mask(X)
+
+    masks = {"trim3sd": sd_trim_mask, "grubbs": grubbs_mask, "tukey": tukey_mask}
+    if method not in masks:
+        raise ValueError(f"Unknown robust method: {method!r} (expected one of {tuple(ROBUST_METHODS)})")
+    excluded = masks[method](X)
+    mean, sd, cv, n = column_stats(np.where(excluded, np.nan, X))
+    return mean, sd, cv, n, excluded
+
+
+# ---------- Thống kê trượt / tích luỹ (thiết lập lại CSTK từ dữ liệu IQC hằng ngày) ----------
+
+
+def group_starts(groups):
+    """Chỉ số run đầu tiên của nhóm chứa mỗi run (các run cùng nhóm phải liên tiếp)."""
+    g = np.asarray(groups)
+    if g.size == 0:
+        return np.zeros(0, dtype=int)
+    new = np.r_[True, g[1:] != g[:-1]]
+    return np.maximum.accumulate(np.where(new, np.arange(g.size), 0))
+
+
+def rolling_column_stats(X, window=None, groups=None):
+    """
+    Mean / SD / CV% / n tại mỗi run (theo cột, bỏ qua NaN) trên cửa sổ kết thúc ở run đó.
+    window=N: N run gần nhất; None: tích luỹ từ run đầu.
+    groups (mã nhóm mỗi run, vd tháng hoặc lô): cửa sổ không vượt qua đầu nhóm
+    -> month-to-date / lot-to-date.
+    Dùng tổng tích luỹ (đã trừ giá trị tham chiếu của cột để ổn định số học) nên mỗi
+    bước O(1). Trả về mảng (n_runs, n_levels).
+    """
+    X = _as_columns(X)
+    n_runs = X.shape[0]
+    valid = ~np.isnan(X)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        ref = np.nan_to_num(np.nanmedian(X, axis=0)) if n_runs else np.zeros(X.shape[1])
+    D = np.where(valid, X - ref, 0.0)
+    zero = np.zeros((1, X.shape[1]))
+    c = np.vstack([zero, np.cumsum(valid, axis=0)])
+    s1 = np.vstack([zero, np.cumsum(D, axis=0)])
+    s2 = np.vstack([zero, np.cumsum(D * D, axis=0)])
+
+    end = np.arange(1, n_runs + 1)
+    lo = np.zeros(n_runs, dtype=int) if window is None else np.maximum(end - int(window), 0)
+    if groups is not None:
+        lo = np.maximum(lo, group_starts(groups))
+
+    n = (c[end] - c[lo]).astype(np.int64)
+    S1 = s1[end] - s1[lo]
+    S2 = s2[end] - s2[lo]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.where(n > 0, ref + S1 / n, np.nan)
+        var = np.where(n > 1, np.maximum(S2 - S1 * S1 / n, 0.0) / (n - 1), np.nan)
+        sd = np.sqrt(var)
+        cv = np.where((mean != 0) & ~np.isnan(sd), sd / mean * 100.0, np.nan)
+    return mean, sd, cv, n
@@ -0,0 +1,135 @@
+"""
+Đánh giá lại Westgard hàng loạt (toàn labo / nhiều labo) bằng process pool.
+
+Ma trận z của mọi xét nghiệm được ghép vào 1 vùng shared memory (float64);
+worker chỉ nhận tên vùng nhớ + offset/shape nên không phải pickle DataFrame.
+Mask bit kết quả được ghi ngược vào 1 vùng shared memory uint16 thứ hai.
+Kết quả được trả về dần theo từng shard hoàn thành.
+"""
+import math
+import os
+import time
+from concurrent.futures import as_completed
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from utils.process_pool import process_pool
+from utils.westgard_rules import WestgardResult, westgard_flags_batch
+
+
+@dataclass
+class BatchProgress:
+    """Tiến độ batch: số xét nghiệm đã xong / tổng, thời gian chạy, tốc độ."""
+    done: int
+    total: int
+    elapsed: float
+
+    @property
+    def rate(self):
+        """Số xét nghiệm / giây."""
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def _evaluate_shard(z_name, flags_name, items):
+    """
+    Chạy trong worker: items = [(offset, n_runs, n_levels, rules), ...].
+    Đọc z từ shared memory, ghi mask bit vào cùng offset ở vùng flags.
+    """
+    z_shm = shared_memory.SharedMemory(name=z_name)
+    f_shm = shared_memory.SharedMemory(name=flags_name)
+    z_all = f_all = Z_list = None
+    try:
+        z_all = np.ndarray((z_shm.size // 8,), dtype=np.float64, buffer=z_shm.buf)
+        f_all = np.ndarray((f_shm.size // 2,), dtype=np.uint16, buffer=f_shm.buf)
+        Z_list = [z_all[o:o + n * l].reshape(n, l) for o, n, l, _ in items]
+        flags_list = westgard_flags_batch(Z_list, [rules for *_, rules in items])
+        for (o, n, l, _), flags in zip(items, flags_list):
+            f_all[o:o + n * l] = flags.ravel()
+    finally:
+        # bỏ mọi view vào buffer trước khi close (tránh BufferError)
+        z_all = f_all = Z_list = None
+        z_shm.close()
+        f_shm.close()
+    return len(items)
+
+
+def iter_westgard_pool(jobs, workers=None, shard_size=None, on_progress=None):
+    """
+    Đánh giá Westgard cho nhiều xét nghiệm song song.
+
+    jobs: list (key, Z, runs, active_rules, sigma_cat).
+    workers: số process (mặc định os.cpu_count(); <=1 chạy tuần tự trong process hiện tại).
+    shard_size: số xét nghiệm mỗi lần gửi cho worker (mặc định chia ~4 shard / worker).
+    on_progress: callback(BatchProgress) sau mỗi shard.
+    Yield (key, WestgardResult) theo thứ tự shard hoàn thành.
+    """
+    jobs = list(jobs)
+    total = len(jobs)
+    if not total:
+        return
+    workers = (os.cpu_count() or 1) if workers is None else int(workers)
+    shard_size = shard_size or max(1, math.ceil(total / (max(workers, 1) * 4)))
+
+    Z_list = [np.ascontiguousarray(j[1], dtype=np.float64) for j in jobs]
+    sizes = [z.size for z in Z_list]
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(int).tolist()
+    n_cells = max(1, sum(sizes))
+
+    z_shm = shared_memory.SharedMemory(create=True, size=n_cells * 8)
+    f_shm = shared_memory.SharedMemory(create=True, size=n_cells * 2)
+    z_all = f_all = None
+    try:
+        z_all = np.ndarray((n_cells,), dtype=np.float64, buffer=z_shm.buf)
+        f_all = np.ndarray((n_cells,), dtype=np.uint16, buffer=f_shm.buf)
+        for o, z in zip(offsets, Z_list):
+            z_all[o:o + z.size] = z.ravel()
+
+        shards = [list(range(i, min(i + shard_size, total))) for i in range(0, total, shard_size)]
+
+        def items_of(shard):
+            return [(offsets[a], *Z_list[a].shape, tuple(sorted(jobs[a][3]))) for a in shard]
+
+        def collect(shard):
+            for a in shard:
+                key, _, runs, rules, sigma_cat = jobs[a]
+                z = Z_list[a]
+                flags = f_all[offsets[a]:offsets[a] + z.size].reshape(z.shape).copy()
+                yield key, WestgardResult(list(runs), z, flags, sigma_cat, set(rules))
+
+        t0 = time.perf_counter()
+        done = 0
+        if workers <= 1:
+            for shard in shards:
+                _evaluate_shard(z_shm.name, f_shm.name, items_of(shard))
+                yield from collect(shard)
+                done += len(shard)
+                if on_progress:
+                    on_progress(BatchProgress(done, total, time.perf_counter() - t0))
+        else:
+            with process_pool(workers) as pool:
+                futures = {
+                    pool.submit(_evaluate_shard, z_shm.name, f_shm.name, items_of(shard)): shard
+                    for shard in shards
+                }
+                for fut in as_completed(futures):
+                    fut.result()
+                    shard = futures[fut]
+                    yield from collect(shard)
+                    done += len(shard)
+                    if on_progress:
+                        on_progress(BatchProgress(done, total, time.perf_counter() - t0))
+    finally:
+        z_all = f_all = None
+        z_shm.close()
+        z_shm.unlink()
+        f_shm.close()
+        f_shm.unlink()
+
+
+def run_westgard_pool(jobs, workers=None, shard_size=None, on_progress=None):
+    """Như iter_westgard_pool nhưng gom hết: trả về ({key: WestgardResult}, BatchProgress)."""
+    t0 = time.perf_counter()
+    results = dict(iter_westgard_pool(jobs, workers, shard_size, on_progress))
+    return results, BatchProgress(len(results), len(results), time.perf_counter() - t0)
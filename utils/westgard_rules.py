@@ -1,5 +1,645 @@
-
 """
-Placeholder module: the app uses qc_core.evaluate_westgard for rules.
-This file is kept for structure clarity.
+Engine Westgard vector hoá (NumPy).
+
+Mỗi quy tắc được tính bằng mask trên toàn bộ ma trận Z (runs x levels) và
+cửa sổ trượt theo trục run, thay cho vòng lặp Python từng ô.
+Kết quả (summary_df / point_df) giống hệt qc_core._evaluate_westgard_legacy.
 """
+from dataclasses import dataclass, field
+from functools import cached_property
+
+import numpy as np
+import pandas as pd
+
+
+# Các "loại vi phạm" (một quy tắc có thể có biến thể theo mức hoặc theo lần chạy)
+# Thứ tự ở đây không ảnh hưởng kết quả vì thông điệp được sort khi tổng hợp.
+WARN_KINDS = ("1_2s",)
+REJECT_KINDS = (
+    "1_3s",
+    "2_2s_run", "2_2s_lvl",
+    "2of3_lvl", "2of3_run",
+    "R_4s",
+    "3_1s_lvl", "3_1s_run",
+    "4_1s_lvl", "4_1s_run",
+    "9x_lvl", "9x_run",
+    "10x_lvl", "10x_run",
+)
+
+# Mỗi loại vi phạm = 1 bit trong mask uint16 theo điểm (run, level).
+KIND_BITS = {kind: np.uint16(1 << n) for n, kind in enumerate(WARN_KINDS + REJECT_KINDS)}
+WARN_MASK = np.uint16(sum(int(KIND_BITS[k]) for k in WARN_KINDS))
+REJECT_MASK = np.uint16(sum(int(KIND_BITS[k]) for k in REJECT_KINDS))
+
+# Loại vi phạm -> mã quy tắc (như trong get_sigma_category_and_rules) và mã hiển thị.
+KIND_RULE = {kind: kind.rsplit("_", 1)[0] if kind.endswith(("_run", "_lvl")) else kind
+             for kind in KIND_BITS}
+KIND_RULE.update({"2of3_lvl": "2of3_2s", "2of3_run": "2of3_2s"})
+RULE_LABEL = {"2of3_2s": "2/3_2s"}
+
+# Mã quy tắc -> mask các bit tương ứng (lọc điểm theo quy tắc bằng phép AND).
+RULE_BITS = {}
+for _kind, _rule in KIND_RULE.items():
+    RULE_BITS[_rule] = np.uint16(int(RULE_BITS.get(_rule, 0)) | int(KIND_BITS[_kind]))
+
+STATUS_OK = "Đạt"
+STATUS_WARN = "Cảnh báo (1_2s)"
+STATUS_REJECT = "Không đạt (Reject QC)"
+
+
+def _window_count(mask, k, axis=0):
+    """Số phần tử True trong cửa sổ k run kết thúc tại mỗi run (0 nếu chưa đủ k run)."""
+    mask = np.moveaxis(np.asarray(mask, dtype=bool), axis, 0)
+    out = np.zeros(mask.shape, dtype=np.int32)
+    n = mask.shape[0]
+    if n >= k:
+        c = np.cumsum(mask, axis=0, dtype=np.int32)
+        out[k - 1] = c[k - 1]
+        out[k:] = c[k:] - c[:-k]
+    return np.moveaxis(out, 0, axis)
+
+
+def _window_all(mask, k, axis=0):
+    return _window_count(mask, k, axis) == k
+
+
+def westgard_masks(Z, active_rules):
+    """
+    Tính mask (n_runs, n_levels) cho từng loại vi phạm.
+    Trả về dict {kind: bool ndarray}; chỉ có các kind thuộc quy tắc đang áp dụng
+    (1_2s luôn có vì là quy tắc cảnh báo).
+    """
+    Z = np.asarray(Z, dtype=float)
+    masks = westgard_masks_batch(Z[None], [Z.shape[1]], active_rules)
+    return {kind: m[0] for kind, m in masks.items()}
+
+
+def westgard_masks_batch(Z, level_counts, rules):
+    """
+    Như westgard_masks nhưng cho tensor (n_analytes, n_runs, n_levels).
+
+    Z được pad NaN ở cuối trục run và trục level; level_counts là số mức QC thật
+    của từng xét nghiệm (2 hoặc 3). Các biến thể phụ thuộc số mức (4_1s 2x2,
+    9x 3x3, 10x, 3_1s theo lần chạy) được bật riêng theo level_counts.
+    rules: tập quy tắc cần tính (hợp của các bộ quy tắc trong batch).
+    """
+    Z = np.asarray(Z, dtype=float)
+    n_analytes, n_runs, n_levels = Z.shape
+    level_counts = np.asarray(level_counts, dtype=int).reshape(n_analytes)
+    lvl = (np.arange(n_levels)[None, :] < level_counts[:, None])[:, None, :]
+    pad = ~lvl
+
+    absZ = np.abs(Z)
+    valid = ~np.isnan(Z)
+    pos = Z > 0
+    neg = Z < 0
+
+    in_2_3 = (absZ >= 2) & (absZ < 3)
+    ge2 = absZ >= 2
+    ge1 = absZ >= 1
+
+    def per_analyte(cond):
+        return np.asarray(cond, dtype=bool)[:, None]
+
+    masks = {"1_2s": in_2_3}
+
+    if "1_3s" in rules:
+        masks["1_3s"] = absZ >= 3
+
+    if "2_2s" in rules:
+        # cùng lần chạy, ≥2 mức cùng phía 2–3SD
+        m = np.zeros_like(valid)
+        for side in (pos, neg):
+            g = in_2_3 & side
+            m |= g & (g.sum(axis=-1) >= 2)[..., None]
+        masks["2_2s_run"] = m
+
+        # cùng mức, 2 lần liên tiếp
+        m = np.zeros_like(valid)
+        for side in (pos, neg):
+            g = in_2_3 & side
+            m[:, 1:] |= g[:, 1:] & g[:, :-1]
+        masks["2_2s_lvl"] = m
+
+    if "2of3_2s" in rules:
+        # cùng mức, 2 trong 3 lần liên tiếp
+        m = np.zeros_like(valid)
+        for side in (pos, neg):
+            m |= _window_count(ge2 & side, 3, axis=1) >= 2
+        masks["2of3_lvl"] = m
+
+        # cùng lần chạy: ưu tiên phía (+) trước, giống vòng lặp gốc (break)
+        gp = ge2 & pos
+        gn = ge2 & neg
+        hit_p = gp.sum(axis=-1) >= 2
+        hit_n = ~hit_p & (gn.sum(axis=-1) >= 2)
+        masks["2of3_run"] = (gp & hit_p[..., None]) | (gn & hit_n[..., None])
+
+    if "R_4s" in rules:
+        zmax = np.where(valid, Z, -np.inf).max(axis=-1, initial=-np.inf)
+        zmin = np.where(valid, Z, np.inf).min(axis=-1, initial=np.inf)
+        hit = (
+            (valid.sum(axis=-1) >= 2)
+            & (zmax - zmin >= 4)
+            & (zmax >= 2)
+            & (zmin <= -2)
+        )
+        masks["R_4s"] = hit[..., None] & ((Z == zmax[..., None]) | (Z == zmin[..., None]))
+
+    if "3_1s" in rules:
+        m = np.zeros_like(valid)
+        for side in (pos, neg):
+            m |= _window_all(ge1 & side, 3, axis=1)
+        masks["3_1s_lvl"] = m
+
+        # cùng lần chạy (chỉ khi ≥3 mức): mọi mức phải có giá trị
+        row_ok = (valid | pad).all(axis=-1) & per_analyte(level_counts >= 3)
+        gp = ge1 & pos
+        gn = ge1 & neg
+        hit_p = row_ok & (gp.sum(axis=-1) >= 3)
+        hit_n = row_ok & ~hit_p & (gn.sum(axis=-1) >= 3)
+        masks["3_1s_run"] = (gp & hit_p[..., None]) | (gn & hit_n[..., None])
+
+    if "4_1s" in rules:
+        m = np.zeros_like(valid)
+        for side in (pos, neg):
+            m |= _window_all(ge1 & side, 4, axis=1)
+        masks["4_1s_lvl"] = m
+
+        # 2 lần chạy x 2 mức (chỉ khi 2 mức)
+        hit = np.zeros((n_analytes, n_runs), dtype=bool)
+        for side in (pos, neg):
+            hit |= _window_all(((ge1 & side) | pad).all(axis=-1), 2, axis=1)
+        hit &= per_analyte(level_counts == 2)
+        masks["4_1s_run"] = hit[..., None] & lvl
+
+    if "9x" in rules:
+        m = np.zeros_like(valid)
+        for side in (pos, neg):
+            m |= _window_all(side, 9, axis=1)
+        masks["9x_lvl"] = m
+
+        # 3 lần chạy x 3 mức (chỉ khi 3 mức)
+        hit = np.zeros((n_analytes, n_runs), dtype=bool)
+        for side in (pos, neg):
+            hit |= _window_all((side | pad).all(axis=-1), 3, axis=1)
+        hit &= per_analyte(level_counts == 3)
+        masks["9x_run"] = hit[..., None] & lvl
+
+    if "10x" in rules:
+        # 10x chỉ áp dụng cho 2 mức
+        two = per_analyte(level_counts == 2)
+        m = np.zeros_like(valid)
+        for side in (pos, neg):
+            m |= _window_all(side, 10, axis=1)
+        masks["10x_lvl"] = m & two[..., None]
+
+        hit = np.zeros((n_analytes, n_runs), dtype=bool)
+        for side in (pos, neg):
+            hit |= _window_all((side | pad).all(axis=-1), 5, axis=1)
+        masks["10x_run"] = (hit & two)[..., None] & lvl
+
+    return masks
+
+
+def _kind_messages(kind, i, levels, Z, runs):
+    """
+    Sinh thông điệp (tiếng Việt) cho 1 loại vi phạm tại run i.
+    levels: các mức bị đánh dấu tại run i. Trả về list (msg, [levels]).
+    """
+    if kind in ("1_2s", "1_3s"):
+        return [(f"{kind} (Ctrl {l+1}, z={Z[i, l]:.2f})", [l]) for l in levels]
+    if kind == "2_2s_run":
+        out = []
+        for side in (1, -1):
+            grp = [l for l in levels if np.sign(Z[i, l]) == side]
+            if grp:
+                msg = (
+                    "2_2s (cùng lần chạy, "
+                    + ", ".join(f"Ctrl {l+1}" for l in grp)
+                    + " cùng phía 2–3SD)"
+                )
+                out.append((msg, grp))
+        return out
+    if kind == "2_2s_lvl":
+        return [(f"2_2s (Ctrl {l+1}, runs {runs[i-1]}–{runs[i]})", [l]) for l in levels]
+    if kind == "2of3_lvl":
+        return [(f"2/3_2s (Ctrl {l+1}, runs {runs[i-2]}–{runs[i]})", [l]) for l in levels]
+    if kind == "2of3_run":
+        return [(f"2/3_2s (run {runs[i]}, ≥2 mức QC cùng phía ≥2SD)", levels)]
+    if kind == "R_4s":
+        return [(f"R_4s (run {runs[i]}, chênh lệch ≥4SD giữa các mức QC)", levels)]
+    if kind == "3_1s_lvl":
+        return [(f"3_1s (Ctrl {l+1}, runs {runs[i-2]}–{runs[i]})", [l]) for l in levels]
+    if kind == "3_1s_run":
+        return [(f"3_1s (run {runs[i]}, ≥3 mức QC cùng phía ≥1SD)", levels)]
+    if kind == "4_1s_lvl":
+        return [(f"4_1s (Ctrl {l+1}, runs {runs[i-3]}–{runs[i]})", [l]) for l in levels]
+    if kind == "4_1s_run":
+        return [("4_1s (2 lần chạy x 2 mức QC, tất cả cùng phía ≥1SD)", levels)]
+    if kind == "9x_lvl":
+        return [(f"9x (Ctrl {l+1}, 9 kết quả liên tiếp cùng phía)", [l]) for l in levels]
+    if kind == "9x_run":
+        return [("9x (3 lần chạy x 3 mức QC, tất cả cùng phía)", levels)]
+    if kind == "10x_lvl":
+        return [(f"10x (Ctrl {l+1}, 10 kết quả liên tiếp cùng phía)", [l]) for l in levels]
+    if kind == "10x_run":
+        return [("10x (5 lần chạy x 2 mức QC, tất cả cùng phía)", levels)]
+    raise KeyError(kind)
+
+
+def _collect_point_messages(runs, Z, masks, rows=None):
+    """
+    Gom thông điệp cảnh báo / loại bỏ theo điểm (i, l).
+    rows: chỉ xét các run này (mặc định: mọi run có vi phạm).
+    """
+    warn_point = {}
+    rej_point = {}
+    for kind, mask in masks.items():
+        target = warn_point if kind in WARN_KINDS else rej_point
+        hit = mask.any(axis=1)
+        hit_runs = np.flatnonzero(hit) if rows is None else [i for i in rows if hit[i]]
+        for i in hit_runs:
+            levels = np.flatnonzero(mask[i]).tolist()
+            for msg, lvls in _kind_messages(kind, i, levels, Z, runs):
+                for l in lvls:
+                    target.setdefault((i, l), set()).add(msg)
+    return warn_point, rej_point
+
+
+def _point_flags(masks, shape):
+    point_warn = np.zeros(shape, dtype=bool)
+    point_rej = np.zeros(shape, dtype=bool)
+    for kind, mask in masks.items():
+        if kind in WARN_KINDS:
+            point_warn |= mask
+        else:
+            point_rej |= mask
+    return point_warn, point_rej
+
+
+def _status(rej, warn):
+    return np.where(rej, STATUS_REJECT, np.where(warn, STATUS_WARN, STATUS_OK)).tolist()
+
+
+def _join_msgs(rej, warn):
+    return "; ".join(sorted(rej) + sorted(warn))
+
+
+def render_westgard_frames(runs, Z, masks):
+    """
+    Dựng summary_df (theo run) và point_df (theo điểm) từ các mask.
+    Chỉ sinh thông điệp cho các ô bị đánh dấu; các ô "Đạt" không tốn vòng lặp.
+    """
+    runs = list(runs)
+    Z = np.asarray(Z, dtype=float)
+    n_runs, n_levels = Z.shape
+
+    warn_point, rej_point = _collect_point_messages(runs, Z, masks)
+    point_warn, point_rej = _point_flags(masks, Z.shape)
+
+    # Tổng hợp theo run
+    if n_runs == 0:
+        summary_df = pd.DataFrame([])
+    else:
+        run_msgs = [""] * n_runs
+        by_run = {}
+        for src, pos in ((rej_point, 0), (warn_point, 1)):
+            for (i, _l), msgs in src.items():
+                by_run.setdefault(i, (set(), set()))[pos].update(msgs)
+        for i, (rejs, warns) in by_run.items():
+            run_msgs[i] = _join_msgs(rejs, warns)
+        summary_df = pd.DataFrame(
+            {
+                "Ngày/Lần": runs,
+                "Trạng thái": _status(point_rej.any(axis=1), point_warn.any(axis=1)),
+                "Vi phạm loại bỏ": run_msgs,
+                "Người thực hiện": [""] * n_runs,
+            }
+        )
+
+    # Tổng hợp theo điểm
+    if n_runs * n_levels == 0:
+        point_df = pd.DataFrame([])
+    else:
+        point_msgs = [""] * (n_runs * n_levels)
+        for key in set(rej_point) | set(warn_point):
+            i, l = key
+            point_msgs[i * n_levels + l] = _join_msgs(
+                rej_point.get(key, ()), warn_point.get(key, ())
+            )
+        point_df = pd.DataFrame(
+            {
+                "Ngày/Lần": [run for run in runs for _ in range(n_levels)],
+                "Control": [f"Ctrl {l+1}" for l in range(n_levels)] * n_runs,
+                "point_status": _status(point_rej.ravel(), point_warn.ravel()),
+                "rule_codes": point_msgs,
+            }
+        )
+
+    return summary_df, point_df
+
+
+# Quy tắc nhìn lại xa nhất là 10x (10 run) -> chỉ cần giữ 10 run cuối.
+WINDOW_RUNS = 10
+
+
+class WestgardStream:
+    """
+    Bộ đánh giá Westgard tăng dần (append-only).
+
+    Chỉ giữ WINDOW_RUNS run cuối trong ring buffer; mỗi lần push 1 run mới sẽ
+    đánh giá cửa sổ cố định này nên chi phí không phụ thuộc độ dài lịch sử.
+    Mọi vi phạm trong engine đều gán cho run cuối của cửa sổ nên kết quả của
+    run mới trùng với dòng tương ứng trong evaluate_westgard trên toàn bộ dữ liệu.
+    """
+
+    def __init__(self, active_rules, n_levels):
+        self.active_rules = set(active_rules)
+        self.n_levels = int(n_levels)
+        self._z = np.full((WINDOW_RUNS, self.n_levels), np.nan)
+        self._runs = [None] * WINDOW_RUNS
+        self._pos = 0      # vị trí ghi tiếp theo
+        self._count = 0    # tổng số run đã nhận
+
+    def __len__(self):
+        return self._count
+
+    def _window(self):
+        w = min(self._count, WINDOW_RUNS)
+        idx = (self._pos - w + np.arange(w)) % WINDOW_RUNS
+        return [self._runs[j] for j in idx], self._z[idx]
+
+    def _store(self, run, z_values):
+        z = np.asarray(z_values, dtype=float).reshape(-1)
+        if z.size != self.n_levels:
+            raise ValueError(f"Expected {self.n_levels} z-values, got {z.size}")
+        self._z[self._pos] = z
+        self._runs[self._pos] = run
+        self._pos = (self._pos + 1) % WINDOW_RUNS
+        self._count += 1
+
+    def push(self, run, z_values):
+        """
+        Thêm 1 run (nhãn 'Ngày/Lần' + z của từng mức) và đánh giá run đó.
+        Trả về (summary_row, point_rows) đúng định dạng 1 dòng summary_df
+        và n_levels dòng point_df.
+        """
+        self._store(run, z_values)
+        runs, Z = self._window()
+        masks = westgard_masks(Z, self.active_rules)
+        last = len(runs) - 1
+        warn_point, rej_point = _collect_point_messages(runs, Z, masks, rows=[last])
+        point_warn, point_rej = _point_flags(
+            {k: m[last:] for k, m in masks.items()}, (1, self.n_levels)
+        )
+
+        run_rej, run_warn = set(), set()
+        point_rows = []
+        for l in range(self.n_levels):
+            rej = rej_point.get((last, l), set())
+            warn = warn_point.get((last, l), set())
+            run_rej |= rej
+            run_warn |= warn
+            point_rows.append(
+                {
+                    "Ngày/Lần": run,
+                    "Control": f"Ctrl {l+1}",
+                    "point_status": _status(point_rej[0, l], point_warn[0, l]),
+                    "rule_codes": _join_msgs(rej, warn),
+                }
+            )
+        summary_row = {
+            "Ngày/Lần": run,
+            "Trạng thái": _status(point_rej.any(), point_warn.any()),
+            "Vi phạm loại bỏ": _join_msgs(run_rej, run_warn),
+            "Người thực hiện": "",
+        }
+        return summary_row, point_rows
+
+    def push_flags(self, run, z_values):
+        """Như push nhưng chỉ trả về mask bit uint16 (n_levels,) của run mới (không dựng thông điệp)."""
+        self._store(run, z_values)
+        _, Z = self._window()
+        return pack_flags(westgard_masks(Z, self.active_rules), Z.shape)[-1]
+
+    def seed(self, runs, Z):
+        """Nạp lịch sử (không đánh giá); chỉ WINDOW_RUNS run cuối được giữ lại."""
+        Z = np.asarray(Z, dtype=float).reshape(-1, self.n_levels)
+        runs = list(runs)
+        for run, z in zip(runs[-WINDOW_RUNS:], Z[-WINDOW_RUNS:]):
+            self._store(run, z)
+        self._count += max(0, len(runs) - WINDOW_RUNS)
+        return self
+
+
+def pack_flags(masks, shape):
+    """Gộp dict mask theo loại vi phạm thành 1 mảng bit uint16."""
+    flags = np.zeros(shape, dtype=np.uint16)
+    for kind, mask in masks.items():
+        flags[mask] |= KIND_BITS[kind]
+    return flags
+
+
+def unpack_masks(flags):
+    """Ngược lại pack_flags: {kind: bool ndarray} cho các loại có ít nhất 1 điểm."""
+    masks = {}
+    for kind, bit in KIND_BITS.items():
+        m = (flags & bit) != 0
+        if m.any():
+            masks[kind] = m
+    return masks
+
+
+def _short_codes(value):
+    """Mã quy tắc rút gọn cho 1 giá trị bit, cùng thứ tự với qc_core.extract_rule_short."""
+    value = int(value)
+    rej = sorted({
+        RULE_LABEL.get(KIND_RULE[k], KIND_RULE[k])
+        for k in REJECT_KINDS
+        if value & int(KIND_BITS[k])
+    })
+    warn = [KIND_RULE[k] for k in WARN_KINDS if value & int(KIND_BITS[k])]
+    return ", ".join(rej + [w for w in warn if w not in rej])
+
+
+@dataclass
+class WestgardResult:
+    """
+    Kết quả Westgard dạng cột: 1 mask bit uint16 cho mỗi điểm (run, level).
+
+    Thông điệp tiếng Việt và summary_df / point_df chỉ được dựng khi truy cập
+    (và cache lại); lọc theo quy tắc dùng phép AND trên `flags`.
+    """
+    runs: list
+    z: np.ndarray
+    flags: np.ndarray
+    sigma_cat: str = ""
+    active_rules: set = field(default_factory=set)
+
+    @property
+    def n_runs(self):
+        return self.flags.shape[0]
+
+    @property
+    def n_levels(self):
+        return self.flags.shape[1]
+
+    @property
+    def point_reject(self):
+        return (self.flags & REJECT_MASK) != 0
+
+    @property
+    def point_warn(self):
+        return (self.flags & WARN_MASK) != 0
+
+    @property
+    def run_reject(self):
+        return self.point_reject.any(axis=1)
+
+    @property
+    def run_warn(self):
+        return self.point_warn.any(axis=1)
+
+    @property
+    def trigger_z(self):
+        """z của các điểm có vi phạm (NaN ở điểm Đạt)."""
+        return np.where(self.flags != 0, self.z, np.nan)
+
+    def rule_mask(self, *rules):
+        """Điểm vi phạm ít nhất 1 trong các quy tắc (vd "2_2s", "R_4s")."""
+        bits = np.uint16(0)
+        for r in rules:
+            bits |= RULE_BITS[r]
+        return (self.flags & bits) != 0
+
+    def point_status(self):
+        """Nhãn trạng thái theo điểm, shape (n_runs, n_levels)."""
+        return np.asarray(_status(self.point_reject, self.point_warn), dtype=object)
+
+    def run_status(self):
+        return _status(self.run_reject, self.run_warn)
+
+    def rule_short(self):
+        """Mã quy tắc rút gọn theo điểm ("1_3s, 2_2s"...), tính 1 lần cho mỗi giá trị bit."""
+        values, inverse = np.unique(self.flags, return_inverse=True)
+        labels = np.array([_short_codes(v) for v in values], dtype=object)
+        return labels[inverse].reshape(self.flags.shape)
+
+    def point_rule_codes(self):
+        """
+        Thông điệp vi phạm theo điểm (như cột rule_codes của point_df), shape (n_runs, n_levels).
+        Chỉ dựng thông điệp cho các ô có bit khác 0; không dựng summary_df / point_df.
+        """
+        if "_frames" in self.__dict__:  # đã dựng (hoặc use_frames) -> dùng lại
+            codes = self.point_df["rule_codes"].to_numpy(dtype=object) if self.flags.size else []
+            return np.asarray(codes, dtype=object).reshape(self.flags.shape)
+        return self._point_codes
+
+    @cached_property
+    def _point_codes(self):
+        codes = np.full(self.flags.shape, "", dtype=object)
+        hit = self.flags != 0
+        if not hit.any():
+            return codes
+        rows = np.flatnonzero(hit.any(axis=1)).tolist()
+        warn_point, rej_point = _collect_point_messages(self.runs, self.z, unpack_masks(self.flags), rows=rows)
+        for i, l in zip(*np.nonzero(hit)):
+            codes[i, l] = _join_msgs(rej_point.get((i, l), ()), warn_point.get((i, l), ()))
+        return codes
+
+    @cached_property
+    def _frames(self):
+        return render_westgard_frames(self.runs, self.z, unpack_masks(self.flags))
+
+    def use_frames(self, summary_df, point_df):
+        """Gán sẵn bảng kết quả (vd từ engine gốc khi đối chiếu)."""
+        self._frames = (summary_df, point_df)
+
+    @property
+    def summary_df(self):
+        return self._frames[0]
+
+    @property
+    def point_df(self):
+        return self._frames[1]
+
+
+def build_westgard_result(Z, runs, active_rules, sigma_cat=""):
+    """Đánh giá Westgard vector hoá, trả về WestgardResult (chưa dựng thông điệp)."""
+    Z = np.asarray(Z, dtype=float)
+    flags = pack_flags(westgard_masks(Z, active_rules), Z.shape)
+    return WestgardResult(list(runs), Z, flags, sigma_cat, set(active_rules))
+
+
+def extend_westgard_result(result, Z, runs):
+    """
+    WestgardResult cho (runs, Z) = lịch sử của result + các run nối thêm ở cuối.
+    Run cũ giữ nguyên mask bit; mỗi run mới được đánh giá qua WestgardStream
+    (cửa sổ WINDOW_RUNS run cuối) nên chi phí chỉ tỉ lệ với số run mới.
+    """
+    Z = np.asarray(Z, dtype=float)
+    runs = list(runs)
+    n_old = result.n_runs
+    stream = WestgardStream(result.active_rules, result.n_levels).seed(result.runs, result.z)
+    new_flags = [stream.push_flags(run, z) for run, z in zip(runs[n_old:], Z[n_old:])]
+    flags = np.vstack([result.flags] + [f[None] for f in new_flags]) if new_flags else result.flags.copy()
+    return WestgardResult(runs, Z, flags, result.sigma_cat, set(result.active_rules))
+
+
+def rule_set_bits(active_rules):
+    """Mask bit của bộ quy tắc (luôn gồm 1_2s cảnh báo)."""
+    bits = int(WARN_MASK)
+    for r in active_rules:
+        bits |= int(RULE_BITS[r])
+    return np.uint16(bits)
+
+
+def stack_z(Z_list):
+    """
+    Xếp các ma trận Z (n_runs_i, n_levels_i) thành tensor pad NaN
+    (n_analytes, max_runs, max_levels) + số run / số mức thật của từng xét nghiệm.
+    """
+    run_counts = np.array([z.shape[0] for z in Z_list], dtype=int)
+    level_counts = np.array([z.shape[1] for z in Z_list], dtype=int)
+    Z3 = np.full(
+        (len(Z_list), run_counts.max(initial=0), level_counts.max(initial=0)), np.nan
+    )
+    for a, z in enumerate(Z_list):
+        Z3[a, : z.shape[0], : z.shape[1]] = z
+    return Z3, run_counts, level_counts
+
+
+def build_westgard_results_batch(Z_list, runs_list, rule_sets, sigma_cats=None):
+    """
+    Đánh giá Westgard cho nhiều xét nghiệm trong 1 lượt vector hoá trên tensor
+    (analyte x run x level). Mỗi xét nghiệm có bộ quy tắc riêng (rule_sets[i]).
+    Trả về list WestgardResult theo đúng thứ tự đầu vào.
+    """
+    if not Z_list:
+        return []
+    Z_list = [np.asarray(z, dtype=float) for z in Z_list]
+    sigma_cats = sigma_cats or [""] * len(Z_list)
+    flags_list = westgard_flags_batch(Z_list, rule_sets)
+    return [
+        WestgardResult(list(runs), z, flags, cat, set(rules))
+        for z, flags, runs, rules, cat in zip(Z_list, flags_list, runs_list, rule_sets, sigma_cats)
+    ]
+
+
+def westgard_flags_batch(Z_list, rule_sets):
+    """Phần tính toán của build_westgard_results_batch: trả về list mask bit theo xét nghiệm."""
+    if not Z_list:
+        return []
+    Z3, run_counts, level_counts = stack_z(Z_list)
+    all_rules = set().union(*map(set, rule_sets))
+    masks = westgard_masks_batch(Z3, level_counts, all_rules)
+    flags = pack_flags(masks, Z3.shape)
+    flags &= np.array([rule_set_bits(r) for r in rule_sets], dtype=np.uint16)[:, None, None]
+    return [flags[a, :n, :l].copy() for a, (n, l) in enumerate(zip(run_counts, level_counts))]
+
+
+def evaluate_westgard_numpy(Z, runs, active_rules):
+    """Đánh giá Westgard vector hoá; trả về (summary_df, point_df) giống engine gốc."""
+    result = build_westgard_result(Z, runs, active_rules)
+    return result.summary_df, result.point_df